@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from rover.utils import parse_epoch, format_epoch, _strptime_epoch, _strftime_epoch
+
+"""
+Micro-benchmark for the timestamp codec.
+
+Writes an availability response (one line per contiguous span, as returned
+by the availability service) and times parsing the start and end times of
+each line, then formatting them again, using the fast functions and the
+datetime-based originals.
+
+  python benchmarks/bench_epoch.py [--lines N]
+"""
+
+
+STATIONS = ['ANMO', 'COLA', 'KONO', 'MAJO', 'PAB']
+CHANNELS = ['BH1', 'BH2', 'BHZ', 'LHZ']
+
+
+def write_response(path, n_lines):
+    sncls = ['IU %s 00 %s' % (station, channel) for station in STATIONS for channel in CHANNELS]
+    per_sncl = n_lines // len(sncls) + 1
+    with open(path, 'w') as output:
+        print('#Network Station Location Channel Earliest Latest', file=output)
+        count = 0
+        for sncl in sncls:
+            start = 1262304000.0  # 2010-01-01
+            for _ in range(per_sncl):
+                if count == n_lines:
+                    return
+                end = start + 3599.975
+                print('%s %sZ %sZ' % (sncl, format_epoch(start), format_epoch(end)), file=output)
+                start = end + 37.025
+                count += 1
+
+
+def read_times(path):
+    with open(path, 'r') as input:
+        return [tuple(line.split()[4:6]) for line in input if not line.startswith('#')]
+
+
+def time_parse(times, parse):
+    start = perf_counter()
+    epochs = [(parse(b), parse(e)) for b, e in times]
+    return perf_counter() - start, epochs
+
+
+def time_format(epochs, format):
+    start = perf_counter()
+    for b, e in epochs:
+        format(b)
+        format(e)
+    return perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser(description='Time the timestamp codec on an availability response')
+    parser.add_argument('--lines', type=int, default=1000000, help='lines in the response')
+    args = parser.parse_args()
+    with TemporaryDirectory() as dir:
+        path = join(dir, 'availability.txt')
+        write_response(path, args.lines)
+        times = read_times(path)
+    slow, slow_epochs = time_parse(times, _strptime_epoch)
+    fast, fast_epochs = time_parse(times, parse_epoch)
+    assert slow_epochs == fast_epochs
+    print('parse  %d lines: strptime %.2fs, fast %.2fs (%.1fx)' % (len(times), slow, fast, slow / fast))
+    slow = time_format(fast_epochs, _strftime_epoch)
+    fast = time_format(fast_epochs, format_epoch)
+    print('format %d lines: strftime %.2fs, fast %.2fs (%.1fx)' % (len(times), slow, fast, slow / fast))
+
+
+if __name__ == '__main__':
+    main()
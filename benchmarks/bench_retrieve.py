@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser, REMAINDER
+from os.path import join
+from statistics import median
+from subprocess import run, STDOUT
+from tempfile import TemporaryDirectory
+from time import time
+
+from fdsn_server import Archive, FdsnServer, AVAILABILITY, DATASELECT, format_time
+
+"""
+Benchmark for retrieval, against a local availability and dataselect service
+(fdsn_server.py) that serves a directory of miniSEED files.
+
+Each run creates a new repository, requests everything in the directory and
+times `rover retrieve` (in a separate process), reporting chunks (dataselect
+responses) per second, MB/s, the time to first byte (as seen by the server,
+including the configured latency) and the wall time of each phase:
+
+  startup    - until the first availability query (includes pre-index)
+  available  - until the first dataselect request (availability, comparison with the index)
+  download   - until the last dataselect response (download, ingest, index)
+  finish     - until rover exits (final ingest and index, verification, summary)
+
+Arguments after -- are passed to rover (eg --download-engine inprocess).
+
+  python benchmarks/bench_retrieve.py [--dir DATA] [--latency SECS] [--bandwidth BYTES] [--runs N] [-- ...]
+"""
+
+
+def write_request(archive, path):
+    with open(path, 'w') as output:
+        for key in archive.sncls():
+            start, end = archive.extent(key)
+            print('%s %s %s' % (' '.join(code if code else '--' for code in key),
+                                format_time(start - 1), format_time(end + 1)), file=output)
+
+
+def retrieve(server, dir, rover_args):
+    """
+    Run rover in a new repository, returning the start and end times, exit code and output.
+    """
+    rover = ['rover']  # as installed (download workers also run this command)
+    run(rover + ['init-repository', dir], check=True, capture_output=True)
+    request = join(dir, 'request.txt')
+    write_request(server.archive, request)
+    server.events(clear=True)
+    # output goes to a file, not a pipe, because the web server (which outlives
+    # retrieve for a while) inherits it
+    with open(join(dir, 'output.txt'), 'w+') as output:
+        start = time()
+        result = run(rover + ['retrieve', request, '--availability-url', server.url(AVAILABILITY),
+                              '--dataselect-url', server.url(DATASELECT)] + rover_args,
+                     cwd=dir, stdout=output, stderr=STDOUT)
+        end = time()
+        output.seek(0)
+        return start, end, result.returncode, output.read()
+
+
+def report(start, end, events):
+    availability = [event for event in events if event.service == AVAILABILITY]
+    dataselect = [event for event in events if event.service == DATASELECT]
+    chunks = [event for event in dataselect if event.status == 200]
+    first_available = min((event.start for event in availability), default=end)
+    first_chunk = min((event.start for event in dataselect), default=first_available)
+    last_chunk = max((event.end for event in dataselect), default=first_chunk)
+    print('  phases:   startup %.2fs, available %.2fs, download %.2fs, finish %.2fs (wall %.2fs)' %
+          (first_available - start, first_chunk - first_available, last_chunk - first_chunk, end - last_chunk,
+           end - start))
+    print('  requests: %d availability, %d dataselect (%d with data)' %
+          (len(availability), len(dataselect), len(chunks)))
+    if chunks:
+        elapsed = max(last_chunk - first_chunk, 1e-6)
+        n_bytes = sum(event.n_bytes for event in chunks)
+        ttfb = [event.first_byte - event.start for event in chunks]
+        print('  download: %.2f chunks/s, %.2f MB/s (%d bytes); first byte %.3fs median, %.3fs max' %
+              (len(chunks) / elapsed, n_bytes / elapsed / 1e6, n_bytes, median(ttfb), max(ttfb)))
+    return end - start
+
+
+def main():
+    parser = ArgumentParser(description='Time rover retrieve against a local availability and dataselect service')
+    parser.add_argument('--dir', default='tests/data', help='directory of miniSEED files to serve')
+    parser.add_argument('--latency', type=float, default=0, help='delay before each response (seconds)')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='bytes per second for each response (0 for unlimited)')
+    parser.add_argument('--runs', type=int, default=1, help='number of retrievals (each in a new repository)')
+    parser.add_argument('rover_args', nargs=REMAINDER, help='-- followed by arguments for rover retrieve')
+    args = parser.parse_args()
+    rover_args = args.rover_args[1:] if args.rover_args[:1] == ['--'] else args.rover_args
+    archive = Archive(args.dir)
+    server = FdsnServer(archive, latency=args.latency, bandwidth=args.bandwidth)
+    server.start()
+    print('serving %d N_S_L_C from %d files (%d bytes); latency %.3fs, bandwidth %s' %
+          (len(archive.sncls()), archive.n_files, archive.n_bytes, args.latency,
+           '%d B/s' % args.bandwidth if args.bandwidth else 'unlimited'))
+    walls = []
+    try:
+        for index in range(args.runs):
+            with TemporaryDirectory() as dir:
+                start, end, code, output = retrieve(server, join(dir, 'repo'), rover_args)
+                print('run %d:' % (index + 1))
+                if code:
+                    print(output)
+                    raise Exception('rover retrieve failed (%d)' % code)
+                walls.append(report(start, end, server.events()))
+    finally:
+        server.shutdown()
+        server.server_close()
+    if len(walls) > 1:
+        print('wall: %.2fs median, %.2fs min, %.2fs max' % (median(walls), min(walls), max(walls)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from glob import glob
+from os.path import join, dirname, basename, getmtime
+from shutil import which
+from sqlite3 import connect
+from subprocess import check_call
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from rover.index import create_tsindex, tsindex_row, INSERT_TSINDEX
+from rover.mseed import scan_file, group_sections, section_hash
+
+"""
+Benchmark for the native miniSEED record scanner.
+
+Indexes each of the test data files (tests/data) into a new SQLite database,
+both by running mseedindex and natively (parsing the record headers, grouping
+them into sections and writing the tsindex rows), and checks that the rows
+agree.
+
+  python benchmarks/bench_scan.py [--repeat N] [--mseedindex CMD]
+"""
+
+
+DATA = join(dirname(dirname(__file__)), 'tests', 'data')
+COLUMNS = 'network, station, location, channel, version, starttime, endtime, samplerate, byteoffset, bytes, hash'
+
+
+def index_mseedindex(cmd, path, db_path):
+    check_call([cmd, '-sqlite', db_path, path])
+
+
+def index_native(path, db_path):
+    filemodtime = getmtime(path)
+    with open(path, 'rb') as input:
+        rows = [tsindex_row(path, section, section_hash(input, section), filemodtime)
+                for section in group_sections(scan_file(path))]
+    db = connect(db_path)
+    with db:
+        create_tsindex(db)
+        db.executemany(INSERT_TSINDEX, rows)
+    db.close()
+
+
+def rows(db_path):
+    db = connect(db_path)
+    try:
+        return db.execute('SELECT %s FROM tsindex ORDER BY byteoffset' % COLUMNS).fetchall()
+    finally:
+        db.close()
+
+
+def time_index(dir, name, index, repeat):
+    start = perf_counter()
+    for i in range(repeat):
+        db_path = join(dir, '%s-%d.sqlite' % (name, i))
+        index(db_path)
+    return (perf_counter() - start) / repeat, db_path
+
+
+def main():
+    parser = ArgumentParser(description='Time the native scanner against mseedindex on the test data')
+    parser.add_argument('--repeat', type=int, default=20, help='times to index each file')
+    parser.add_argument('--mseedindex', default=which('mseedindex'), help='mseedindex command')
+    args = parser.parse_args()
+    total_slow, total_fast = 0, 0
+    for path in sorted(glob(join(DATA, '*.mseed'))):
+        with TemporaryDirectory() as dir:
+            slow, slow_db = time_index(dir, 'mseedindex', lambda db: index_mseedindex(args.mseedindex, path, db),
+                                       args.repeat)
+            fast, fast_db = time_index(dir, 'native', lambda db: index_native(path, db), args.repeat)
+            assert rows(slow_db) == rows(fast_db), path
+        total_slow, total_fast = total_slow + slow, total_fast + fast
+        print('%s: mseedindex %.1fms, native %.1fms (%.1fx)' %
+              (basename(path), slow * 1000, fast * 1000, slow / fast))
+    print('total: mseedindex %.1fms, native %.1fms (%.1fx)' %
+          (total_slow * 1000, total_fast * 1000, total_slow / total_fast))
+
+
+if __name__ == '__main__':
+    main()
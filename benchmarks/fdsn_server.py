@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
+from fnmatch import fnmatchcase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import walk
+from os.path import join, getsize
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import urlsplit, parse_qsl
+
+from rover.mseed import scan_file, MSeedError
+from rover.utils import parse_epoch, format_epoch
+
+"""
+A local stand-in for the fdsnws-availability and fdsnws-dataselect services,
+serving a directory of miniSEED files, so that retrieval can be measured
+without a data center (see bench_retrieve.py).
+
+Availability is returned in the text format that rover requests (one line per
+contiguous span, merged over samplerate and quality, trimmed to the request).
+Dataselect returns the (whole) records that overlap the request.  Both accept
+POSTed request lines and GET query parameters.
+
+  python benchmarks/fdsn_server.py --dir DATA [--port N] [--latency SECS] [--bandwidth BYTES]
+
+then retrieve with, for example,
+
+  rover retrieve request.txt --availability-url http://127.0.0.1:8080/fdsnws/availability/1/query \\
+      --dataselect-url http://127.0.0.1:8080/fdsnws/dataselect/1/query
+"""
+
+
+AVAILABILITY = 'availability'
+DATASELECT = 'dataselect'
+HEADER = '#Network Station Location Channel Earliest Latest'
+BLOCKSIZE = 64 * 1024
+
+# a record in the archive (start and end are epoch seconds; end is the last sample)
+Entry = namedtuple('Entry', 'start end samplerate path offset length')
+
+# one response, for the benchmark (times are epoch seconds; first_byte is None if there was no data)
+Event = namedtuple('Event', 'service start first_byte end n_bytes status')
+
+
+class Archive:
+    """
+    The records in a directory of miniSEED files, by N_S_L_C.
+    """
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.n_files, self.n_bytes, self.skipped = 0, 0, []
+        records = defaultdict(list)
+        for root, dirs, files in walk(dir):
+            dirs.sort()
+            for file in sorted(files):
+                path = join(root, file)
+                try:
+                    scanned = scan_file(path)
+                except MSeedError as e:
+                    self.skipped.append((path, str(e)))
+                    continue
+                self.n_files += 1
+                self.n_bytes += getsize(path)
+                for record in scanned:
+                    records[record[0:4]].append(Entry(record.start, record.end, record.samplerate, path,
+                                                      record.offset, record.length))
+        self._records, self._starts = {}, {}
+        for key, entries in records.items():
+            entries.sort()
+            self._records[key] = entries
+            self._starts[key] = [entry.start for entry in entries]
+
+    def sncls(self):
+        """
+        The N_S_L_C codes (as tuples) in the archive, sorted.
+        """
+        return sorted(self._records.keys())
+
+    def extent(self, key):
+        """
+        The first and last times for the given N_S_L_C.
+        """
+        entries = self._records[key]
+        return entries[0].start, max(entry.end for entry in entries)
+
+    def _match(self, codes):
+        # codes may contain wildcards (and lists); '--' is the empty location
+        patterns = [['' if code == '--' else code for code in codes.split(',')] for codes in codes]
+        for key in self.sncls():
+            if all(any(fnmatchcase(code, pattern) for pattern in options) for code, options in zip(key, patterns)):
+                yield key
+
+    def _overlapping(self, key, begin, end):
+        entries, starts = self._records[key], self._starts[key]
+        # records are short, so step back until they cannot overlap (records may overlap each other)
+        index = bisect_right(starts, end)
+        while index > 0:
+            index -= 1
+            entry = entries[index]
+            if entry.end >= begin:
+                yield entry
+            elif entry.end < begin - 86400:
+                break
+
+    def availability(self, requests):
+        """
+        The contiguous spans (N_S_L_C, begin, end) in the requests, trimmed and sorted.
+        """
+        spans = set()
+        for codes, begin, end in requests:
+            for key in self._match(codes):
+                previous = None
+                for entry in sorted(self._overlapping(key, begin, end)):
+                    tolerance = 1.5 / entry.samplerate if entry.samplerate else 0
+                    if previous and entry.start <= previous[1] + tolerance:
+                        previous[1] = max(previous[1], entry.end)
+                    else:
+                        if previous:
+                            spans.add((key, max(begin, previous[0]), min(end, previous[1])))
+                        previous = [entry.start, entry.end]
+                if previous:
+                    spans.add((key, max(begin, previous[0]), min(end, previous[1])))
+        return sorted(spans)
+
+    def dataselect(self, requests):
+        """
+        The (path, offset, length) byte ranges of the records in the requests, in N_S_L_C
+        and time order, with adjacent records in a file merged.
+        """
+        entries = set()
+        for codes, begin, end in requests:
+            for key in self._match(codes):
+                entries.update((key, entry) for entry in self._overlapping(key, begin, end))
+        ranges = []
+        for key, entry in sorted(entries):
+            if ranges and ranges[-1][0] == entry.path and ranges[-1][1] + ranges[-1][2] == entry.offset:
+                ranges[-1][2] += entry.length
+            else:
+                ranges.append([entry.path, entry.offset, entry.length])
+        return ranges
+
+
+def parse_request(lines):
+    """
+    The (codes, begin, end) for each request line, ignoring options (key=value).
+    """
+    requests = []
+    for line in lines:
+        parts = line.split()
+        if not parts or '=' in line:
+            continue
+        if len(parts) != 6:
+            raise ValueError('Could not parse "%s"' % line.strip())
+        begin = 0 if parts[4] == '*' else parse_epoch(parts[4])
+        end = float('inf') if parts[5] == '*' else parse_epoch(parts[5])
+        requests.append((tuple(parts[0:4]), begin, end))
+    return requests
+
+
+def parse_query(query):
+    """
+    The request for GET parameters (using the same shape as parse_request).
+    """
+    params = dict(parse_qsl(query, keep_blank_values=True))
+
+    def param(*names):
+        for name in names:
+            if name in params:
+                return params[name]
+        return '*'
+
+    line = ' '.join((param('net', 'network'), param('sta', 'station'), param('loc', 'location'),
+                     param('cha', 'channel'), param('start', 'starttime'), param('end', 'endtime')))
+    return parse_request([line])
+
+
+def format_time(epoch):
+    return format_epoch(epoch) + 'Z'
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self._respond(url.path, lambda: parse_query(url.query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._respond(urlsplit(self.path).path, lambda: parse_request(body.decode('ascii').splitlines()))
+
+    def _respond(self, path, parse):
+        start = time()
+        service = AVAILABILITY if AVAILABILITY in path else DATASELECT if DATASELECT in path else None
+        if not service:
+            self._send_error(404, 'Unknown service %s' % path)
+            return
+        try:
+            requests = parse()
+        except ValueError as e:
+            self._send_error(400, str(e))
+            return
+        sleep(self.server.latency)
+        if service == AVAILABILITY:
+            spans = self.server.archive.availability(requests)
+            body = '\n'.join([HEADER] + ['%s %s %s' % (' '.join(code if code else '--' for code in key),
+                                                       format_time(begin), format_time(end))
+                                         for key, begin, end in spans]).encode('ascii') + b'\n'
+            ranges, length = None, len(body) if spans else 0
+        else:
+            ranges = self.server.archive.dataselect(requests)
+            body, length = None, sum(range[2] for range in ranges)
+        if not length:
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            self.server.record(Event(service, start, None, time(), 0, 204))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain' if body else 'application/vnd.fdsn.mseed')
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        throttle = Throttle(self.server.bandwidth)
+        first_byte = time()
+        if body:
+            for offset in range(0, len(body), BLOCKSIZE):
+                throttle.write(self.wfile, body[offset:offset + BLOCKSIZE])
+        else:
+            for path, offset, remaining in ranges:
+                with open(path, 'rb') as input:
+                    input.seek(offset)
+                    while remaining:
+                        block = input.read(min(BLOCKSIZE, remaining))
+                        throttle.write(self.wfile, block)
+                        remaining -= len(block)
+        self.server.record(Event(service, start, first_byte, time(), length, 200))
+
+    def _send_error(self, status, message):
+        body = message.encode('ascii', 'replace')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class Throttle:
+    """
+    Limit writes to the given bandwidth (bytes per second, per response; 0 is unlimited).
+    """
+
+    def __init__(self, bandwidth):
+        self._bandwidth = bandwidth
+        self._start = time()
+        self._written = 0
+
+    def write(self, output, block):
+        output.write(block)
+        self._written += len(block)
+        if self._bandwidth:
+            delay = self._written / self._bandwidth - (time() - self._start)
+            if delay > 0:
+                sleep(delay)
+
+
+class FdsnServer(ThreadingHTTPServer):
+    """
+    The availability and dataselect services for an archive, recording an Event for
+    each response (see events()).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, archive, port=0, latency=0, bandwidth=0, verbose=False):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.archive = archive
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.verbose = verbose
+        self._events = []
+        self._lock = Lock()
+
+    def url(self, service):
+        return 'http://127.0.0.1:%d/fdsnws/%s/1/query' % (self.server_address[1], service)
+
+    def record(self, event):
+        with self._lock:
+            self._events.append(event)
+
+    def events(self, clear=False):
+        with self._lock:
+            events = list(self._events)
+            if clear:
+                self._events = []
+        return events
+
+    def start(self):
+        """
+        Serve in a background thread.
+        """
+        thread = Thread(target=self.serve_forever, name='fdsn-server', daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = ArgumentParser(description='Serve availability and dataselect from a directory of miniSEED files')
+    parser.add_argument('--dir', default='tests/data', help='directory of miniSEED files')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (localhost only)')
+    parser.add_argument('--latency', type=float, default=0, help='delay before each response (seconds)')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='bytes per second for each response (0 for unlimited)')
+    parser.add_argument('--verbose', action='store_true', help='log each request')
+    args = parser.parse_args()
+    archive = Archive(args.dir)
+    for path, error in archive.skipped:
+        print('skipped %s: %s' % (path, error))
+    server = FdsnServer(archive, port=args.port, latency=args.latency, bandwidth=args.bandwidth,
+                        verbose=args.verbose)
+    print('serving %d N_S_L_C from %d files (%d bytes)' % (len(archive.sncls()), archive.n_files, archive.n_bytes))
+    print('  %s' % server.url(AVAILABILITY))
+    print('  %s' % server.url(DATASELECT))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,7 @@ from smtplib import SMTP_PORT
 from textwrap import dedent
 
 from .__version__ import __version__
-from .utils import create_parents, canonify, check_cmd, dictionary_text_list
+from .utils import create_parents, canonify, check_cmd, dictionary_text_list, calc_bytes
 
 """
 Command line / file configuration parameters.
@@ -50,10 +50,14 @@ ALL = 'all'
 ARGS = 'args'
 ASDF_FILENAME = 'asdf-filename'
 AVAILABILITYURL = 'availability-url'
+AVAILABILITYWORKERS = 'availability-workers'
+CHECKPOINTPERIOD = 'checkpoint-period'
+CHUNKSIZE = 'chunk-size'
 COMMAND = 'command'
 DATADIR = 'data-dir'
 DATASELECTURL = 'dataselect-url'
 DELETEFILES = 'delete-files'
+DOWNLOADENGINE = 'download-engine'
 DOWNLOADRETRIES = 'download-retries'
 DOWNLOADWORKERS = 'download-workers'
 DEV = 'dev'
@@ -68,9 +72,11 @@ H, FULLHELP = 'H', 'full-help'
 _h, _help = 'h', 'help'
 FULLCONFIG = 'full-config'
 HTTPBINDADDRESS = 'http-bind-address'
+HTTPBLOCKSIZE = 'http-block-size'
 HTTPPORT = 'http-port'
 HTTPRETRIES = 'http-retries'
 HTTPTIMEOUT = 'http-timeout'
+INDEXENGINE = 'index-engine'
 LOGDIR = 'log-dir'
 LOGVERBOSITY = 'log-verbosity'
 LOGSIZE = 'log-size'
@@ -81,6 +87,7 @@ MDFORMAT = 'md-format'
 MSEEDINDEXCMD = 'mseedindex-cmd'
 MSEEDINDEXWORKERS = 'mseedindex-workers'
 OUTPUT_FORMAT = 'output-format'
+PIPELINE = 'pipeline'
 POSTSUMMARY = 'post-summary'
 PREINDEX = 'pre-index'
 RECHECKPERIOD = 'recheck-period'
@@ -106,20 +113,34 @@ LITTLE_CONFIG = (DATADIR, DOWNLOADRETRIES, DOWNLOADWORKERS, OUTPUT_FORMAT,
                  EMAIL, SMTPADDRESS, SMTPPORT)
 DYNAMIC_ARGS = (VERSION, HELP_CMD, FULLHELP)
 
+# download engines
+SUBPROCESS = 'subprocess'
+INPROCESS = 'inprocess'
+
+# index engines
+NATIVE = 'native'
+MSEEDINDEX = 'mseedindex'
+
 # default values (for non-boolean parameters)
 DEFAULT_ASDF_FILENAME = 'asdf.h5'
 DEFAULT_AVAILABILITYURL = 'http://service.iris.edu/fdsnws/availability/1/query'
+DEFAULT_AVAILABILITYWORKERS = 3
+DEFAULT_CHECKPOINTPERIOD = 600
+DEFAULT_CHUNKSIZE = '0'
 DEFAULT_DATADIR = 'data'
 DEFAULT_DATASELECTURL = 'http://service.iris.edu/fdsnws/dataselect/1/query'
+DEFAULT_DOWNLOADENGINE = SUBPROCESS
 DEFAULT_DOWNLOADRETRIES = 3
 DEFAULT_DOWNLOADWORKERS = 5
 DEFAULT_EMAILFROM = 'noreply@rover'
 DEFAULT_FILE = join('rover.config')
 DEFAULT_FORCEFAILURES = 0
 DEFAULT_HTTPBINDADDRESS = '127.0.0.1'
+DEFAULT_HTTPBLOCKSIZE = '1M'
 DEFAULT_HTTPPORT = 8000
 DEFAULT_HTTPRETRIES = 3
 DEFAULT_HTTPTIMEOUT = 60
+DEFAULT_INDEXENGINE = MSEEDINDEX
 DEFAULT_LOGDIR = 'logs'
 DEFAULT_LOGVERBOSITY = 4
 DEFAULT_LOGSIZE = '10M'
@@ -285,6 +306,10 @@ class Arguments(ArgumentParser):
         retrieve_group.add_argument(mm(TIMESPANTOL), default=DEFAULT_TIMESPANTOL, action='store', help='fractional tolerance for overlapping timespans', metavar=SAMPLESVAR, type=float)
         retrieve_group.add_argument(mm(DOWNLOADRETRIES), default=DEFAULT_DOWNLOADRETRIES, action='store', help='maximum number of attempts to download data', metavar=NVAR, type=int)
         retrieve_group.add_argument(mm(DOWNLOADWORKERS), default=DEFAULT_DOWNLOADWORKERS, action='store', help='number of download instances to run', metavar=NVAR, type=int)
+        retrieve_group.add_argument(mm(DOWNLOADENGINE), default=DEFAULT_DOWNLOADENGINE, action='store', help='run downloads as "subprocess" (rover download) or "inprocess" (threads)', metavar='')
+        retrieve_group.add_argument(mm(CHUNKSIZE), default=DEFAULT_CHUNKSIZE, action='store', help='estimated size of each download request, 0 for one station-day (e.g. 50M)', metavar=SIZE)
+        retrieve_group.add_argument(mm(PIPELINE), default=False, action='store_bool', help='start downloads while checking availability?', metavar='')
+        retrieve_group.add_argument(mm(CHECKPOINTPERIOD), default=DEFAULT_CHECKPOINTPERIOD, action='store', help='time between database checkpoints, 0 for automatic', metavar=SECSVAR, type=int)
         retrieve_group.add_argument(mm(ROVERCMD), default=DEFAULT_ROVERCMD, action='store', help='command to run rover', metavar=CMDVAR)
         retrieve_group.add_argument(mm(PREINDEX), default=True, action='store_bool', help='index before retrieval?', metavar='')
         retrieve_group.add_argument(mm(INGEST), default=True, action='store_bool', help='call ingest after retrieval?', metavar='')
@@ -301,11 +326,13 @@ class Arguments(ArgumentParser):
         # downloads
         download_group = self.add_argument_group('download arguments')
         download_group.add_argument(mm(AVAILABILITYURL), default=DEFAULT_AVAILABILITYURL, action='store', help='availability service url', metavar=URLVAR)
+        download_group.add_argument(mm(AVAILABILITYWORKERS), default=DEFAULT_AVAILABILITYWORKERS, action='store', help='number of parallel availability queries', metavar=NVAR, type=int)
         download_group.add_argument(mm(DATASELECTURL), default=DEFAULT_DATASELECTURL, action='store', help='dataselect service url', metavar=URLVAR)
         download_group.add_argument(mm(TEMPDIR), default=DEFAULT_TEMPDIR, action='store', help='temporary storage for downloads', metavar=DIRVAR)
         download_group.add_argument(mm(TEMPEXPIRE), default=DEFAULT_TEMPEXPIRE, action='store', help='number of days before deleting temp files', metavar=DAYSVAR, type=int)
         download_group.add_argument(mm(HTTPTIMEOUT), default=DEFAULT_HTTPTIMEOUT, action='store', help='timeout for HTTP requests', metavar=SECSVAR, type=int)
         download_group.add_argument(mm(HTTPRETRIES), default=DEFAULT_HTTPRETRIES, action='store', help='max retries for HTTP requests', metavar=NVAR, type=int)
+        download_group.add_argument(mm(HTTPBLOCKSIZE), default=DEFAULT_HTTPBLOCKSIZE, action='store', help='size of blocks read from HTTP responses (e.g. 1M)', metavar=SIZE)
         download_group.add_argument(mm(FORCEFAILURES), default=DEFAULT_FORCEFAILURES, action='store', help='force failures for testing (dangerous)', metavar=PERCENTVAR, type=int)
         download_group.add_argument(mm(SORTINPYTHON), default=False, action='store_bool', help='avoid OS sort (slower)?', metavar='')
 
@@ -334,6 +361,7 @@ class Arguments(ArgumentParser):
         mseedindex_group = self.add_argument_group('mseedindex arguments')
         mseedindex_group.add_argument(mm(MSEEDINDEXCMD), default=DEFAULT_MSEEDINDEXCMD, action='store', help='mseedindex command', metavar=CMDVAR)
         mseedindex_group.add_argument(mm(MSEEDINDEXWORKERS), default=DEFAULT_MSEEDINDEXWORKERS, action='store', help='number of mseedindex instances to run', metavar=NVAR, type=int)
+        mseedindex_group.add_argument(mm(INDEXENGINE), default=DEFAULT_INDEXENGINE, action='store', help='index with "mseedindex" or (opt-in, experimental) "native" header parsing', metavar='')
 
         # user feedback
         user_feedback_group = self.add_argument_group('user feedback arguments')
@@ -624,6 +652,14 @@ class Arguments(ArgumentParser):
                         dictionary_text_list(ADVANCED_COMMANDS)))
 
 
+def http_pool_size(config):
+    """
+    The number of HTTP connections to keep for each host: enough for all download
+    workers and availability queries to make requests at once.
+    """
+    return config.arg(DOWNLOADWORKERS) + config.arg(AVAILABILITYWORKERS)
+
+
 def fail_early(config):
     """
     Check commands so that we fail early.
@@ -637,6 +673,28 @@ def fail_early(config):
     elif workers > 5:
         config.log.warn('Many workers - data center may refuse service (%s %d)' %
                         (mm(DOWNLOADWORKERS), workers))
+    if config.arg(CHECKPOINTPERIOD) < 0:
+        raise Exception('The checkpoint period cannot be negative (%s %d)' %
+                        (mm(CHECKPOINTPERIOD), config.arg(CHECKPOINTPERIOD)))
+    if config.arg(AVAILABILITYWORKERS) < 1:
+        raise Exception('At least one availability query is needed (%s %d)' %
+                        (mm(AVAILABILITYWORKERS), config.arg(AVAILABILITYWORKERS)))
+    engine = config.arg(DOWNLOADENGINE)
+    if engine not in (SUBPROCESS, INPROCESS):
+        raise Exception('Unknown download engine "%s" (%s must be "%s" or "%s")' %
+                        (engine, mm(DOWNLOADENGINE), SUBPROCESS, INPROCESS))
+    engine = config.arg(INDEXENGINE)
+    if engine not in (NATIVE, MSEEDINDEX):
+        raise Exception('Unknown index engine "%s" (%s must be "%s" or "%s")' %
+                        (engine, mm(INDEXENGINE), NATIVE, MSEEDINDEX))
+    for size in (CHUNKSIZE, HTTPBLOCKSIZE):
+        try:
+            calc_bytes(config.arg(size))
+        except ValueError:
+            raise Exception('Cannot parse %s %s (expected a size like 50M)' % (mm(size), config.arg(size)))
+    if calc_bytes(config.arg(HTTPBLOCKSIZE)) <= 0:
+        raise Exception('The HTTP block size must be positive (%s %s)' %
+                        (mm(HTTPBLOCKSIZE), config.arg(HTTPBLOCKSIZE)))
     if config.arg(OUTPUT_FORMAT).upper() == "ASDF":
         try:
             import pyasdf
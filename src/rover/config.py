@@ -1,5 +1,6 @@
 
 from argparse import Namespace
+from copy import copy
 from genericpath import exists
 from os import makedirs, getcwd
 from os.path import isabs, join, realpath, abspath, expanduser, dirname
@@ -125,6 +126,16 @@ class BaseConfig:
 def timeseries_db(config):
     return join(config.dir(DATADIR), 'timeseries.sqlite')
 
+
+def thread_config(config):
+    """
+    A copy of the configuration with its own database connection, for use in
+    a worker thread (sqlite connections cannot be shared across threads).
+    """
+    config = copy(config)
+    config.db = init_db(timeseries_db(config), config.log)
+    return config
+
 def asdf_container(config):
     return join(config.dir(DATADIR), config.arg(ASDF_FILENAME))
 
@@ -1,6 +1,13 @@
 
+from itertools import chain
+
 from .utils import PushBackIterator, format_epoch, parse_epoch
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # numpy is optional (see ArrayCoverage)
+
 """
 Interface to the N_S_L_C / timespan data in tsindex - how much data do we have
 for particular channels?
@@ -110,9 +117,17 @@ class Coverage:
         self.join()
         other.join()
 
-        us, them = PushBackIterator(iter(self.timespans)), PushBackIterator(iter(other.timespans))
-        difference = Coverage(self._log, self._frac_tolerance, self._frac_increment, self.sncl)
+        difference = self.__class__(self._log, self._frac_tolerance, self._frac_increment, self.sncl)
         difference.add_samplerate(self.samplerate)
+        difference.timespans = self._subtract_timespans(self.timespans, other.timespans, tolerance, increment)
+        return difference
+
+    def _subtract_timespans(self, us, them, tolerance, increment):
+        """
+        The core of subtract(), for (joined, sorted) lists of timespans.
+        """
+        us, them = PushBackIterator(iter(us)), PushBackIterator(iter(them))
+        difference = []
         while True:
             try:
                 us_start, us_end = next(us)
@@ -124,10 +139,10 @@ class Coverage:
             except StopIteration:
                 # there's no more subtraction, so everything left goes into difference
                 if us_end - us_start >= tolerance:
-                    difference.add_epochs(us_start, us_end)
+                    difference.append((us_start, us_end))
                 for (us_start, us_end) in us:
                     if us_end - us_start >= tolerance:
-                        difference.add_epochs(us_start, us_end)
+                        difference.append((us_start, us_end))
                 return difference
 
             # we start together
@@ -150,14 +165,14 @@ class Coverage:
                 # we also end before them, so we're home free into the difference and
                 # they live to try kill our next timespan
                 if us_end < them_start:
-                    difference.add_epochs(us_start, us_end)
+                    difference.append((us_start, us_end))
                     them.push((them_start, them_end))
                 # we end after they start, so we overlap.  save the initial part in
                 # the difference and push the rest back for further consideration.
                 else:
                     # is (us_start, them_start - increment) worth adding?
                     if them_start - increment - us_start >= tolerance:
-                        difference.add_epochs(us_start, them_start - increment)
+                        difference.append((us_start, them_start - increment))
                     if us_end - them_start > tolerance:
                         us.push((them_start, us_end))
                     them.push((them_start, them_end))
@@ -176,6 +191,153 @@ class Coverage:
                     us.push((max(them_end + increment, us_start), us_end))
 
 
+class ArrayCoverage(Coverage):
+    """
+    A Coverage that joins and subtracts large numbers of timespans using numpy arrays
+    (requires numpy - see new_coverage()).
+
+    The results are identical to Coverage, including the quirks of the original
+    sequential logic.  Where the arrays cannot reproduce that logic (eg unsorted
+    data) we fall back to the code in Coverage, as we do for small coverages, where
+    conversion to arrays costs more than it saves.
+    """
+
+    # below this number of timespans, use the plain python code
+    THRESHOLD = 32
+
+    def __init__(self, log, frac_tolerance, frac_increment, sncl):
+        super().__init__(log, frac_tolerance, frac_increment, sncl)
+        self._arrays = None  # (timespans, starts, ends) after join(), to avoid converting again
+        self._other = None
+
+    def add_epochs(self, start, end, samplerate=None):
+        self._arrays = None
+        super().add_epochs(start, end, samplerate)
+
+    def subtract(self, other):
+        # keep other so that _subtract_timespans() can use any arrays from other.join()
+        self._other = other
+        try:
+            return super().subtract(other)
+        finally:
+            self._other = None
+
+    def _arrays_for(self, timespans):
+        for coverage in (self, self._other):
+            cached = getattr(coverage, '_arrays', None)
+            if cached and cached[0] is timespans and len(timespans) == len(cached[1]):
+                return cached[1], cached[2]
+        return self._to_arrays(timespans)
+
+    @staticmethod
+    def _to_arrays(timespans):
+        # much faster than np.array() on a list of tuples
+        flat = np.fromiter(chain.from_iterable(timespans), dtype=np.float64, count=2 * len(timespans))
+        return flat[0::2], flat[1::2]
+
+    @staticmethod
+    def _from_arrays(starts, ends):
+        return list(zip(starts.tolist(), ends.tolist()))
+
+    def join(self):
+        if len(self.timespans) < self.THRESHOLD:
+            return super().join()
+        tolerance, increment = self.tolerances()
+        starts, ends = self._arrays_for(self.timespans)
+        # with sorted starts and ends the end of the current (joined) timespan is always
+        # the end of the previous timespan, so the decision to join is independent of
+        # earlier decisions.  otherwise (eg one timespan inside another) we must loop.
+        if np.any(starts[1:] < starts[:-1]) or np.any(ends[1:] < ends[:-1]):
+            return super().join()
+        self._log.debug('Joining overlapping timespans (arrays)')
+        if self.samplerate == 0:
+            # Channels with 0 sample rate must always be merged.
+            starts, ends = starts[:1], ends[-1:]
+        else:
+            # written as in Coverage.join() so that nan and rounding are identical
+            joined = np.abs(starts[1:] - ends[:-1]) < 1.0 / self.samplerate + tolerance
+            first = np.flatnonzero(np.concatenate(([True], ~joined)))
+            last = np.concatenate((first[1:] - 1, [len(starts) - 1]))
+            starts, ends = starts[first], ends[last]
+        self.timespans = self._from_arrays(starts, ends)
+        self._arrays = (self.timespans, starts, ends)
+
+    def _subtract_timespans(self, us, them, tolerance, increment):
+        # the timespans are divided into clusters that are separated by more than both
+        # tolerance and increment.  the sequential logic cannot carry anything from one
+        # cluster to the next, except whether any of them remain (which changes whether
+        # short timespans are kept), so clusters can be considered separately.  clusters
+        # with only us, or a single us matched by a single them, are handled with arrays;
+        # anything more complex uses the original code, one cluster at a time.
+        if len(us) + len(them) < self.THRESHOLD or not us or not them:
+            return super()._subtract_timespans(us, them, tolerance, increment)
+        (us_starts, us_ends), (them_starts, them_ends) = self._arrays_for(us), self._arrays_for(them)
+        n_us, n_them = len(us), len(them)
+        is_us = np.concatenate((np.ones(n_us, dtype=bool), np.zeros(n_them, dtype=bool)))
+        starts = np.concatenate((us_starts, them_starts))
+        order = np.argsort(starts, kind='stable')  # stable keeps us and them in their original order
+        starts, ends, is_us = starts[order], np.concatenate((us_ends, them_ends))[order], is_us[order]
+
+        margin = 2 * max(tolerance, increment)
+        reach = np.maximum.accumulate(ends)
+        new_cluster = np.concatenate(([True], starts[1:] - reach[:-1] > margin))
+        cluster = np.cumsum(new_cluster) - 1
+        first = np.flatnonzero(new_cluster)
+        n_clusters = len(first)
+        n_cluster_us = np.bincount(cluster, weights=is_us, minlength=n_clusters).astype(int)
+        n_cluster_them = np.bincount(cluster, minlength=n_clusters) - n_cluster_us
+        # when no more of them remain, short timespans are dropped
+        them_remain = np.arange(n_clusters) < cluster[~is_us].max()
+
+        # clusters with only us
+        only_us = is_us & (n_cluster_them[cluster] == 0)
+        keep = only_us & (them_remain[cluster] | (ends - starts >= tolerance))
+        ids, kept_starts, kept_ends = [cluster[keep]], [starts[keep]], [ends[keep]]
+
+        # clusters with a single us and them that start and end together are removed
+        pairs = first[(n_cluster_us == 1) & (n_cluster_them == 1)]
+        us_index = np.where(is_us[pairs], pairs, pairs + 1)
+        them_index = np.where(is_us[pairs], pairs + 1, pairs)
+        covered = np.zeros(n_clusters, dtype=bool)
+        covered[cluster[pairs]] = ((np.abs(starts[us_index] - starts[them_index]) < tolerance) &
+                                   (np.abs(ends[us_index] - ends[them_index]) < tolerance))
+
+        # everything else uses the original code, with the next of them (if any) after the
+        # cluster, so that the code knows whether any of them remain.
+        them_rank = np.cumsum(~is_us) - 1
+        last = np.concatenate((first[1:], [len(starts)]))
+        for k in np.flatnonzero((n_cluster_us > 0) & (n_cluster_them > 0) & ~covered).tolist():
+            lo, hi = first[k], last[k]
+            cluster_us = is_us[lo:hi]
+            cluster_starts, cluster_ends = starts[lo:hi], ends[lo:hi]
+            cluster_them = self._from_arrays(cluster_starts[~cluster_us], cluster_ends[~cluster_us])
+            after = them_rank[hi - 1] + 1
+            if after < n_them:
+                cluster_them.append(them[after])
+            difference = super()._subtract_timespans(
+                self._from_arrays(cluster_starts[cluster_us], cluster_ends[cluster_us]),
+                cluster_them, tolerance, increment)
+            if difference:
+                ids.append(np.full(len(difference), k))
+                difference_starts, difference_ends = self._to_arrays(difference)
+                kept_starts.append(difference_starts)
+                kept_ends.append(difference_ends)
+
+        ids = np.concatenate(ids)
+        order = np.argsort(ids, kind='stable')
+        return self._from_arrays(np.concatenate(kept_starts)[order], np.concatenate(kept_ends)[order])
+
+
+def new_coverage(log, frac_tolerance, frac_increment, sncl):
+    """
+    Create an empty coverage, using arrays when numpy is available.
+    """
+    if np is None:
+        return Coverage(log, frac_tolerance, frac_increment, sncl)
+    else:
+        return ArrayCoverage(log, frac_tolerance, frac_increment, sncl)
+
+
 # builders are needed to buffer the data read from the database and sort it,
 # this is because:
 # (1) the add_epochs() method requires sorted data to correctly merge timespans
@@ -224,7 +386,7 @@ class SingleSNCLBuilder(BaseBuilder):
             self._timespans.append((start, end, samplerate))
 
     def coverage(self):
-        coverage = Coverage(self._log, self._frac_tolerance, self._frac_increment, self._sncl)
+        coverage = new_coverage(self._log, self._frac_tolerance, self._frac_increment, self._sncl)
         for start, end, samplerate in sorted(self._timespans):
             coverage.add_epochs(start, end, samplerate)
         return coverage
@@ -252,7 +414,7 @@ class MultipleSNCLBuilder(BaseBuilder):
     def coverages(self):
         for sncl in sorted(self._timespans.keys()):
             ts = self._timespans[sncl]
-            coverage = Coverage(self._log, self._frac_tolerance, self._frac_increment, sncl)
+            coverage = new_coverage(self._log, self._frac_tolerance, self._frac_increment, sncl)
             for start, end, samplerate in sorted(ts):
                 coverage.add_epochs(start, end, samplerate)
             if self._join:
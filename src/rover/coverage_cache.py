@@ -0,0 +1,159 @@
+from array import array
+from uuid import uuid4
+
+from .args import TIMESPANTOL, TIMESPANINC
+from .coverage import new_coverage
+from .sqlite import SqliteSupport
+
+"""
+A persistent cache of (joined) local coverage, per N_S_L_C.
+"""
+
+
+def _invalidate(row):
+    return '''DELETE FROM rover_coverage_cache
+               WHERE network = %s.network AND station = %s.station
+                 AND location = %s.location AND channel = %s.channel;''' % (row, row, row, row)
+
+
+# an update could move a row to a new N_S_L_C, so clear both old and new
+TRIGGERS = {
+    'rover_coverage_cache_insert': 'AFTER INSERT ON tsindex BEGIN %s END' % _invalidate('NEW'),
+    'rover_coverage_cache_update': 'AFTER UPDATE ON tsindex BEGIN %s %s END' % (_invalidate('OLD'), _invalidate('NEW')),
+    'rover_coverage_cache_delete': 'AFTER DELETE ON tsindex BEGIN %s END' % _invalidate('OLD')
+}
+
+
+class CoverageCache(SqliteSupport):
+    """
+    Local coverage for each N_S_L_C, as read from tsindex (parsed, sorted and joined),
+    stored in the rover_coverage_cache table.
+
+    Entries are invalidated by triggers on tsindex, so any change to the index (by
+    rover or by mseedindex directly) deletes the entries for the N_S_L_Cs affected.
+    So that a coverage read while the index was changing is not saved, reserve() adds
+    an empty entry (a placeholder) for each N_S_L_C before the index is read, and save()
+    only fills placeholders that the triggers have not deleted since.  Placeholders carry
+    a token for the reader that reserved them, so a reader cannot fill a placeholder that
+    was deleted and then reserved again by another reader (after the change).  So a change
+    affects only its own N_S_L_Cs, and costs one delete (by primary key) per row.
+    If the triggers are missing or different (eg tsindex was re-created, or an older
+    version of rover) the cache is cleared and they are added again.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._timespan_tol = config.arg(TIMESPANTOL)
+        self._timespan_inc = config.arg(TIMESPANINC)
+
+    def prepare(self):
+        """
+        Create the tables and triggers, if necessary.  Returns False if there's
+        no index (so the cache cannot be used).
+        """
+        if not self.fetchsingle('''SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'tsindex' '''):
+            return False
+        with self._db:  # single transaction
+            self._db.cursor().execute('BEGIN')
+            triggers = dict(self._db.execute('''SELECT name, sql FROM sqlite_master
+                                                 WHERE type = 'trigger' AND name IN (?, ?, ?)''',
+                                              tuple(TRIGGERS.keys())).fetchall())
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(rover_coverage_cache)').fetchall()]
+            state = None
+            if triggers == dict((name, 'CREATE TRIGGER %s %s' % (name, trigger)) for name, trigger in TRIGGERS.items()) \
+                    and 'reader' in columns:
+                state = self._db.execute('SELECT timespan_tol, timespan_inc FROM rover_coverage_cache_state').fetchone()
+            # joins depend on the tolerances, so must be discarded if they change
+            if state != (self._timespan_tol, self._timespan_inc):
+                self._log.debug('Clearing coverage cache')
+                for name in TRIGGERS:
+                    self._db.execute('DROP TRIGGER IF EXISTS %s' % name)
+                self._db.execute('DROP TABLE IF EXISTS rover_coverage_cache')
+                self._db.execute('DROP TABLE IF EXISTS rover_coverage_cache_state')
+                # samplerate and timespans are null for a placeholder, which has the reader's token (see reserve())
+                self._db.execute('''CREATE TABLE rover_coverage_cache (
+                                      network text not null,
+                                      station text not null,
+                                      location text not null,
+                                      channel text not null,
+                                      samplerate real,
+                                      timespans blob,
+                                      reader text,
+                                      primary key (network, station, location, channel)
+                                    )''')
+                self._db.execute('''CREATE TABLE rover_coverage_cache_state (
+                                      timespan_tol real not null,
+                                      timespan_inc real not null
+                                    )''')
+                self._db.execute('''INSERT INTO rover_coverage_cache_state (timespan_tol, timespan_inc)
+                                    VALUES (?, ?)''', (self._timespan_tol, self._timespan_inc))
+                for name, trigger in TRIGGERS.items():
+                    self._db.execute('CREATE TRIGGER %s %s' % (name, trigger))
+        return True
+
+    def reserve(self, conditions, params):
+        """
+        Add placeholders for the uncached N_S_L_Cs in tsindex selected by the conditions,
+        before reading them from the index (see save()).  Existing placeholders (from
+        readers that did not save) are taken over.  Returns the token for save().
+        """
+        token = uuid4().hex
+        with self._db:  # single transaction
+            self._db.cursor().execute('BEGIN')
+            self._db.execute('''UPDATE rover_coverage_cache SET reader = ? WHERE %s''' %
+                             ' AND '.join(['timespans IS NULL'] + conditions), (token,) + tuple(params))
+            where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+            self._db.execute('''INSERT OR IGNORE INTO rover_coverage_cache (network, station, location, channel, reader)
+                                SELECT DISTINCT network, station, location, channel, ? FROM tsindex %s''' % where,
+                             (token,) + tuple(params))
+        return token
+
+    def stream(self, conditions, params):
+        """
+        Cached coverages, ordered by N_S_L_C, for the N_S_L_Cs selected by the conditions.
+        """
+        sql = '''SELECT network, station, location, channel, samplerate, timespans
+                   FROM rover_coverage_cache WHERE %s
+                  ORDER BY network, station, location, channel''' % ' AND '.join(['timespans IS NOT NULL'] + conditions)
+        self._log.debug('Stream coverage cache: %s %s' % (sql, params))
+        cursor = self._db.cursor()
+        try:
+            for row in cursor.execute(sql, params):
+                yield row
+        finally:
+            cursor.close()
+
+    def coverage(self, row):
+        """
+        The coverage for a row returned by stream().
+        """
+        coverage = new_coverage(self._log, self._timespan_tol, self._timespan_inc, '_'.join(row[0:4]))
+        coverage.samplerate = row[4]
+        flat = array('d')
+        flat.frombytes(row[5])
+        coverage.timespans = list(zip(flat[0::2], flat[1::2]))
+        return coverage
+
+    def save(self, coverages, token):
+        """
+        Save (joined) coverages, except those whose placeholders (with the token from reserve())
+        have been deleted (because the index changed for that N_S_L_C since reserve()) or taken
+        over by another reader.
+        """
+        n_skipped = 0
+        with self._db:  # single transaction
+            self._db.cursor().execute('BEGIN')
+            for coverage in coverages:
+                flat = array('d')
+                for start, end in coverage.timespans:
+                    flat.append(start)
+                    flat.append(end)
+                cursor = self._db.execute('''UPDATE rover_coverage_cache SET samplerate = ?, timespans = ?, reader = NULL
+                                              WHERE network = ? AND station = ? AND location = ? AND channel = ?
+                                                AND timespans IS NULL AND reader = ?''',
+                                          (coverage.samplerate, flat.tobytes()) + tuple(coverage.sncl.split('_')) +
+                                          (token,))
+                if not cursor.rowcount:
+                    n_skipped += 1
+        if n_skipped:
+            self._log.debug('Index changed, so not caching %d of %d coverages' % (n_skipped, len(coverages)))
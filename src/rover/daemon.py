@@ -43,7 +43,13 @@ See also `rover stop`, `rover status` and `rover daemon`.
 
 @rover-cmd
 @mseedindex-cmd
+@index-engine
 @download-workers
+@availability-workers
+@download-engine
+@chunk-size
+@pipeline
+@checkpoint-period
 @mseedindex-workers
 @temp-dir
 @subscriptions-dir
@@ -51,6 +57,7 @@ See also `rover stop`, `rover status` and `rover daemon`.
 @download-retries
 @http-timeout
 @http-retries
+@http-block-size
 @web
 @http-bind-address
 @http-port
@@ -183,7 +190,13 @@ See also `rover stop`, `rover status`.
 
 @rover-cmd
 @mseedindex-cmd
+@index-engine
 @download-workers
+@availability-workers
+@download-engine
+@chunk-size
+@pipeline
+@checkpoint-period
 @mseedindex-workers
 @temp-dir
 @subscriptions-dir
@@ -191,6 +204,7 @@ See also `rover stop`, `rover status`.
 @download-retries
 @http-timeout
 @http-retries
+@http-block-size
 @web
 @http-bind-address
 @http-port
@@ -241,7 +255,8 @@ REMINDER: ROVER start is the preferred method to launch the subscription service
                     if self._download_manager.is_idle():
                         sleep(60)
                 self._download_manager.step()
-                sleep(1)
+                # wake early when a download finishes, so that new downloads start immediately
+                self._download_manager.wait(1)
             except Exception as e:
                 self._reporter.send_email('ROVER Failure', self._reporter.describe_error(DAEMON, e))
                 raise
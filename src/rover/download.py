@@ -1,15 +1,16 @@
 import os
 import json
 import sys
+from time import time
 
 from .args import DOWNLOAD, TEMPDIR, DELETEFILES, INGEST, \
     TEMPEXPIRE, HTTPTIMEOUT, \
-    HTTPRETRIES, DATASELECTURL
+    HTTPRETRIES, DATASELECTURL, HTTPBLOCKSIZE, http_pool_size
 from .ingest import Ingester
 from .sqlite import SqliteSupport
-from .utils import uniqueish, get_to_file, unique_filename, \
+from .utils import get_to_file, \
     clean_old_files, match_prefixes, create_parents, unique_path, \
-    safe_unlink, post_to_file, diagnose_error
+    safe_unlink, post_to_file, diagnose_error, calc_bytes
 
 """
 The 'rover download' command - download data from a URL (and then call ingest).
@@ -46,6 +47,7 @@ deleted from the temp directory. `rover download` is called by
 @temp-dir
 @http-timeout
 @http-retries
+@http-block-size
 @delete-files
 @ingest
 @index
@@ -87,10 +89,11 @@ will download, ingest and index data from `dataselect-url` after POSTing
         self._temp_dir = config.dir(TEMPDIR)
         self._dataselect_url = config.arg(DATASELECTURL)
         self._delete_files = config.arg(DELETEFILES)
-        self._blocksize = 1024 * 1024
+        self._blocksize = calc_bytes(config.arg(HTTPBLOCKSIZE))
         self._ingest = config.arg(INGEST)
         self._http_timeout = config.arg(HTTPTIMEOUT)
         self._http_retries = config.arg(HTTPRETRIES)
+        self._http_pool_size = http_pool_size(config)
         self._config = config
         clean_old_files(self._temp_dir, config.arg(TEMPEXPIRE), match_prefixes(TMPDOWNLOAD), self._log)
 
@@ -101,7 +104,6 @@ will download, ingest and index data from `dataselect-url` after POSTing
         if len(args) < 1 or len(args) > 2:
             raise Exception('Usage: rover %s url [path]' % DOWNLOAD)
         in_path_or_url = args[0]
-        db_path = self._ingesters_db_path(in_path_or_url)
         if '://' in in_path_or_url:
             url, in_path, get = in_path_or_url, None, True
             if '&' not in url:
@@ -116,23 +118,48 @@ will download, ingest and index data from `dataselect-url` after POSTing
         else:
             out_path, delete_out = unique_path(self._temp_dir, TMPDOWNLOAD, in_path_or_url), True
 
+        self._download_and_ingest(get, url, in_path, out_path, delete_out)
+        if self._delete_files:
+            # Remove empty log files to avoid clutter
+            log_path = self._config.log_path
+            if os.path.exists(log_path) and os.path.getsize(log_path) == 0:
+                safe_unlink(log_path)
+
+    def download(self, in_path, feedback):
+        """
+        Download the given request file from the dataselect service, then call
+        ingest and index before deleting.  Called for worker threads (see DownloadTask),
+        so feedback is returned in the given dictionary rather than on stdout.
+        """
+        out_path = unique_path(self._temp_dir, TMPDOWNLOAD, in_path)
+        self._download_and_ingest(False, self._dataselect_url, in_path, out_path, True, feedback=feedback)
+
+    def _download_and_ingest(self, get, url, in_path, out_path, delete_out, feedback=None):
+        # the ingester indexes the data in memory (or from mseedindex JSON), so no temporary database is needed.
+        # on success, the byte count and timings are returned to the caller (for the download
+        # manager's metrics) - either as JSON on stdout (worker process, where stdout is redirected
+        # to a file rather than a terminal) or in the dictionary provided (worker thread)
+        stats = {}
         try:
-            if self._do_download(get, url, in_path, out_path):  # False when no data available
-                if self._ingest:
-                    Ingester(self._config).run([out_path], db_path=db_path)
-        except:
-            raise
-        else:
-            if self._delete_files:
-                # Remove empty log files to avoid clutter
-                log_path = self._config.log_path
-                if os.path.exists(log_path) and os.path.getsize(log_path) == 0:
-                    safe_unlink(log_path)
+            start = time()
+            response = self._do_download(get, url, in_path, out_path)
+            stats['download_seconds'] = time() - start
+            if response and os.path.isfile(response):
+                stats['download_byte_count'] = os.path.getsize(response)
+            if response and self._ingest:  # response is False when no data available
+                start = time()
+                ingester = Ingester(self._config)
+                ingester.run([out_path])
+                stats['ingest_seconds'] = time() - start
+                stats['index_seconds'] = ingester.index_seconds
+                stats['lock_wait'] = ingester.lock_wait
         finally:
-            if self._delete_files:
-                if delete_out:
-                    safe_unlink(out_path)
-                safe_unlink(db_path)
+            if self._delete_files and delete_out:
+                safe_unlink(out_path)
+        if feedback is not None:
+            feedback.update(stats)
+        elif not sys.stdout.isatty():
+            sys.stdout.write(json.dumps(stats))
 
     def _do_download(self, get, url, in_path, out_path):
         # previously we extracted the file name from the header, but the code
@@ -143,27 +170,38 @@ will download, ingest and index data from `dataselect-url` after POSTing
 
         if get:
             response, check_status = get_to_file(url, out_path,
-                                                 self._http_timeout, self._http_retries, self._log)
+                                                 self._http_timeout, self._http_retries, self._log,
+                                                 blocksize=self._blocksize, pool_size=self._http_pool_size)
             check_status()
         else:
             try:
                 response, check_status = post_to_file(url, in_path, out_path,
-                                                      self._http_timeout, self._http_retries, self._log)
+                                                      self._http_timeout, self._http_retries, self._log,
+                                                      blocksize=self._blocksize, pool_size=self._http_pool_size)
                 check_status()
             except Exception as e:
                 diagnose_error(self._log, str(e), in_path, out_path, copied=False)
                 raise
 
-        # write feedback, in JSON, to caller on stdout with download byte count
-        if response and os.path.isfile(response):
-            feedback = {}
-            feedback['download_byte_count'] = os.path.getsize(response)
+        return response
 
-            if feedback['download_byte_count']:
-                sys.stdout.write(json.dumps(feedback))
 
-        return response
+class DownloadTask:
+    """
+    A single download, run in a worker thread by the download manager when
+    the "inprocess" download engine is configured (see ThreadWorkers).
+
+    This is the in-process equivalent of `rover download file`.
+    """
+
+    def __init__(self, path, fail=False):
+        self._path = path
+        self._fail = fail
+
+    def __call__(self, config, feedback):
+        if self._fail:
+            raise Exception('Failure for tests')
+        Downloader(config).download(self._path, feedback)
 
-    def _ingesters_db_path(self, url):
-        name = uniqueish('rover_ingester', url)
-        return unique_filename(os.path.join(self._temp_dir, name))
+    def __str__(self):
+        return '%s "%s"' % (DOWNLOAD, self._path)
@@ -1,16 +1,21 @@
 
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from os.path import getmtime
 from re import match, sub
 from sqlite3 import OperationalError
 
 from .config import timeseries_db
 from .args import MSEEDINDEXCMD, DEV, VERBOSITY, MSEEDINDEXWORKERS, HTTPTIMEOUT, HTTPRETRIES, FORCECMD, TIMESPANINC
-from .args import TIMESPANTOL
+from .args import TIMESPANTOL, INDEXENGINE, NATIVE
 from .coverage import MultipleSNCLBuilder
 from .help import HelpFormatter
-from .scan import ModifiedScanner, DirectoryScanner
-from .sqlite import SqliteSupport
-from .utils import format_epoch, windows, tidy_timestamp
+from .mseed import MSeedError, scan_file, group_sections, section_hash
+from .scan import ModifiedScanner, DirectoryScanner, forget_changes
+from .sqlite import SqliteSupport, begin_write
+from .utils import format_epoch, format_time_epoch, windows, tidy_timestamp
 from .utils import check_cmd, STATION, NETWORK, CHANNEL, LOCATION
 from .workers import Workers
 
@@ -23,6 +28,141 @@ The 'rover list-index' command - displays entries from the tsindex table.
 """
 
 
+# the table created by mseedindex (which rows written directly by rover must match)
+TSINDEX = ['''CREATE TABLE IF NOT EXISTS tsindex (network TEXT,station TEXT,location TEXT,channel TEXT,
+                quality TEXT,version INTEGER,starttime TEXT,endtime TEXT,samplerate REAL,filename TEXT,
+                byteoffset INTEGER,bytes INTEGER,hash TEXT,timeindex TEXT,timespans TEXT,timerates TEXT,
+                format TEXT,filemodtime TEXT,updated TEXT,scanned TEXT)''',
+           '''CREATE INDEX IF NOT EXISTS tsindex_nslcse_idx
+                ON tsindex (network,station,location,channel,starttime,endtime)''',
+           '''CREATE INDEX IF NOT EXISTS tsindex_filename_idx ON tsindex (filename)''',
+           '''CREATE INDEX IF NOT EXISTS tsindex_updated_idx ON tsindex (updated)''']
+INSERT_TSINDEX = 'INSERT INTO tsindex VALUES (%s)' % ','.join('?' * 20)
+
+# indexes for the queries that rover makes (in addition to those created by mseedindex):
+#   - coverage for a N_S_L_C, or all coverage in N_S_L_C order (see Source in manager.py),
+#     already sorted.  timespans are not included, so the rows are read from the table,
+#     because copying the largest column made the database ~40% larger for ~20% faster queries.
+#   - the latest modification time for each file (see DatabasePathIterator in scan.py),
+#     from the index alone (a covering index).
+ROVER_INDEXES = {'rover_tsindex_nslc_idx':
+                     'tsindex (network,station,location,channel,starttime,endtime,samplerate)',
+                 'rover_tsindex_filename_idx': 'tsindex (filename,filemodtime)'}
+
+# a batch of rows is written when it reaches either limit
+BATCH_FILES = 100
+BATCH_ROWS = 10000
+
+def create_tsindex(db):
+    """
+    Create the tsindex table (if missing), exactly as mseedindex does, along with
+    rover's own indexes.
+    """
+    for sql in TSINDEX:
+        db.execute(sql)
+    for name, target in ROVER_INDEXES.items():
+        db.execute('CREATE INDEX IF NOT EXISTS %s ON %s' % (name, target))
+
+
+def create_rover_indexes(db, log):
+    """
+    Add rover's indexes to an existing tsindex table (eg one created by mseedindex),
+    replacing any with a different definition (eg from an earlier version).
+    """
+    existing = dict(db.execute('''SELECT name, sql FROM sqlite_master
+                                   WHERE type = 'index' AND tbl_name = 'tsindex' ''').fetchall())
+    if existing:  # otherwise, no table
+        for name, target in ROVER_INDEXES.items():
+            sql = 'CREATE INDEX %s ON %s' % (name, target)
+            if existing.get(name) != sql:
+                log.info('Creating index %s (may take some time)' % name)
+                with db:
+                    db.execute('DROP INDEX IF EXISTS %s' % name)
+                    db.execute(sql)
+
+
+def tsindex_row(filename, section, hash, filemodtime, now=None):
+    """
+    The values for a tsindex row (in table order) describing a section (see mseed.py)
+    of the given file, as mseedindex would write them (although the time index entries
+    are chosen a little differently).
+    """
+    now = now or datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    return (section.network, section.station, section.location, section.channel,
+            None, section.version,
+            format_epoch(section.start), format_epoch(section.end), section.samplerate,
+            filename, section.offset, section.length, hash,
+            ','.join('%.6f=>%d' % entry for entry in section.timeindex) + ',latest=>1',
+            ','.join('[%.6f:%.6f]' % span for span in section.timespans),
+            None, None, format_time_epoch(filemodtime), now, now)
+
+
+def index_file(path):
+    """
+    The tsindex rows for a file, from the records (raises MSeedError if the file cannot
+    be parsed).  Does not access the database, so can be called from any thread.
+    """
+    filemodtime = getmtime(path)  # before reading, so later changes are seen
+    with open(path, 'rb') as input:
+        return [tsindex_row(path, section, section_hash(input, section), filemodtime)
+                for section in group_sections(scan_file(path))]
+
+
+class TsindexWriter(SqliteSupport):
+    """
+    Replace the tsindex rows for whole files, in batches.  Each batch is written in a
+    single transaction so that the write lock is taken once per batch (and by a single
+    writer) rather than once per file.  The time spent waiting for the lock is logged.
+    """
+
+    def __init__(self, config, batch_files=BATCH_FILES, batch_rows=BATCH_ROWS):
+        super().__init__(config)
+        self._batch_files = batch_files
+        self._batch_rows = batch_rows
+        self._pending = []  # (path, rows)
+        self._n_pending_rows = 0
+        self.n_files, self.n_rows, self.n_batches = 0, 0, 0
+        self.lock_wait = 0.0
+
+    def add(self, path, rows):
+        """
+        Queue the rows for a file (replacing any existing rows), writing the batch if full.
+        """
+        self._pending.append((path, rows))
+        self._n_pending_rows += len(rows)
+        if len(self._pending) >= self._batch_files or self._n_pending_rows >= self._batch_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Write any queued rows.
+        """
+        if not self._pending:
+            return
+        with self._db:  # single transaction
+            waited = begin_write(self._db)
+            create_tsindex(self._db)
+            for path, rows in self._pending:
+                self._db.execute('DELETE FROM tsindex WHERE filename = ?', (path,))
+                self._db.executemany(INSERT_TSINDEX, rows)
+        self._log.debug('Wrote %d tsindex rows for %d files (waited %.3fs for the write lock)' %
+                        (self._n_pending_rows, len(self._pending), waited))
+        self.n_files += len(self._pending)
+        self.n_rows += self._n_pending_rows
+        self.n_batches += 1
+        self.lock_wait += waited
+        self._pending, self._n_pending_rows = [], 0
+
+    def close(self):
+        """
+        Write any queued rows and report the totals.
+        """
+        self.flush()
+        if self.n_batches:
+            self._log.info('Wrote %d tsindex rows for %d files in %d batches (waited %.2fs for the write lock)' %
+                           (self.n_rows, self.n_files, self.n_batches, self.lock_wait))
+
+
 class Indexer(ModifiedScanner, DirectoryScanner):
     """
 ### Index
@@ -35,9 +175,12 @@ Indexes files, adds or changes entries in the tsindex table stored in the
 miniSEED database.
 
 When no argument is given, all modified files in the repository are processed.
-The `--all` flag forces all files to be processed. If a path argument
-is provided, all files contained in the directory are processed, along with
-the contents of sub-directories, unless `--no-recurse` is specified.
+Files changed by ingest are recorded in a journal, so only those (and the
+contents of directories that have changed since the last index) are checked
+after the first, complete scan of the repository.  The `--all` flag forces
+all files to be scanned and processed. If a path argument is provided, all
+files contained in the directory are processed, along with the contents of
+sub-directories, unless `--no-recurse` is specified.
 
 ##### Significant Options
 
@@ -45,6 +188,7 @@ the contents of sub-directories, unless `--no-recurse` is specified.
 @data-dir
 @mseedindex-cmd
 @mseedindex-workers
+@index-engine
 @verbosity
 @log-dir
 @log-verbosity
@@ -58,7 +202,10 @@ will index the entire repository.
 """
 
 # Most of the work is done in the scanner superclasses which find the files
-# to modify, and in the worker that runs mseedindex.
+# to modify, and in the worker that runs mseedindex.  With the native engine
+# files are parsed (see mseed.py) in a pool of threads and the rows are written
+# in batches by a single writer (TsindexWriter).  mseedindex is only used for
+# files that cannot be parsed.
 
     def __init__(self, config):
         ModifiedScanner.__init__(self, config)
@@ -67,6 +214,13 @@ will index the entire repository.
         self._timeseries_db = timeseries_db(config)
         self._verbose = config.arg(DEV) and config.arg(VERBOSITY) == 5
         self._workers = Workers(config, config.arg(MSEEDINDEXWORKERS))
+        self._native = config.arg(INDEXENGINE) == NATIVE
+        self._n_parsers = config.arg(MSEEDINDEXWORKERS)
+        self._parsers = None
+        self._parsing = deque()  # (path, future), in the order submitted
+        self._writer = None
+        self._processed = None  # explicit paths, to remove from the change journal
+        self.lock_wait = 0.0  # time the writer spent waiting for the database write lock
 
     def run(self, args):
         """
@@ -76,19 +230,59 @@ will index the entire repository.
             self._log.info('Indexing all changed files')
             self.scan_data_dir()
         else:
+            last, self._processed = self.last_change(), []
             self.scan_dirs_and_files(args)
+            if last:
+                with self._db:
+                    forget_changes(self._db, last, self._processed)
 
     def process(self, path):
         """
-        Run mseedindex asynchronously in a worker.
+        Parse the file directly or run mseedindex asynchronously in a worker.
         """
         self._log.info('Indexing %s' % path)
+        if self._processed is not None:
+            self._processed.append(path)
+        if self._native:
+            if not self._parsers:
+                self._parsers = ThreadPoolExecutor(max_workers=self._n_parsers, thread_name_prefix='index')
+                self._writer = TsindexWriter(self._config)
+            self._parsing.append((path, self._parsers.submit(index_file, path)))
+            # limit the rows held in memory
+            while len(self._parsing) > 2 * self._n_parsers:
+                self._write_parsed()
+        else:
+            self._run_mseedindex(path)
+
+    def _run_mseedindex(self, path):
         self._workers.execute('%s %s -sqlite %s %s'
                               % (self._mseed_cmd, '-v -v' if self._verbose else '',
                                  self._timeseries_db, path))
 
+    def _write_parsed(self):
+        path, future = self._parsing.popleft()
+        try:
+            self._writer.add(path, future.result())
+        except MSeedError as e:
+            self._log.warn('Cannot parse %s (%s) - using mseedindex' % (path, e))
+            self._run_mseedindex(path)
+
     def done(self):
+        if self._parsers:
+            try:
+                while self._parsing:
+                    self._write_parsed()
+                self._writer.close()
+                self.lock_wait += self._writer.lock_wait
+            finally:
+                # cancel anything not yet started (on error) by hand - cancel_futures needs python 3.9
+                for _, future in self._parsing:
+                    future.cancel()
+                self._parsing.clear()
+                self._parsers.shutdown()
+                self._parsers, self._writer = None, None
         self._workers.wait_for_all()
+        create_rover_indexes(self._db, self._log)
 
 
 START = 'start'
@@ -316,8 +510,9 @@ printed to stdout.
                     repeated = True
                 else:
                     sql += 'or '
-                sql += '%s like ? ' % name
-                params.append(self._wildchars(value))
+                predicate, values = self._predicate(name, value)
+                sql += predicate
+                params.extend(values)
             if repeated:
                 sql += ') '
         if self._single_constraints[START]:
@@ -334,6 +529,24 @@ printed to stdout.
     def _wildchars(value):
         return sub(r'\?', '_', sub(r'\*', '%', value))
 
+    def _predicate(self, name, value):
+        """
+        SQL (and parameters) to match the value, which may contain wildcards.  Where
+        possible we avoid 'like' (equality, or a range for a prefix) so that the
+        indexes are used.  Both give the same results as 'like', which is case-sensitive
+        (see init_db()), except that 'like' treats '_' as a wildcard, so values that
+        contain '_' (and samplerates, which are compared as text) still use it.
+        """
+        if name == SAMPLERATE or '_' in value:
+            return '%s like ? ' % name, [self._wildchars(value)]
+        if '*' not in value and '?' not in value:
+            return '%s = ? ' % name, [value]
+        prefix = value.rstrip('*')
+        if prefix and '*' not in prefix and '?' not in prefix:
+            # the range of strings that start with prefix (value ends with '*')
+            return '(%s >= ? and %s < ?) ' % (name, name), [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+        return '%s like ? ' % name, [self._wildchars(value)]
+
     def _count(self, sql, params, stdout):
         # force to int here to avoid issues with strings on python 2
         print(int(self.fetchsingle(sql, params)), file=stdout)
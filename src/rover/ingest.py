@@ -1,26 +1,24 @@
 from datetime import datetime
-from os import getpid
-from os.path import exists, join
+from json import loads
+from os import getpid, fsync, truncate
+from os.path import exists, join, getsize, getmtime
 from re import match
-from shutil import copyfile
+from subprocess import check_output, CalledProcessError
+from time import time
 
-from .args import MSEEDINDEXCMD, DATADIR, INDEX, HTTPTIMEOUT, HTTPRETRIES, OUTPUT_FORMAT
-from .index import Indexer
+from .args import MSEEDINDEXCMD, DATADIR, INDEX, HTTPTIMEOUT, HTTPRETRIES, OUTPUT_FORMAT, INDEXENGINE, NATIVE
+from .index import Indexer, create_tsindex, tsindex_row, INSERT_TSINDEX
 from .lock import DatabaseBasedLockFactory, MSEED
-from .scan import DirectoryScanner
-from .sqlite import SqliteSupport, SqliteContext
-from .utils import run, check_cmd, create_parents, safe_unlink, windows, atomic_move, hash
+from .mseed import MSeedError, scan_file, group_sections, section_hash
+from .scan import DirectoryScanner, record_change, forget_changes
+from .sqlite import SqliteSupport, begin_write
+from .utils import check_cmd, create_parents, safe_unlink, windows, hash, process_exists, format_epoch
 
 """
 The 'rover ingest' command - copy downloaded data into the repository (and then call index).
 """
 
 
-# this is the table name when run directly from the command line.
-# when run as a worker from (multiple) retriever(s) a table is supplied.
-TMPFILE = 'rover_tmp_ingest'
-
-
 class Ingester(SqliteSupport, DirectoryScanner):
     """
 ### Ingest
@@ -33,6 +31,7 @@ indexes the new data.
 ##### Significant Options
 
 @mseedindex-cmd
+@index-engine
 @data-dir
 @index
 @verbosity
@@ -51,86 +50,146 @@ will add all the data in the given file to the repository.
 """
 
 # The simplest possible ingester:
-# * Uses mseedindex to parse the file.
-# * For each section, appends to any existing file using byte offsets
+# * Runs mseedindex on the file (or, with the opt-in native index engine, parses
+#   the record headers, using mseedindex if that fails).
+# * For each destination file, appends all the relevant sections using byte offsets
 # * Refuses to handle blocks that cross day boundaries
 # * Does not check for overlap, differences in sample rate, etc.
+#
+# Appends are made in place.  To survive a crash mid-append, the original size of
+# the destination is recorded in the rover_ingest_journal table before appending
+# and removed once the data are synced to disk.  Any entry left in the journal is
+# rolled back (the file truncated to the original size) by the next ingester.
+#
+# When the records were parsed here, the tsindex rows for the appended data are
+# written directly (in the same transaction that removes the journal entry), so
+# there is no need to run mseedindex over the whole destination file again.
+#
+# Each destination is also added to the change journal (see scan.py), and removed
+# once indexed, so that pre-index need not scan the whole repository for changes.
 
     def __init__(self, config):
         SqliteSupport.__init__(self, config)
         DirectoryScanner.__init__(self, config)
         self._mseed_cmd = check_cmd(config, MSEEDINDEXCMD, 'mseedindex')
-        self._db_path = None
         self._data_dir = config.dir(DATADIR)
         self._index = config.arg(INDEX)
+        self._native = config.arg(INDEXENGINE) == NATIVE
         self._config = config
         self._log = config.log
         self._lock_factory = DatabaseBasedLockFactory(config, MSEED)
+        self.index_seconds = 0.0  # time spent indexing (for metrics)
+        self.lock_wait = 0.0  # time spent waiting for the database write lock
+        self._create_journal_table()
+        self._recover_all()
+
+    def _create_journal_table(self):
+        self.execute('''CREATE TABLE IF NOT EXISTS rover_ingest_journal (
+                           filename text primary key,
+                           size integer not null,
+                           pid integer not null,
+                           creation_epoch int default (cast(strftime('%s', 'now') as int))
+        )''')
 
-    def run(self, args, db_path=TMPFILE):
+    def run(self, args):
         """
         We only support explicit paths - modified file scanning makes no sense because
         the files are external, downloaded data.
-
-        To avoid database contention we can run mseedindex into a unique database path.
         """
-        self._db_path = db_path
         if not args:
             raise Exception('No paths provided')
         self.scan_dirs_and_files(args)
 
     def process(self, temp_file):
         """
-        Run mseedindex and, move across the bytes, and then call follow-up tasks.
+        Parse the records (or run mseedindex), move across the bytes, and then call follow-up tasks.
         """
         self._log.info('Indexing %s for ingest' % temp_file)
-        if exists(self._db_path):
-            self._log.warn('Temp file %s exists (deleting)' % self._db_path)
-            safe_unlink(self._db_path)
-        updated = set()
-        try:
-            run('%s -sqlite %s %s'
-                % (self._mseed_cmd, self._db_path, temp_file), self._log)
-
-            with SqliteContext(self._db_path, self._log) as db:
-                rows = db.fetchall('''SELECT network, station, starttime, endtime, byteoffset, bytes
-                                  FROM tsindex ORDER BY byteoffset''')
-                updated.update(self._copy_all_rows(temp_file, rows))
-        finally:
-            safe_unlink(self._db_path)
+        rows = None
+        if self._native:
+            try:
+                rows = self._scan_rows(temp_file)
+            except MSeedError as e:
+                self._log.warn('Cannot parse %s (%s) - using mseedindex' % (temp_file, e))
+        if rows is None:
+            rows = self._mseedindex_rows(temp_file)
+        updated, indexed = self._copy_all_rows(temp_file, rows)
         if self._index:
-            Indexer(self._config).run(updated)
+            if updated - indexed:
+                # files whose new data were not indexed directly
+                start, indexer = time(), Indexer(self._config)
+                indexer.run(updated - indexed)
+                self.index_seconds += time() - start
+                self.lock_wait += indexer.lock_wait
             if self._config.arg(OUTPUT_FORMAT).upper() == "ASDF":
                 from .asdf import ASDFHandler
                 # output as ASDF format
                 ASDFHandler(self._config).load_miniseed(updated)
 
+    def _scan_rows(self, temp_file):
+        """
+        The sections in the file (ordered by byte offset), with their records.
+        """
+        records = scan_file(temp_file)
+        rows, first = [], 0
+        for section in group_sections(records):
+            last = first
+            while last < len(records) and records[last].offset < section.offset + section.length:
+                last += 1
+            rows.append((section.network, section.station, format_epoch(section.start), format_epoch(section.end),
+                         section.offset, section.length, records[first:last]))
+            first = last
+        return rows
+
+    def _mseedindex_rows(self, temp_file):
+        """
+        The sections in the file (ordered by byte offset), from mseedindex (no records).
+        mseedindex writes JSON to stdout, so no temporary database is needed.
+        """
+        cmd = '%s -json - %s' % (self._mseed_cmd, temp_file)
+        self._log.debug('Running "%s"' % cmd)
+        try:
+            output = check_output(cmd, shell=True)
+        except CalledProcessError:
+            raise Exception('Command "%s" failed' % cmd)
+        rows = []
+        for indexed in (loads(output) if output.strip() else {}).values():
+            for section in indexed['content']:
+                # source ids are FDSN:NET_STA_LOC_B_S_S
+                network, station = section['source_id'].split(':', 1)[1].split('_')[0:2]
+                rows.append((network, station, section['start_string'].rstrip('Z'), section['end_string'].rstrip('Z'),
+                             section['byte_offset'], section['byte_count'], None))
+        return sorted(rows, key=lambda row: row[4])
+
     def _copy_all_rows(self, temp_file, rows):
         self._log.info('Ingesting %s' % temp_file)
-        updated = set()
         self.updated_files_last_run = []
+        # group the sections by destination so that each file is locked and written once
+        destinations = {}
+        offset = 0
+        for row in rows:
+            offset, dest, section = self._check_single_row(offset, temp_file, *row)
+            if dest not in destinations:
+                destinations[dest] = []
+            destinations[dest].append(section)
+        indexed = set()
         with open(temp_file, 'rb') as input_file:
-            offset = 0
-            for row in rows:
-                offset, dest = self._copy_single_row(offset, input_file,
-                                                     temp_file, *row)
-                updated.add(dest)
-        return updated
-
-    def _copy_single_row(self, offset, input_buffer, temp_file, network, station, starttime, endtime, byteoffset, raw_bytes):
+            for dest, sections in destinations.items():
+                if self._append_data(input_file, temp_file, sections, dest):
+                    indexed.add(dest)
+        return set(destinations.keys()), indexed
+
+    def _check_single_row(self, offset, temp_file, network, station, starttime, endtime, byteoffset, raw_bytes,
+                          records=None):
         self._assert_single_day(temp_file, starttime, endtime, "%s_%s" % (network, station))
         if offset < byteoffset:
             self._log.warn('Non-contiguous bytes in %s - skipping %d bytes' % (temp_file, byteoffset - offset))
-            input_buffer.seek(byteoffset - offset, 1)
             offset = byteoffset
         elif offset > byteoffset:
             raise Exception('Overlapping blocks in %s, index is inconsistent regarding byte ranges)' % temp_file)
-        data = input_buffer.read(raw_bytes)
         offset += raw_bytes
         dest = self._make_destination(network, station, starttime)
-        self._log.debug('Appending %d bytes from %s at offset %d to %s' % (raw_bytes, temp_file, byteoffset, dest))
-        self._append_data(data, dest)
-        return offset, dest
+        return offset, dest, (byteoffset, raw_bytes, records)
 
     def _make_destination(self, network, station, starttime):
         date_string = match(r'\d{4}-\d{2}-\d{2}', starttime).group(0)
@@ -138,25 +197,80 @@ will add all the data in the given file to the repository.
         year, day = time_data.tm_year, time_data.tm_yday
         return join(self._data_dir, network, str(year), '%03d' % day, '%s.%s.%04d.%03d' % (station, network, year, day))
 
-    def _append_data(self, data, mseed_file):
+    def _append_data(self, input_file, temp_file, sections, mseed_file):
+        """
+        Append the sections to the file and, if we have the records (and are indexing), add
+        the tsindex rows for the new data.  Returns True if the rows were added.
+        """
         # here we are locking for this process, so we can set the PID directly.
-        # there is no possibility for deadlock because we are single threaded
-        # and release on exit.
+        # locks are owned per thread, so threads (the in-process download engine) ingest
+        # different files in parallel.  a thread holds one lock at a time, so nothing here
+        # may take another.
         with self._lock_factory.lock(mseed_file, pid=getpid()):
-            # to avoid leaving broken files on unexpected exit, use a temp
-            # file and then move into position (move should be atomic)
-            tmp = mseed_file + '.tmp'
-            if exists(tmp):
-                self._log.warn('Cleaning %s' % tmp)
-                safe_unlink(tmp)
+            self._recover(mseed_file)
             if not exists(mseed_file):
                 create_parents(mseed_file)
-                open(tmp, 'w').close()
-            else:
-                copyfile(mseed_file, tmp)
-            with open(tmp, 'ba') as output:
-                output.write(data)
-            atomic_move(self._log, tmp, mseed_file)
+                open(mseed_file, 'w').close()
+            size = getsize(mseed_file)
+            with self._db:
+                self._db.execute('INSERT INTO rover_ingest_journal (filename, size, pid) VALUES (?, ?, ?)',
+                                 (mseed_file, size, getpid()))
+                change = record_change(self._db, mseed_file)
+            appended, position = [], 0  # the records, with offsets relative to the original end of file
+            with open(mseed_file, 'ab') as output:
+                for byteoffset, raw_bytes, records in sections:
+                    self._log.debug('Appending %d bytes from %s at offset %d to %s' %
+                                    (raw_bytes, temp_file, byteoffset, mseed_file))
+                    input_file.seek(byteoffset)
+                    output.write(input_file.read(raw_bytes))
+                    if records is None:
+                        appended = None
+                    elif appended is not None:
+                        for record in records:
+                            appended.append(record._replace(offset=position))
+                            position += record.length
+                output.flush()
+                fsync(output.fileno())
+            index, rows, start = self._index and appended is not None, [], time()
+            if index:
+                filemodtime = getmtime(mseed_file)
+                with open(mseed_file, 'rb') as input:
+                    rows = [tsindex_row(mseed_file, section, section_hash(input, section), filemodtime)
+                            for section in group_sections(appended, offset=size)]
+            with self._db:  # single transaction, so the index matches the journal after a crash
+                waited = begin_write(self._db)
+                if index:
+                    create_tsindex(self._db)
+                    self._db.executemany(INSERT_TSINDEX, rows)
+                    if change:
+                        forget_changes(self._db, change, [mseed_file])
+                self._db.execute('DELETE FROM rover_ingest_journal WHERE filename = ?', (mseed_file,))
+            self.lock_wait += waited
+            if index:
+                self.index_seconds += time() - start
+                self._log.debug('Wrote %d tsindex rows for %s (waited %.3fs for the write lock)' %
+                                (len(rows), mseed_file, waited))
+            return index
+
+    def _recover(self, mseed_file):
+        # must be called with the lock held.  the temp file is left by earlier versions
+        # of rover that copied the whole file before appending.
+        tmp = mseed_file + '.tmp'
+        if exists(tmp):
+            self._log.warn('Cleaning %s' % tmp)
+            safe_unlink(tmp)
+        for (size,) in self.fetchall('SELECT size FROM rover_ingest_journal WHERE filename = ?', (mseed_file,)):
+            if exists(mseed_file) and getsize(mseed_file) > size:
+                self._log.warn('Rolling back incomplete append to %s (truncating to %d bytes)' % (mseed_file, size))
+                truncate(mseed_file, size)
+            self.execute('DELETE FROM rover_ingest_journal WHERE filename = ?', (mseed_file,))
+
+    def _recover_all(self):
+        # roll back appends from processes that died while appending
+        for filename, pid in self.fetchall('SELECT filename, pid FROM rover_ingest_journal'):
+            if not process_exists(pid):
+                with self._lock_factory.lock(filename, pid=getpid()):
+                    self._recover(filename)
 
     def _assert_single_day(self, temp_file, starttime, endtime, sid):
         # Comparing time strings, presumed format 'YYYY-MM-DDThh:mm:ss.ssssss'
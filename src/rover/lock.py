@@ -1,6 +1,7 @@
 
 from os import getpid
 from sqlite3 import OperationalError, IntegrityError
+from threading import get_ident
 from time import sleep
 from .utils import format_epoch, process_exists
 from .sqlite import SqliteSupport
@@ -32,12 +33,28 @@ class DatabaseBasedLockFactory(SqliteSupport):
         self._create_lock_table()
 
     def _create_lock_table(self):
-        self.execute('''CREATE TABLE IF NOT EXISTS %s (
+        # a lock is owned by a thread (the in-process download engine runs several in one
+        # process), so each thread can hold one lock and threads lock different files in parallel.
+        # older tables (pid alone unique) are rebuilt, keeping any locks they hold.
+        old = self._table_name + '_old'
+        with self._db:
+            c = self._db.cursor()
+            c.execute('BEGIN')
+            columns = [row[1] for row in c.execute('PRAGMA table_info(%s)' % self._table_name).fetchall()]
+            if columns and 'thread' not in columns:
+                c.execute('ALTER TABLE %s RENAME TO %s' % (self._table_name, old))
+            c.execute('''CREATE TABLE IF NOT EXISTS %s (
                            id integer primary key autoincrement,
-                           pid integer unique,
+                           pid integer,
+                           thread integer,
                            key text unique,
-                           creation_epoch int default (cast(strftime('%%s', 'now') as int))
-        )''' % self._table_name)
+                           creation_epoch int default (cast(strftime('%%s', 'now') as int)),
+                           unique (pid, thread)
+            )''' % self._table_name)
+            if columns and 'thread' not in columns:
+                c.execute('''INSERT INTO %s (id, pid, key, creation_epoch)
+                             SELECT id, pid, key, creation_epoch FROM %s''' % (self._table_name, old))
+                c.execute('DROP TABLE %s' % old)
 
     def lock(self, key, pid=None):
         return LockContext(self._config, self._table_name, key, pid)
@@ -58,6 +75,8 @@ class LockContext(SqliteSupport):
         self.acquire()
 
     def acquire(self):
+        # locks taken for this process belong to the calling thread
+        thread = get_ident() if self._pid == getpid() else None
         clean = False
         while True:
             try:
@@ -71,12 +90,13 @@ class LockContext(SqliteSupport):
                     c.execute('BEGIN')
                     if not c.execute('SELECT count(*) FROM %s WHERE key = ?' % self._table, (self._key,)).fetchone()[0]:
                         self._log.debug('Acquiring lock on %s with %s for PID %d' % (self._table, self._key, getpid()))
-                        c.execute('INSERT INTO %s (pid, key) VALUES (?, ?)' % self._table, (self._pid, self._key))
+                        c.execute('INSERT INTO %s (pid, thread, key) VALUES (?, ?, ?)' % self._table,
+                                  (self._pid, thread, self._key))
                         return
             except IntegrityError as e:
                 self._log.debug('Acquiring lock: %s' % e)
                 sleep(1)
-                pass  # PID existed and needs to be cleaned out
+                pass  # PID (thread) existed and needs to be cleaned out
             except OperationalError as e:
                 self._log.debug('Acquiring lock: %s' % e)
                 sleep(1)
@@ -92,7 +112,7 @@ class LockContext(SqliteSupport):
         with self._db:
             c = self._db.cursor()
             c.execute('BEGIN')
-            c.execute('UPDATE %s SET pid=? WHERE key=?' % self._table, (pid, self._key))
+            c.execute('UPDATE %s SET pid=?, thread=NULL WHERE key=?' % self._table, (pid, self._key))
 
     def release(self):
         self._log.debug('Releasing lock on %s with %s' % (self._table, self._key))
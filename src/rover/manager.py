@@ -1,19 +1,28 @@
 import datetime as dt
-from collections import deque
+from collections import deque, defaultdict
+from fnmatch import fnmatchcase
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from queue import Queue, Empty
+from os.path import exists, getsize
 from random import randint
 from sqlite3 import OperationalError
-from time import time, sleep
+from time import time
 
 from .args import mm, FORCEFAILURES, DELETEFILES, TEMPDIR, HTTPTIMEOUT, HTTPRETRIES, TIMESPANTOL, DOWNLOADRETRIES, \
     DOWNLOADWORKERS, ROVERCMD, MSEEDINDEXCMD, LOGUNIQUE, LOGVERBOSITY, VERBOSITY, DOWNLOAD, DEV, WEB, SORTINPYTHON, \
-    TIMESPANINC, ABORT_CODE
-from .config import write_config
-from .coverage import Coverage, SingleSNCLBuilder
-from .download import DEFAULT_NAME, TMPREQUEST, TMPRESPONSE
+    TIMESPANINC, ABORT_CODE, DOWNLOADENGINE, INPROCESS, CHUNKSIZE, HTTPBLOCKSIZE, AVAILABILITYWORKERS, \
+    PIPELINE, CHECKPOINTPERIOD, http_pool_size
+from .config import write_config, timeseries_db
+from .coverage import new_coverage, SingleSNCLBuilder
+from .coverage_cache import CoverageCache
+from .download import DEFAULT_NAME, TMPREQUEST, TMPRESPONSE, DownloadTask
+from .metrics import METRICS_STORE, metrics_path, DOWNLOAD_BYTES, DOWNLOAD_REQUESTS, CHUNK_SECONDS, \
+    DOWNLOAD_SECONDS, INGEST_SECONDS, INDEX_SECONDS, ACTIVE_WORKERS, MAX_WORKERS, RETRIES, SQLITE_BUSY
 from .sqlite import SqliteSupport
-from .utils import utc, EPOCH_UTC, PushBackIterator, format_epoch, safe_unlink, unique_path, post_to_file, \
-    sort_file_inplace, parse_epoch, check_cmd, run, windows, diagnose_error, format_year_day_epoch
-from .workers import Workers
+from .utils import utc, EPOCH_UTC, PushBackIterator, format_epoch, safe_unlink, unique_path, post_to_lines, \
+    sort_file_inplace, parse_epoch, check_cmd, run, windows, diagnose_error, format_year_day_epoch, calc_bytes, \
+    http_connection_stats
+from .workers import Workers, ThreadWorkers
 
 """
 The core logic for scheduling multiple downloads.  Called by both the daemon and `rover retrieve`.
@@ -32,6 +41,7 @@ class ProgressStatistics:
     Statistics are pairs of values:
       index 0 - current value
       index 1 - initial value / limit
+    The limits are provisional (may still increase) until the availability is complete.
     """
 
     download_bytes = 0 # number of downloaded bytes per run
@@ -43,6 +53,7 @@ class ProgressStatistics:
         self.stations = [0, 0]
         self.seconds = [0, 0]
         self.chunks = [0, 0]
+        self.provisional = False
 
     def add_coverage(self, coverage):
         net_sta = coverage.sncl.split('_')[0:2]
@@ -56,17 +67,18 @@ class ProgressStatistics:
     def pop_timespan(self, start, end):
         self.seconds[0] += (end - start)
 
-    def add_chunks(self, n):
-        self.stations[0] += 1  # a set of chunks is for a single station
+    def add_chunks(self, n, stations=1):
+        self.stations[0] += stations  # a set of chunks is usually for a single station
         # the day count isn't global - it's per sncl (coverage) - so resets
         self.chunks[0] = 0
         self.chunks[1] = n
 
-    def pop_chunk(self):
-        self.chunks[0] += 1
+    def pop_chunk(self, n=1):
+        self.chunks[0] += n
 
     def __str__(self):
-        return '(N_S %d/%d; day %d/%d)' % (self.stations[0], self.stations[1], self.chunks[0], self.chunks[1])
+        return '(N_S %d/%d%s; day %d/%d)' % (self.stations[0], self.stations[1], '+' if self.provisional else '',
+                                             self.chunks[0], self.chunks[1])
 
 
 class ErrorStatistics:
@@ -90,13 +102,29 @@ class Chunks:
     A chunk is a collection of SNCLs and timespans that are downloaded at once.
     We used to download each individually, but that required too many parallel requests to
     be efficient, so now we collect them here.
-    This is a *collection* of chunks because a single chunk is only for one calendar day -
-    we may assemble multiple days when moving from the coverages to chunks.
+    This is a *collection* of chunks because a single chunk is only for one calendar day
+    of one station - we may assemble multiple days when moving from the coverages to chunks.
+
+    If chunk_size is non-zero then several days (and stations) are combined into a single
+    request, until the estimated size of the response reaches chunk_size bytes.  Ingest
+    splits the downloaded data by day, so this only changes the number of requests.
     """
 
-    def __init__(self, temp_dir):
+    # rough size of compressed miniSEED data, used to estimate request size
+    BYTES_PER_SAMPLE = 2
+
+    # nominal sample rates from the SEED band code, when no local data exist
+    BAND_RATES = {'F': 1000, 'G': 1000, 'D': 250, 'C': 250, 'E': 100, 'S': 40, 'H': 100, 'B': 40,
+                  'M': 10, 'L': 1, 'V': 0.1, 'U': 0.01, 'R': 0.001, 'P': 0.0001, 'T': 0.00001,
+                  'Q': 0.000001, 'A': 1, 'O': 1}
+    DEFAULT_RATE = 100
+
+    def __init__(self, temp_dir, chunk_size=0):
         self.__temp_dir = temp_dir
-        self.__chunks = {}   # list of (sncl, start, end) indexed by end of day epoch
+        self.__chunk_size = chunk_size
+        self.__chunks = {}   # list of (sncl, start, end) indexed by (station order, end of day epoch)
+        self.__sizes = {}    # estimated size in bytes, same index
+        self.__stations = {}  # station order, indexed by (network, station)
         self.__network = None
         self.__station = None
 
@@ -106,6 +134,10 @@ class Chunks:
     def __len__(self):
         return len(self.__chunks)
 
+    @property
+    def n_stations(self):
+        return len(self.__stations)
+
     @staticmethod
     def _end_of_day(epoch):
         day = dt.datetime.fromtimestamp(epoch, utc)
@@ -114,24 +146,44 @@ class Chunks:
         left = right - 0.000001
         return left, right
 
-    def _append(self, right, sncl, start, end):
-        if right not in self.__chunks:
-            self.__chunks[right] = []
-        self.__chunks[right].append((sncl, start, end))
+    @classmethod
+    def estimate_rate(cls, coverage):
+        """
+        The sample rate from local data, if known, otherwise a guess from the channel name.
+        """
+        if coverage.samplerate:
+            return coverage.samplerate
+        channel = coverage.sncl.split('_')[3]
+        if channel and channel[0] in cls.BAND_RATES:
+            return cls.BAND_RATES[channel[0]]
+        return cls.DEFAULT_RATE
+
+    def _append(self, right, sncl, start, end, rate):
+        key = (self.__stations[(self.__network, self.__station)], right)
+        if key not in self.__chunks:
+            self.__chunks[key] = []
+            self.__sizes[key] = 0
+        self.__chunks[key].append((sncl, start, end))
+        self.__sizes[key] += (end - start) * rate * self.BYTES_PER_SAMPLE
 
     def _set_ns(self, sncl):
         nslc = sncl.split('_')
         self.__network = nslc[0]
         self.__station = nslc[1]
+        if (self.__network, self.__station) not in self.__stations:
+            self.__stations[(self.__network, self.__station)] = len(self.__stations)
 
     def sncl_ok(self, sncl):
         nslc = sncl.split('_')
-        return not self.__chunks or (nslc[0] == self.__network and nslc[1] == self.__station)
+        if not self.__chunks or (nslc[0] == self.__network and nslc[1] == self.__station):
+            return True
+        # when combining, keep adding stations until there is enough for a single request
+        return self.__chunk_size > 0 and sum(self.__sizes.values()) < self.__chunk_size
 
     def add_coverage(self, coverage):
         sncl, timespans = coverage.sncl, PushBackIterator(iter(coverage.timespans))
-        if not self.__chunks:
-            self._set_ns(sncl)
+        self._set_ns(sncl)
+        rate = self.estimate_rate(coverage)
 
         # Determine sampling period (interval)
         # On initial download we do not know the sampling rate/period, but if data exists locally we do
@@ -151,7 +203,7 @@ class Chunks:
                 if sampleperiod and sampleperiod > 0 and (left - start) < sampleperiod:
                     continue
                 else:
-                    self._append(right, sncl, start, end)
+                    self._append(right, sncl, start, end, rate)
 
             # Otherwise, add the range beyond the current day to the timespans and
             # append the range that fits in the first day
@@ -163,24 +215,47 @@ class Chunks:
                 if sampleperiod and sampleperiod > 0 and (left - start) < sampleperiod:
                     continue
                 else:
-                    self._append(right, sncl, start, left)
+                    self._append(right, sncl, start, left, rate)
 
 
     @staticmethod
     def format_sncl(sncl):
         return ' '.join(code if code else '--' for code in sncl.split('_'))
 
+    def _next_keys(self):
+        keys = sorted(self.__chunks.keys())
+        if not self.__chunk_size:
+            return keys[:1]
+        size, n = self.__sizes[keys[0]], 1
+        while n < len(keys) and size + self.__sizes[keys[n]] <= self.__chunk_size:
+            size += self.__sizes[keys[n]]
+            n += 1
+        return keys[:n]
+
+    def _describe(self, keys):
+        stations = sorted(set(key[0] for key in keys))
+        names = dict((order, '%s_%s' % ns) for (ns, order) in self.__stations.items())
+        description = names[stations[0]]
+        if len(stations) > 1:
+            description += '+%d' % (len(stations) - 1)
+        days = sorted(set(key[1] for key in keys))
+        description += ' ' + format_year_day_epoch(days[0]-24*3600)
+        if len(days) > 1:
+            description += '-' + format_year_day_epoch(days[-1]-24*3600)
+        return description
+
     def pop(self, progress):
-        right = next(iter(sorted(self.__chunks.keys())))
-        description = '%s_%s %s' % (self.__network, self.__station, format_year_day_epoch(right-24*3600))
-        data = self.__chunks[right]
+        keys = self._next_keys()
+        description = self._describe(keys)
         path = unique_path(self.__temp_dir, 'rover_chunk', description)
         with open(path, 'w') as out:
-            for (sncl, start, end) in data:
-                progress.pop_timespan(start, end)
-                print('%s %s %s' % (self.format_sncl(sncl), format_epoch(start), format_epoch(end)), file=out)
-        del self.__chunks[right]
-        progress.pop_chunk()
+            for key in keys:
+                for (sncl, start, end) in self.__chunks[key]:
+                    progress.pop_timespan(start, end)
+                    print('%s %s %s' % (self.format_sncl(sncl), format_epoch(start), format_epoch(end)), file=out)
+                del self.__chunks[key]
+                del self.__sizes[key]
+        progress.pop_chunk(len(keys))
         return description, path
 
 
@@ -191,13 +266,17 @@ class Retrieval:
     on the fly).
     """
 
-    def __init__(self, log, name, temp_dir, delete_files, dataselect_url, force_failures):
+    def __init__(self, log, name, temp_dir, delete_files, dataselect_url, force_failures, in_process, chunk_size,
+                 label=None):
         self._log = log
         self._name = name
+        self._label = label  # for metrics (see source_label)
         self._temp_dir = temp_dir
         self._delete_files = delete_files
         self._dataselect_url = dataselect_url
         self._force_failures = force_failures
+        self._in_process = in_process
+        self._chunk_size = chunk_size
         self._coverages = deque()  # fifo: appendright / popleft; exposed for display
         self._chunks = None
         self.worker_count = 0
@@ -224,11 +303,11 @@ class Retrieval:
         """
         if self._chunks:
             return True
-        self._chunks = Chunks(self._temp_dir)
+        self._chunks = Chunks(self._temp_dir, self._chunk_size)
         while self._coverages and self._chunks.sncl_ok(self._coverages[0].sncl):
             self._chunks.add_coverage(self._coverages.popleft())
         if self._chunks:
-            self.progress.add_chunks(len(self._chunks))
+            self.progress.add_chunks(len(self._chunks), self._chunks.n_stations)
             return True
         return False
 
@@ -237,12 +316,20 @@ class Retrieval:
                      tuple(code if code else '--' for code in tuple(sncl.split('_')))
         return '%s?%s&start=%s&end=%s' % (self._dataselect_url, url_params, format_epoch(start), format_epoch(end))
 
-    def _worker_callback(self, command, return_code, path, **kwargs):
+    def _worker_callback(self, command, return_code, path, start, **kwargs):
         feedback = kwargs.get("feedback")
+        METRICS_STORE.observe(CHUNK_SECONDS, time() - start, source=self._label)
+        METRICS_STORE.inc(DOWNLOAD_REQUESTS, source=self._label, result='error' if return_code else 'ok')
         if feedback:
             bytecount = feedback.get("download_byte_count", 0)
             ProgressStatistics.download_bytes += bytecount
             ProgressStatistics.download_total_bytes += bytecount
+            METRICS_STORE.inc(DOWNLOAD_BYTES, bytecount, source=self._label)
+            for key, name in (('download_seconds', DOWNLOAD_SECONDS), ('ingest_seconds', INGEST_SECONDS),
+                              ('index_seconds', INDEX_SECONDS)):
+                if key in feedback:
+                    METRICS_STORE.observe(name, feedback[key], source=self._label)
+            METRICS_STORE.inc(SQLITE_BUSY, feedback.get('lock_wait', 0.0), source=self._label)
         if self._delete_files:
             safe_unlink(path)
         self.worker_count -= 1
@@ -259,8 +346,13 @@ class Retrieval:
         description, path = self._chunks.pop(self.progress)
         self._log.default('Downloading %s %s' % (description, self.progress))
         # for testing error handling we can inject random errors here
-        if randint(1, 100) <= self._force_failures:
+        fail = randint(1, 100) <= self._force_failures
+        if fail:
             self._log.warn('Random failure expected (%s %d)' % (mm(FORCEFAILURES), self._force_failures))
+        if self._in_process:
+            # run in a worker thread, sharing this process (see ThreadWorkers)
+            command = DownloadTask(path, fail=fail)
+        elif fail:
             command = 'exit 1  # failure for tests'
         else:
             # we only pass arguments on the command line that are different from the
@@ -271,7 +363,8 @@ class Retrieval:
                 command = '%s -f %s %s "%s"' % (rover_cmd, config_path, DOWNLOAD, path)
         self._log.debug(command)
 
-        callback_function = lambda cmd, rtn, **kwargs: self._worker_callback(cmd, rtn, path, **kwargs)
+        start = time()
+        callback_function = lambda cmd, rtn, **kwargs: self._worker_callback(cmd, rtn, path, start, **kwargs)
 
         try:
             workers.execute(command, callback=callback_function, feedback=True)
@@ -291,6 +384,48 @@ class Retrieval:
 # (if we use backports then it's a conditional install)
 UNCERTAIN, CONFIRMED, INCONSISTENT = 0, 1, 2
 
+# time (s) spent adding availability to a retrieval in each step of the download manager, when pipelined
+PIPELINE_SLICE = 0.1
+
+# minimum time (s) between writes of the metrics for the web server
+METRICS_PERIOD = 1
+
+
+def source_label(name):
+    """
+    The source label for metrics ("retrieve" or the subscription id).
+    """
+    return 'retrieve' if name == DEFAULT_NAME else str(name)
+
+
+def _codes_overlap(a, b):
+    """
+    Could the codes (which may be lists and contain wildcards) match the same value?
+    """
+    for x in a.split(','):
+        for y in b.split(','):
+            wild_x, wild_y = any(c in x for c in '*?'), any(c in y for c in '*?')
+            if x == y or (wild_x and wild_y) or (wild_x and fnmatchcase(y, x)) or (wild_y and fnmatchcase(x, y)):
+                return True
+    return False
+
+
+def _group_overlapping(keys):
+    """
+    Group the (network, station) keys so that any two that could match the same station
+    are in the same group (groups, and keys within them, are sorted).
+    """
+    groups = []
+    for key in sorted(keys):
+        overlapping = [group for group in groups
+                       if any(all(map(_codes_overlap, key, other)) for other in group)]
+        merged = [key]
+        for group in overlapping:
+            groups.remove(group)
+            merged.extend(group)
+        groups.append(sorted(merged))
+    return sorted(groups)
+
 
 class Source(SqliteSupport):
     """
@@ -303,7 +438,8 @@ class Source(SqliteSupport):
     # second. it collects and reports statistics that are used by the download manager and displayed to the user.
     # these are the public attributes and properties (delegated to the current retriever).
 
-    def __init__(self, config, name, fetch, request_path, availability_url, dataselect_url, completion_callback):
+    def __init__(self, config, name, fetch, request_path, availability_url, dataselect_url, completion_callback,
+                 wake=None):
         super().__init__(config)
         self._log = config.log
         self._force_failures = config.arg(FORCEFAILURES)
@@ -311,11 +447,22 @@ class Source(SqliteSupport):
         self._temp_dir = config.dir(TEMPDIR)
         self._http_timeout = config.arg(HTTPTIMEOUT)
         self._http_retries = config.arg(HTTPRETRIES)
+        self._http_blocksize = calc_bytes(config.arg(HTTPBLOCKSIZE))
+        self._http_pool_size = http_pool_size(config)
         self._timespan_inc = config.arg(TIMESPANINC)
         self._timespan_tol = config.arg(TIMESPANTOL)
         self._config = config
         self.download_retries = config.arg(DOWNLOADRETRIES)
         self._sort_in_python = config.arg(SORTINPYTHON)
+        self._in_process = config.arg(DOWNLOADENGINE) == INPROCESS
+        self._coverage_cache = CoverageCache(config)
+        self._chunk_size = calc_bytes(config.arg(CHUNKSIZE))
+        self._availability_workers = config.arg(AVAILABILITYWORKERS)
+        self._wake = wake  # called when an availability query completes
+        self._pipeline = config.arg(PIPELINE)
+        self._shards = []  # (future, request, queue) for availability queries not yet added to the retrieval
+        self._joining = None  # (shard, generator) when a shard is partially added (pipeline)
+        self._fetch = fetch
         self.name = name
         self._request_path = request_path
         self._availability_url = availability_url
@@ -352,6 +499,12 @@ class Source(SqliteSupport):
         """
         return self._retrieval.has_chunks()
 
+    def availability_pending(self):
+        """
+        Are availability queries still running (or not yet added to the retrieval)?
+        """
+        return bool(self._shards)
+
     @property
     def worker_count(self):
         """
@@ -402,7 +555,8 @@ class Source(SqliteSupport):
 
         # the default value for consistent is UNCERTAIN so it is left unchanged in many places below
         # we throw an exception if we finish with incomplete data (errors) or proof of inconsistency.
-        if self._retrieval.is_complete():
+        self._collect_availability()
+        if not self._shards and self._retrieval.is_complete():
             self.errors.accumulate(self._retrieval.errors)
             complete = True  # default if exception thrown
             try:
@@ -574,48 +728,164 @@ class Source(SqliteSupport):
     def _new_retrieval(self, fetch):
         # fetch indicates we're not simply querying and so should check for no data and prime days
         self.n_retries += 1
+        self._fetch = fetch
         if fetch:
             self._log.default('Trying new %sretrieval attempt %d of %d.' %
                               (self._name, self.n_retries, self.download_retries))
         self._retrieval = Retrieval(self._log, self._name, self._temp_dir, self._delete_files,
-                                    self._dataselect_url, self._force_failures)
-        request = self._build_request(self._request_path)
-        response = self._get_availability(request, self._availability_url)
-        try:
-            # compare database and availability to construct list of missing data
-            # we could make this lazy, but then we lose progression statistics.  so
-            # just try to be as meagre with memory use as possible.
-            for remote in self._parse_availability(response):
-                self._log.debug('Available data: %s' % remote)
-                local = self._scan_index(remote.sncl)
-                self._log.debug('Local data: %s' % local)
-                required = remote.subtract(local)
-                self._retrieval.add_coverage(required)
-        finally:
+                                    self._dataselect_url, self._force_failures, self._in_process, self._chunk_size,
+                                    label=source_label(self.name))
+        # the availability service is queried in parallel (one query per shard of the request),
+        # in background threads.  results are added to the retrieval as they arrive (see
+        # _collect_availability) so downloads can start before all queries are complete.
+        requests = self._build_requests(self._request_path)
+        executor = ThreadPoolExecutor(max_workers=len(requests), thread_name_prefix='availability')
+        self._shards, self._joining = [], None
+        for request in requests:
+            queue = Queue()
+            future = executor.submit(self._query_availability, request, queue)
+            if self._wake:
+                future.add_done_callback(lambda future: self._wake())
+            self._shards.append((future, request, queue))
+        executor.shutdown(wait=False)
+        if fetch:
+            self._retrieval.progress.provisional = True
+        else:
+            # listing, so we need everything now
+            self._collect_availability(block=True)
+
+    def _query_availability(self, request, queue):
+        # called in a background thread, so no database access
+        lines = self._get_availability(request, self._availability_url)
+        for coverage in self._parse_availability(lines, request):
+            queue.put(coverage)
+            if self._pipeline and self._wake:
+                self._wake()
+
+    @staticmethod
+    def _queued(shard):
+        """
+        The coverages from a shard, as they arrive.  None means that none are available yet.
+        """
+        future, request, queue = shard
+        while True:
+            try:
+                yield queue.get_nowait()
+            except Empty:
+                if future.done():
+                    if queue.empty():
+                        future.result()  # raise any error
+                        return
+                else:
+                    yield None
+
+    def _collect_availability(self, block=False):
+        """
+        Add the coverages from completed availability queries to the retrieval (if block is True,
+        wait for all queries to complete).
+
+        When pipelined, coverages are added as they arrive, for (roughly) PIPELINE_SLICE seconds
+        per call, so that downloads can start while the availability is still being processed.
+        """
+        pipeline, start = self._pipeline and not block, time()
+        while self._shards:
+            if not self._joining:
+                ready = [shard for shard in self._shards if pipeline or shard[0].done()]
+                if not ready:
+                    if not block:
+                        return
+                    wait([shard[0] for shard in self._shards], return_when=FIRST_COMPLETED)
+                    continue
+                self._joining = ready[0], self._join_index(self._queued(ready[0]), ready[0][1])
+            shard, join = self._joining
+            try:
+                # compare database and availability to construct list of missing data
+                # unless pipelined, we do this for a complete shard at a time, so that the
+                # progress statistics are (mostly) known before we start downloading.
+                for remote, local in join:
+                    if remote is None:
+                        return  # waiting for the availability service
+                    self._log.debug('Available data: %s' % remote)
+                    self._log.debug('Local data: %s' % local)
+                    required = remote.subtract(local)
+                    self._retrieval.add_coverage(required)
+                    if pipeline and time() - start > PIPELINE_SLICE:
+                        if self._wake:
+                            self._wake()  # more to do, so don't block in DownloadManager.wait()
+                        return
+            except Exception:
+                self._cancel_availability()
+                raise
+            self._joining = None
+            self._shards.remove(shard)
             if self._delete_files:
-                safe_unlink(request)
-                safe_unlink(response)
-        if fetch and not self._retrieval.has_chunks():
+                safe_unlink(shard[1])
+        self._retrieval.progress.provisional = False
+        if self._fetch and not self._retrieval.progress.stations[1]:  # nothing to download
             self._log.default('%sRetrieval attempt %d of %d is complete.' %
                               (self._name, self.n_retries, self.download_retries))
+            self._fetch = False  # only display once
+
+    def is_reading_index(self):
+        """
+        Is a read of the index in progress (a shard partially joined when pipelined)?
+        """
+        return self._joining is not None
+
+    def _cancel_availability(self):
+        if self._joining:
+            self._joining[1].close()
+        for future, request, queue in self._shards:
+            future.cancel()
+            if self._delete_files and future.done():
+                safe_unlink(request)
+        self._shards, self._joining = [], None
 
-    def _build_request(self, path):
-        tmp = unique_path(self._temp_dir, TMPREQUEST, path)
-        self._log.debug('Prepending options to %s via %s' % (path, tmp))
-        with open(tmp, 'w') as output:
-            print('merge=samplerate,quality', file=output)
-            with open(path, 'r') as inpath:
-                for line in inpath:
+    def _build_requests(self, path):
+        """
+        Split the request into (at most) one shard per availability worker, keeping each
+        network/station together (along with any that could match the same stations, via
+        wildcards, so that a N_S_L_C is returned by only one shard), and prepend options to each.
+        """
+        options, stations = [], defaultdict(list)
+        with open(path, 'r') as input:
+            for line in input:
+                parts = line.split()
+                if '=' in line or len(parts) < 2:
+                    options.append(line)
+                else:
+                    stations[tuple(parts[0:2])].append(line)
+        groups = [[line for key in group for line in stations[key]] for group in _group_overlapping(stations.keys())]
+        n_shards = max(1, min(self._availability_workers, len(groups)))
+        per_shard = sum(len(group) for group in groups) / n_shards
+        shards, count = [[]], 0
+        for index, group in enumerate(groups):
+            if shards[-1] and len(shards) < n_shards and \
+                    (count >= per_shard * len(shards) or len(groups) - index <= n_shards - len(shards)):
+                shards.append([])
+            shards[-1].extend(group)
+            count += len(group)
+        requests = []
+        for index, lines in enumerate(shards):
+            request = unique_path(self._temp_dir, TMPREQUEST, '%s %d' % (path, index))
+            self._log.debug('Prepending options to shard %d of %s via %s' % (index, path, request))
+            with open(request, 'w') as output:
+                print('merge=samplerate,quality', file=output)
+                for line in options + lines:
                     print(line, file=output, end='')
-        return tmp
+            requests.append(request)
+        if len(requests) > 1:
+            self._log.info('Split the availability request into %d queries' % len(requests))
+        return requests
 
     def _get_availability(self, request, availability_url):
         self._log.info('Checking availability service')
         response = unique_path(self._temp_dir, TMPRESPONSE, request)
-        response, check_status = post_to_file(availability_url, request, response, self._http_timeout, self._http_retries, self._log)
+        lines, check_status = post_to_lines(availability_url, request, response, self._http_timeout, self._http_retries, self._log,
+                                            blocksize=self._http_blocksize, pool_size=self._http_pool_size)
         try:
             check_status()
-            return response
+            return lines
         except Exception as e:
             diagnose_error(self._log, str(e), request, response)
             raise
@@ -627,28 +897,194 @@ class Source(SqliteSupport):
         except:
             raise Exception('Could not parse "%s" in the response from the availability service' % line)
 
-    def _parse_availability(self, response):
+    def _parse_lines(self, lines, ordered=False):
+        """
+        Yield a coverage for each group of lines with the same N_S_L_C.  If ordered is True
+        stop at (and return) the first line whose N_S_L_C sorts before the previous one.
+        Within a group, timespans whose start times go backwards are sorted (in memory).
+        """
+        availability, unsorted = None, False
+        for line in lines:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                sncl, b, e = self._parse_line(line)
+                if availability and not availability.sncl == sncl:
+                    yield self._sorted(availability, unsorted)
+                    if ordered and sncl.split('_') < availability.sncl.split('_'):
+                        return line
+                    availability, unsorted = None, False
+                if not availability:
+                    availability = new_coverage(self._log, self._timespan_tol, self._timespan_inc, sncl)
+                elif b < availability.timespans[-1][0]:
+                    unsorted = True
+                availability.add_epochs(b, e)
+        if availability:
+            yield self._sorted(availability, unsorted)
+
+    def _sorted(self, availability, unsorted):
+        if unsorted:
+            self._log.info('Availability start times out of order for %s so sorting' % availability.sncl)
+            availability.timespans = sorted(availability.timespans)
+        return availability
+
+    def _parse_availability(self, lines, request):
+        """
+        Parse the availability response as it arrives, yielding a coverage per N_S_L_C.
+
+        The service groups (and orders) the response by N_S_L_C, so usually no sorting is
+        needed.  If an N_S_L_C is out of order the rest of the response is written to a
+        file, sorted, and parsed from there.  An N_S_L_C split across the two parts then
+        gives two coverages, which _join_index() handles like any other out of order data.
+        """
+        spool = None
         try:
-            if response is not None:  # None when no data returned
-                sort_file_inplace(self._log, response, self._temp_dir, self._sort_in_python)
-                with open(response, 'r') as input:
-                    availability = None
-                    for line in input:
-                        line = line.strip()
-                        if line and not line.startswith('#'):
-                            sncl, b, e = self._parse_line(line)
-                            if availability and not availability.sncl == sncl:
-                                yield availability
-                                availability = None
-                            if not availability:
-                                availability = Coverage(self._log, self._timespan_tol, self._timespan_inc, sncl)
-                            availability.add_epochs(b, e)
-                    if availability:
-                        yield availability
+            if lines is not None:  # None when no data returned
+                unordered = yield from self._parse_lines(lines, ordered=True)
+                if unordered:
+                    spool = unique_path(self._temp_dir, TMPRESPONSE, request)
+                    self._log.info('Availability out of order at "%s" so sorting the rest in %s' % (unordered, spool))
+                    with open(spool, 'w') as output:
+                        print(unordered, file=output)
+                        for line in lines:
+                            output.write(line)
+                    sort_file_inplace(self._log, spool, self._temp_dir, self._sort_in_python)
+                    with open(spool, 'r') as input:
+                        yield from self._parse_lines(input)
         except Exception as e:
             diagnose_error(self._log, 'Problems parsing the availability service response.',
-                           self._request_path, response)
+                           self._request_path, spool)
             raise
+        finally:
+            if spool and self._delete_files:
+                safe_unlink(spool)
+
+    def _request_networks(self, request=None):
+        """
+        The (possibly wildcard) network codes in the request, or None if all networks
+        may be included.
+        """
+        networks = set()
+        with open(request or self._request_path, 'r') as input:
+            for line in input:
+                parts = line.split()
+                if len(parts) < 4 or '=' in line:
+                    continue
+                for network in parts[0].split(','):
+                    # the index is case sensitive, but the service may not be
+                    if network == '*' or network != network.upper():
+                        return None
+                    networks.add(network)
+        return sorted(networks) if networks else None
+
+    def _network_filter(self, request=None):
+        """
+        SQL conditions (and parameters) for the networks in the request.
+        """
+        networks = self._request_networks(request)
+        if networks:
+            # equality (where possible) lets sqlite use the index
+            return ['(' + ' OR '.join(['network GLOB ?' if any(c in network for c in '*?[') else 'network = ?'
+                                       for network in networks]) + ')'], tuple(networks)
+        else:
+            return [], tuple()
+
+    def _stream_index(self, uncached=False, request=None):
+        """
+        All tsindex rows for the requested networks, ordered by N_S_L_C (used by _join_index).
+        If uncached is True, N_S_L_Cs in the coverage cache are excluded.
+        """
+        conditions, params = self._network_filter(request)
+        if uncached:
+            conditions.append('''NOT EXISTS (SELECT 1 FROM rover_coverage_cache AS c
+                                 WHERE c.network = tsindex.network AND c.station = tsindex.station
+                                   AND c.location = tsindex.location AND c.channel = tsindex.channel
+                                   AND c.timespans IS NOT NULL)''')
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        # see _scan_index for the use of coalesce
+        sql = '''SELECT network, station, location, channel,
+                        coalesce(timespans, '<' || starttime || ' ' || endtime || '>'), samplerate
+                   FROM tsindex %s
+                  ORDER BY network, station, location, channel''' % where
+        self._log.debug('Stream index: %s %s' % (sql, params))
+        cursor = self._db.cursor()
+        try:
+            for row in cursor.execute(sql, params):
+                yield row
+        except OperationalError:
+            self._log.debug('No index - check rover.config')
+        finally:
+            cursor.close()
+
+    def _stream_cache(self, request=None):
+        """
+        Cached coverages for the requested networks, ordered by N_S_L_C (used by _join_index).
+        """
+        conditions, params = self._network_filter(request)
+        return self._coverage_cache.stream(conditions, params)
+
+    @staticmethod
+    def _merge(rows, key):
+        """
+        Rows from the (ordered) iterator that match the key, skipping earlier rows.
+        """
+        for row in rows:
+            if tuple(row[0:4]) < key:
+                continue
+            elif tuple(row[0:4]) == key:
+                yield row
+            else:
+                rows.push(row)
+                break
+
+    def _join_index(self, remotes, request=None):
+        """
+        Pair each availability coverage with the local coverage, reading the index in a single
+        ordered pass (a merge join) rather than a query per N_S_L_C.  If the availability
+        is not in the same order as the index we fall back to a query for that N_S_L_C.
+
+        Local coverages are read from the coverage cache when possible, and those read
+        from the index are added to the cache.
+
+        A remote of None is passed through (as None, None) so that the caller can pause.
+        """
+        use_cache, token = self._coverage_cache.prepare(), None
+        if use_cache:
+            token = self._coverage_cache.reserve(*self._network_filter(request))
+        rows, cached, new = None, None, []
+        previous = None
+        for remote in remotes:
+            if remote is None:  # nothing available yet (see _queued)
+                yield None, None
+                continue
+            key = tuple(remote.sncl.split('_'))
+            if previous is not None and key <= previous:
+                self._log.debug('Availability out of order at %s' % remote.sncl)
+                yield remote, self._scan_index(remote.sncl)
+                continue
+            if rows is None:
+                index_rows, cache_rows = self._stream_index(uncached=use_cache, request=request), \
+                                         (self._stream_cache(request) if use_cache else iter(()))
+                rows, cached = PushBackIterator(index_rows), PushBackIterator(cache_rows)
+            previous = key
+            local = None
+            for row in self._merge(cached, key):
+                local = self._coverage_cache.coverage(row)
+            if local is None:
+                builder = SingleSNCLBuilder(self._log, self._timespan_tol, self._timespan_inc, remote.sncl)
+                for row in self._merge(rows, key):
+                    builder.add_timespans(row[4], row[5])
+                local = builder.coverage()
+                # joined now (as it would be in subtract) so that the cache can skip that work
+                if use_cache and local and local.samplerate is not None:
+                    local.join()
+                    new.append(local)
+            yield remote, local
+        if rows is not None:
+            index_rows.close()  # release the cursors
+            if use_cache:
+                cache_rows.close()
+        if new:
+            self._coverage_cache.save(new, token)
 
     def _scan_index(self, sncl):
         availability = SingleSNCLBuilder(self._log, self._timespan_tol, self._timespan_inc, sncl)
@@ -672,6 +1108,117 @@ class Source(SqliteSupport):
         return availability.coverage()
 
 
+def wal_size(config):
+    """
+    The size of the database's write-ahead log (0 if there is none).
+    """
+    wal_path = timeseries_db(config) + '-wal'
+    return getsize(wal_path) if exists(wal_path) else 0
+
+
+# the longest time (seconds) the manager waits for workers to finish before a checkpoint
+CHECKPOINT_DRAIN = 10
+
+
+class CheckpointScheduler(SqliteSupport):
+    """
+    Checkpoint the database every checkpoint-period seconds (and at the start), copying
+    the write-ahead log (WAL) back into the database and truncating it, so that the WAL
+    does not grow without limit during long runs (which slows every reader).
+
+    A TRUNCATE checkpoint waits for writers and cannot complete while other connections
+    read from the WAL, so the manager stops starting new workers once a checkpoint is
+    due and calls drain() until they have all finished.  If that takes longer than
+    CHECKPOINT_DRAIN seconds, or the index is being read (pipelined retrieval), the
+    checkpoint is skipped until the next period, so that downloads do not stall for
+    nothing.  Automatic checkpoints are disabled on the manager's connection (other
+    processes keep the default).
+
+    The results of the latest checkpoint (or skip) are saved in rover_checkpoint_stats
+    for the web display.
+    """
+
+    def __init__(self, config, drain=CHECKPOINT_DRAIN):
+        super().__init__(config)
+        self._config = config
+        self._period = config.arg(CHECKPOINTPERIOD)
+        self._drain = drain
+        self._last = None
+        self._drain_start = None
+        self._create_stats_table()
+        if self._period:
+            self.execute('PRAGMA wal_autocheckpoint = 0')
+
+    def _create_stats_table(self):
+        self.execute('''CREATE TABLE IF NOT EXISTS rover_checkpoint_stats (
+                          checkpoint_epoch float not null,
+                          duration float not null,
+                          wal_before int not null,
+                          wal_after int not null,
+                          busy int not null
+                        )''')
+
+    def is_due(self):
+        """
+        Should a checkpoint be made (when workers are idle)?
+        """
+        return bool(self._period) and (self._last is None or time() - self._last >= self._period)
+
+    def drain(self, idle, reading):
+        """
+        Called while a checkpoint is due, with whether the workers are idle and whether
+        the index is being read.  Checkpoints (or skips) and returns False, or returns
+        True while the manager should wait for workers to finish.
+        """
+        if reading:
+            self.skip('the index is being read')
+            return False
+        if idle:
+            self.checkpoint()
+            return False
+        if self._drain_start is None:
+            self._drain_start = time()
+        elif time() - self._drain_start >= self._drain:
+            self.skip('downloads still running after %ds' % self._drain)
+            return False
+        return True
+
+    def checkpoint(self):
+        """
+        Checkpoint the database and save the statistics.
+        """
+        before, start = wal_size(self._config), time()
+        try:
+            busy, _, _ = self.fetchone('PRAGMA wal_checkpoint(TRUNCATE)')
+        except OperationalError as e:  # a statement is still open on this connection
+            self._log.debug('Database checkpoint failed: %s' % e)
+            busy = 1
+        self._last = time()
+        duration, after = self._last - start, wal_size(self._config)
+        if busy:
+            self._log.warn('Database checkpoint could not complete (WAL is %d bytes)' % after)
+        else:
+            self._log.debug('Database checkpoint took %.3fs (WAL was %d bytes)' % (duration, before))
+        self._save_stats(duration, before, after, busy)
+
+    def skip(self, reason):
+        """
+        Skip the checkpoint until the next period (saved as incomplete in the statistics).
+        """
+        self._last, size = time(), wal_size(self._config)
+        self._log.info('Skipping database checkpoint (%s; WAL is %d bytes)' % (reason, size))
+        self._save_stats(self._last - self._drain_start if self._drain_start else 0, size, size, 1)
+
+    def _save_stats(self, duration, before, after, busy):
+        self._drain_start = None
+        with self._db:  # single transaction
+            self._db.cursor().execute('BEGIN')
+            self._db.execute('DELETE FROM rover_checkpoint_stats')
+            self._db.execute('''INSERT INTO rover_checkpoint_stats
+                                (checkpoint_epoch, duration, wal_before, wal_after, busy)
+                                VALUES (?, ?, ?, ?, ?)''', (self._last, duration, before, after, busy))
+
+
 class DownloadManager(SqliteSupport):
     """
     An interface to downloader instances that restricts downloads to a fixed number of workers,
@@ -695,7 +1242,10 @@ class DownloadManager(SqliteSupport):
         self._config = config
         self._sources = {}  # map of source names to sources
         self._index = 0  # used to round-robin sources
-        self._workers = Workers(config, config.arg(DOWNLOADWORKERS))
+        if config.arg(DOWNLOADENGINE) == INPROCESS:
+            self._workers = ThreadWorkers(config, config.arg(DOWNLOADWORKERS))
+        else:
+            self._workers = Workers(config, config.arg(DOWNLOADWORKERS))
         self._n_downloads = 0
         self._create_stats_table()
         if config_file:
@@ -705,9 +1255,12 @@ class DownloadManager(SqliteSupport):
             log_unique = config.arg(LOGUNIQUE) or not config.arg(DEV)
             log_verbosity = config.arg(LOGVERBOSITY) if config.arg(DEV) else min(config.arg(LOGVERBOSITY), 3)
             self._config_path = write_config(config, config_file, log_unique=log_unique, log_verbosity=log_verbosity)
+            self._checkpoints = CheckpointScheduler(config)
+            self._metrics_path, self._metrics_epoch = metrics_path(config), 0
             self._start_web()
         else:
             self._config_path = None
+            self._checkpoints = None
 
     # source management
 
@@ -727,7 +1280,7 @@ class DownloadManager(SqliteSupport):
         if name in self._sources and self._sources[name].worker_count:
             raise Exception('Cannot overwrite active source %s' % self._sources[name])
         self._sources[name] = Source(self._config, name, fetch, request_path, availability_url, dataselect_url,
-                                     completion_callback)
+                                     completion_callback, wake=self._workers.wake)
 
     # display expected downloads
 
@@ -808,15 +1361,6 @@ class DownloadManager(SqliteSupport):
         else:
             return False
 
-    # the step method below is probably the best place to insert a call to execute
-    # pragma wal_checkpoint if we have further problems with locked databases.
-    # the idea would be to add a counter to the manager and every 1000 (say) calls,
-    # wait for all workers to close and then execute the pragma.  this would
-    # allow the database to update without contention.
-
-    # we would also need to disable automatic checkpointing with pragma
-    # wal_autocheckpoint and make sure to run a checkpoint on count 0 (ie at the start).
-
     def step(self, quiet=True):
         """
         A single iteration of the manager's main loop.  Can be inter-mixed with add().
@@ -838,6 +1382,13 @@ class DownloadManager(SqliteSupport):
         self._clean_sources(quiet=quiet)
         # with that done, update the stats for teh web display
         self._update_stats()
+        # when a checkpoint is due we let the workers drain (don't start new ones), for a
+        # limited time, so that the database is not in use (see CheckpointScheduler)
+        if self._checkpoints.is_due():
+            reading = any(source.is_reading_index() for source in self._sources.values())
+            if self._checkpoints.drain(self._workers.is_idle(), reading):
+                self._write_metrics()
+                return
         # before trying to find a suitable candidates for more work...
         while self._workers.has_space() and self._has_data():
             # the order of sources is sorted here so that we round-robin consistently
@@ -855,6 +1406,16 @@ class DownloadManager(SqliteSupport):
                 self._n_downloads += 1
             # todo - does this do anything useful without a workers.check()?
             self._clean_sources(quiet=quiet)
+        # after starting workers, so that the number running is current
+        self._write_metrics()
+
+    def wait(self, timeout=None):
+        """
+        Block until a download (or availability query) finishes or the timeout (in seconds)
+        expires, rather than polling.
+        """
+        pending = any(source.availability_pending() for source in self._sources.values())
+        self._workers.wait(timeout, pending=pending)
 
     def download(self):
         """
@@ -866,16 +1427,44 @@ class DownloadManager(SqliteSupport):
         try:
             while self._sources and not source.is_complete():
                 self.step(quiet=False)
-                sleep(0.1)
+                self.wait()
         finally:
             # not needed in normal use, as no workers when no sources, but useful on error
             self._workers.wait_for_all()
+            if self._config_path:
+                self._write_metrics(force=True)
+            n_requests, n_connections = http_connection_stats()
+            self._log.info('Made %d HTTP requests in this process using %d new connections (%d re-used)' %
+                           (n_requests, n_connections, n_requests - n_connections))
 
         return self._n_downloads
 
     # stats for web display
 
+    def _write_metrics(self, force=False):
+        """
+        Write the metrics (see metrics.py) for the web server, at most once every METRICS_PERIOD
+        seconds (unless force is True or the number of workers has changed).  Most values are
+        updated as workers complete; here we add the current state.
+        """
+        n_active = self._workers.n_active()
+        if not force and n_active == METRICS_STORE.get(ACTIVE_WORKERS) and \
+                time() - self._metrics_epoch < METRICS_PERIOD:
+            return
+        self._metrics_epoch = time()
+        METRICS_STORE.set(ACTIVE_WORKERS, n_active)
+        METRICS_STORE.set(MAX_WORKERS, self._config.arg(DOWNLOADWORKERS))
+        for source in self._sources.values():
+            METRICS_STORE.set(RETRIES, source.n_retries, source=source_label(source.name))
+        try:
+            METRICS_STORE.write(self._metrics_path)
+        except OSError as e:
+            self._log.warn('Could not write metrics to %s: %s' % (self._metrics_path, e))
+
     def _create_stats_table(self):
+        # the table only holds current values, so can be discarded if it is from an older version
+        if 'provisional' not in [row[1] for row in self.fetchall('PRAGMA table_info(rover_download_stats)')]:
+            self.execute('DROP TABLE IF EXISTS rover_download_stats')
         self.execute('''CREATE TABLE IF NOT EXISTS rover_download_stats (
                           submission text not null,
                           initial_stations int not null,
@@ -883,7 +1472,8 @@ class DownloadManager(SqliteSupport):
                           initial_time float not null,
                           remaining_time float not null,
                           n_retries int not null,
-                          download_retries int not null
+                          download_retries int not null,
+                          provisional int not null default 0
                         )''')
 
     def _update_stats(self):
@@ -894,12 +1484,12 @@ class DownloadManager(SqliteSupport):
                 progress = source.stats()
                 self._db.execute('''INSERT INTO rover_download_stats
                                     (submission, initial_stations, remaining_stations, initial_time, remaining_time,
-                                     n_retries, download_retries)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                                     n_retries, download_retries, provisional)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
                                  (source.name,
                                   progress.stations[1], progress.stations[1] - progress.stations[0],
                                   progress.seconds[1], max(0, int(progress.seconds[1] - progress.seconds[0])),
-                                  source.n_retries, source.download_retries))
+                                  source.n_retries, source.download_retries, progress.provisional))
 
     def _start_web(self):
         if windows():
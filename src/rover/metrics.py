@@ -0,0 +1,155 @@
+from bisect import bisect_left
+from os import replace
+from os.path import join
+from threading import Lock
+
+from .args import TEMPDIR
+
+"""
+A lightweight, in-memory store of metrics (counters, gauges and histograms) for
+the download manager, which writes it (in the Prometheus text format) to a file
+that the web server returns for /metrics.
+"""
+
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# upper bounds (seconds) for histogram buckets
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+
+DOWNLOAD_BYTES = 'rover_download_bytes_total'
+DOWNLOAD_REQUESTS = 'rover_download_requests_total'
+CHUNK_SECONDS = 'rover_chunk_seconds'
+DOWNLOAD_SECONDS = 'rover_download_seconds'
+INGEST_SECONDS = 'rover_ingest_seconds'
+INDEX_SECONDS = 'rover_index_seconds'
+ACTIVE_WORKERS = 'rover_workers_active'
+MAX_WORKERS = 'rover_workers_max'
+RETRIES = 'rover_retrieval_attempt'
+SQLITE_BUSY = 'rover_sqlite_busy_seconds_total'
+
+METRICS = {
+    DOWNLOAD_BYTES: (COUNTER, 'Bytes downloaded from the dataselect service.'),
+    DOWNLOAD_REQUESTS: (COUNTER, 'Downloads (one per chunk), by result.'),
+    CHUNK_SECONDS: (HISTOGRAM, 'Time to process a chunk (download, ingest and index) in a worker.'),
+    DOWNLOAD_SECONDS: (HISTOGRAM, 'Time to download a chunk from the dataselect service.'),
+    INGEST_SECONDS: (HISTOGRAM, 'Time to ingest a chunk, including indexing.'),
+    INDEX_SECONDS: (HISTOGRAM, 'Time to index the data ingested from a chunk.'),
+    ACTIVE_WORKERS: (GAUGE, 'Download workers running.'),
+    MAX_WORKERS: (GAUGE, 'Download workers allowed.'),
+    RETRIES: (GAUGE, 'Current retrieval attempt for each source.'),
+    SQLITE_BUSY: (COUNTER, 'Time spent waiting for the SQLite write lock by workers.'),
+}
+
+METRICSFILE = 'rover_metrics.txt'
+
+
+def metrics_path(config):
+    """
+    The file the download manager writes and the web server reads.
+    """
+    return join(config.dir(TEMPDIR), METRICSFILE)
+
+
+def _format_labels(labels, extra=None):
+    labels = labels + ((extra,) if extra else ())
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """
+    Thread-safe counters, gauges and histograms, identified by name (see METRICS) and labels.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self._buckets = buckets
+        self._lock = Lock()
+        self._values = {}  # (name, labels) -> value, or [bucket counts, sum, count] for histograms
+
+    def _key(self, name, labels):
+        if name not in METRICS:
+            raise Exception('Unknown metric %s' % name)
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self._buckets), 0.0, 0]
+            counts, _, _ = histogram = self._values[key]
+            index = bisect_left(self._buckets, value)
+            if index < len(counts):
+                counts[index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def get(self, name, **labels):
+        """
+        The current value (for a histogram, the count).
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            value = self._values.get(key, 0)
+        return value[2] if isinstance(value, list) else value
+
+    def render(self):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            values = dict((key, [list(value[0]), value[1], value[2]] if isinstance(value, list) else value)
+                          for key, value in self._values.items())
+        lines = []
+        for name in sorted(METRICS):
+            kind, help = METRICS[name]
+            keys = sorted(key for key in values if key[0] == name)
+            if not keys:
+                continue
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for key in keys:
+                labels, value = key[1], values[key]
+                if kind == HISTOGRAM:
+                    counts, total, count = value
+                    cumulative = 0
+                    for bound, n in zip(self._buckets, counts):
+                        cumulative += n
+                        lines.append('%s_bucket%s %d' % (name, _format_labels(labels, ('le', bound)), cumulative))
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels, ('le', '+Inf')), count))
+                    lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(total)))
+                    lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+                else:
+                    lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def write(self, path):
+        """
+        Write the metrics to the file (atomically, so that the reader sees a complete copy).
+        """
+        temp = path + '.tmp'
+        with open(temp, 'w') as output:
+            output.write(self.render())
+        replace(temp, path)
+
+
+# the store for this process (updated by the download manager and its sources)
+METRICS_STORE = Metrics()
@@ -0,0 +1,218 @@
+from collections import namedtuple
+from datetime import date
+from hashlib import md5
+from mmap import mmap, ACCESS_READ
+from os.path import getsize
+from struct import Struct
+
+from .utils import EPOCH_ORDINAL
+
+"""
+A minimal reader for miniSEED (2 and 3) record headers - enough to find the records in
+a file, group them into sections and index them without running mseedindex.
+"""
+
+
+class MSeedError(Exception):
+    """
+    The data could not be parsed (the caller may fall back to mseedindex).
+    """
+
+
+# a single record in a file (times are epoch seconds, end is the time of the last sample).
+# quality is the miniSEED 2 quality code (None for miniSEED 3), version the publication version.
+Record = namedtuple('Record', 'network station location channel quality version start end samplerate offset length')
+
+# contiguous records (in the file) for a single N_S_L_C, quality, version and samplerate, as
+# indexed in a tsindex row.  timespans are the (start, end) pairs with no gaps; timeindex is
+# a list of (time, byteoffset) pairs, from the first record in each hour.
+Section = namedtuple('Section', 'network station location channel quality version start end samplerate offset length '
+                                'timespans timeindex')
+
+# mseedindex maps the miniSEED 2 quality code to a publication version
+VERSIONS = {'D': 1, 'R': 2, 'Q': 3, 'M': 4}
+
+_FIXED_HEADER = 48
+_FIXED_HEADER_3 = 40
+_HEADER_3 = Struct('<xxxxIHHBBBxdIxxxxBBHI')
+_BTIME = {'>': Struct('>HHBBBxH'), '<': Struct('<HHBBBxH')}
+_HEADER = {'>': Struct('>HhhBxxBiHH'), '<': Struct('<HhhBxxBiHH')}
+_BLOCKETTE = {'>': Struct('>HH'), '<': Struct('<HH')}
+_DAY_EPOCHS = {}
+
+
+def _day_epoch(year, day):
+    # epoch at the start of the given day of year (cached, as records are mostly from a few days)
+    key = (year, day)
+    if key not in _DAY_EPOCHS:
+        _DAY_EPOCHS[key] = (date(year, 1, 1).toordinal() + day - 1 - EPOCH_ORDINAL) * 86400
+    return _DAY_EPOCHS[key]
+
+
+def _samplerate(factor, multiplier):
+    # see the SEED manual, fixed section of data header, fields 10 and 11
+    if factor > 0 and multiplier > 0:
+        return float(factor * multiplier)
+    elif factor > 0 and multiplier < 0:
+        return -float(factor) / multiplier
+    elif factor < 0 and multiplier > 0:
+        return -float(multiplier) / factor
+    elif factor < 0 and multiplier < 0:
+        return 1.0 / (factor * multiplier)
+    else:
+        return 0.0
+
+
+def _byte_order(data, offset):
+    # the year must be sensible, which identifies the byte order
+    for order in '><':
+        year, day = _BTIME[order].unpack_from(data, offset + 20)[0:2]
+        if 1900 <= year <= 2100 and 1 <= day <= 366:
+            return order
+    raise MSeedError('Cannot determine byte order of record at offset %d' % offset)
+
+
+def _parse_record(data, offset):
+    if data[offset:offset + 3] == b'MS\x03':
+        return _parse_record_3(data, offset)
+    if len(data) - offset < _FIXED_HEADER:
+        raise MSeedError('Truncated header at offset %d' % offset)
+    quality = chr(data[offset + 6])
+    if not data[offset:offset + 6].isdigit() or quality not in 'DRQM':
+        raise MSeedError('No miniSEED record at offset %d' % offset)
+    order = _byte_order(data, offset)
+    year, day, hour, minute, second, fraction = _BTIME[order].unpack_from(data, offset + 20)
+    n_samples, factor, multiplier, activity, n_blockettes, correction, _, blockette = \
+        _HEADER[order].unpack_from(data, offset + 30)
+    start = _day_epoch(year, day) + hour * 3600 + minute * 60 + second + fraction / 10000.0
+    if correction and not activity & 0x02:  # time correction not already applied
+        start += correction / 10000.0
+    length, micros = None, 0
+    # walk the blockettes for the record length (1000) and extra time precision (1001)
+    while blockette and n_blockettes:
+        if blockette + 4 > len(data) - offset:
+            raise MSeedError('Truncated blockette in record at offset %d' % offset)
+        kind, following = _BLOCKETTE[order].unpack_from(data, offset + blockette)
+        if kind == 1000:
+            length = 1 << data[offset + blockette + 6]
+        elif kind == 1001:
+            micros = int.from_bytes(data[offset + blockette + 5:offset + blockette + 6], 'big', signed=True)
+        if following and following <= blockette:
+            break
+        blockette, n_blockettes = following, n_blockettes - 1
+    if not length:
+        raise MSeedError('No record length (blockette 1000) in record at offset %d' % offset)
+    start += micros / 1000000.0
+    samplerate = _samplerate(factor, multiplier)
+    end = start + (n_samples - 1) / samplerate if samplerate and n_samples else start
+    sid = data[offset + 8:offset + 20].decode('ascii')
+    return Record(sid[10:12].strip(), sid[0:5].strip(), sid[5:7].strip(), sid[7:10].strip(), quality,
+                  VERSIONS[quality], start, end, samplerate, offset, length)
+
+
+def _parse_record_3(data, offset):
+    # see the miniSEED 3 specification (all values are little-endian)
+    if len(data) - offset < _FIXED_HEADER_3:
+        raise MSeedError('Truncated header at offset %d' % offset)
+    nanos, year, day, hour, minute, second, rate, n_samples, version, sid_length, extra_length, data_length = \
+        _HEADER_3.unpack_from(data, offset)
+    sid = bytes(data[offset + _FIXED_HEADER_3:offset + _FIXED_HEADER_3 + sid_length]).decode('ascii')
+    if not sid.startswith('FDSN:'):
+        raise MSeedError('Unsupported source identifier (%s) in record at offset %d' % (sid, offset))
+    codes = sid[5:].split('_')
+    if len(codes) != 6:
+        raise MSeedError('Cannot parse source identifier (%s) in record at offset %d' % (sid, offset))
+    network, station, location, band, source, subsource = codes
+    if len(band) == len(source) == len(subsource) == 1:
+        channel = band + source + subsource
+    else:
+        channel = '_'.join((band, source, subsource))
+    start = _day_epoch(year, day) + hour * 3600 + minute * 60 + second + nanos / 1000000000.0
+    # negative values are the sample period
+    samplerate = rate if rate >= 0 else -1.0 / rate
+    end = start + (n_samples - 1) / samplerate if samplerate and n_samples else start
+    return Record(network, station, location, channel, None, version, start, end, samplerate, offset,
+                  _FIXED_HEADER_3 + sid_length + extra_length + data_length)
+
+
+def scan_records(data, offset=0, end=None):
+    """
+    Yield the records in the data (bytes or mmap), from offset to end.
+    """
+    end = len(data) if end is None else end
+    while offset < end:
+        record = _parse_record(data, offset)
+        if offset + record.length > end:
+            raise MSeedError('Truncated record at offset %d' % offset)
+        yield record
+        offset += record.length
+
+
+def scan_file(path):
+    """
+    All the records in a file (read via mmap).
+    """
+    if not getsize(path):
+        return []
+    with open(path, 'rb') as input:
+        with mmap(input.fileno(), 0, access=ACCESS_READ) as data:
+            return list(scan_records(data))
+
+
+def section_hash(input, section, blocksize=1024 * 1024):
+    """
+    The (hex) md5 digest of the section's bytes, read from an open (binary) file,
+    which is the hash that mseedindex stores.
+    """
+    digest = md5()
+    input.seek(section.offset)
+    remaining = section.length
+    while remaining:
+        block = input.read(min(blocksize, remaining))
+        if not block:
+            raise MSeedError('Truncated section at offset %d' % section.offset)
+        digest.update(block)
+        remaining -= len(block)
+    return digest.hexdigest()
+
+
+# mseedindex adds a time index entry about once an hour
+TIMEINDEX_INTERVAL = 3600
+
+
+def group_sections(records, offset=0):
+    """
+    Group (contiguous) records into sections, as indexed by mseedindex.  The records
+    are assumed to be consecutive in the file, starting at offset (which is added to
+    the record offsets, eg when records are appended to another file).
+    """
+    section, spans, index, next_index = None, None, None, None
+    for record in records:
+        key = record[0:6] + (record.samplerate,)
+        if section and key == section[0]:
+            tolerance = 0.5 / record.samplerate if record.samplerate else 0
+            previous = spans[-1]
+            if abs(record.start - (previous[1] + (1.0 / record.samplerate if record.samplerate else 0))) <= tolerance:
+                spans[-1] = (previous[0], max(previous[1], record.end))
+            else:
+                spans.append((record.start, record.end))
+            if record.end >= next_index:
+                index.append((record.start, offset + record.offset))
+                next_index = record.start + TIMEINDEX_INTERVAL
+            section[1] = min(section[1], record.start)
+            section[2] = max(section[2], record.end)
+            section[4] += record.length
+        else:
+            if section:
+                yield _section(section, spans, index)
+            section = [key, record.start, record.end, offset + record.offset, record.length]
+            spans = [(record.start, record.end)]
+            index = [(record.start, offset + record.offset)]
+            next_index = record.start + TIMEINDEX_INTERVAL
+    if section:
+        yield _section(section, spans, index)
+
+
+def _section(section, spans, index):
+    key, start, end, offset, length = section
+    return Section(*(key[0:6] + (start, end, key[6], offset, length, spans, index)))
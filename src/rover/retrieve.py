@@ -52,6 +52,7 @@ which is not in the local repository.
 
 @temp-dir
 @availability-url
+@availability-workers
 @dataselect-url
 @timespan-tol
 @pre-index
@@ -60,11 +61,17 @@ which is not in the local repository.
 @post-summary
 @rover-cmd
 @mseedindex-cmd
+@index-engine
 @data-dir
 @download-workers
+@download-engine
+@chunk-size
+@pipeline
+@checkpoint-period
 @download-retries
 @http-timeout
 @http-retries
+@http-block-size
 @web
 @http-bind-address
 @http-port
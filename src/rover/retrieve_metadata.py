@@ -2,10 +2,10 @@ import os
 import shutil
 from collections import namedtuple
 from .args import STATIONURL, RETRIEVE_METADATA, UserFeedback, fail_early, \
-    HTTPTIMEOUT, HTTPRETRIES, TEMPDIR, OUTPUT_FORMAT
+    HTTPTIMEOUT, HTTPRETRIES, TEMPDIR, OUTPUT_FORMAT, HTTPBLOCKSIZE, http_pool_size
 from .report import Reporter
 from .sqlite import SqliteContext, NoResult
-from .utils import post_to_file, diagnose_error, unique_path, safe_unlink
+from .utils import post_to_file, diagnose_error, unique_path, safe_unlink, calc_bytes
 from .config import timeseries_db
 
 
@@ -25,6 +25,8 @@ class MetadataSource(UserFeedback):
         self._station_url = config.arg(STATIONURL)
         self._http_timeout = config.arg(HTTPTIMEOUT)
         self._http_retries = config.arg(HTTPRETRIES)
+        self._blocksize = calc_bytes(config.arg(HTTPBLOCKSIZE))
+        self._http_pool_size = http_pool_size(config)
         self._temp_dir = config.dir(TEMPDIR)
         self._config = config
 
@@ -33,7 +35,9 @@ class MetadataSource(UserFeedback):
             response, check_status = post_to_file(url, in_path, out_path,
                                                   self._http_timeout,
                                                   self._http_retries,
-                                                  self._log)
+                                                  self._log,
+                                                  blocksize=self._blocksize,
+                                                  pool_size=self._http_pool_size)
             check_status()
         except Exception as e:
             diagnose_error(self._log, str(e), in_path,
@@ -154,6 +158,7 @@ data archive. This feature is only supported for the ASDF output format.
 @download-retries
 @http-timeout
 @http-retries
+@http-block-size
 @http-bind-address
 @http-port
 @email
@@ -1,12 +1,11 @@
 
-from genericpath import isdir
-from os import listdir, makedirs
-from os.path import split, join, isfile, exists, getmtime
+from os import listdir, makedirs, scandir, stat, sep
+from os.path import split, join, isfile, exists
 from sqlite3 import OperationalError
 
 from .args import DATADIR, ALL, RECURSE
-from .sqlite import SqliteSupport
-from .utils import canonify, PushBackIterator, in_memory, parse_epoch
+from .sqlite import SqliteSupport, NoResult
+from .utils import canonify, PushBackIterator, parse_epoch
 
 """
 Iterators over files on the file system, or in the database, and - building
@@ -14,6 +13,61 @@ on that - an iterator over modified files.
 """
 
 
+# the files in the repository changed (by ingest) since they were last indexed.
+# the table only exists once the repository has been scanned completely, so when
+# it is present it is a complete list and the scan can be skipped (see ModifiedScanner).
+CHANGE_JOURNAL = 'rover_changed_files'
+
+
+def create_change_journal(db):
+    db.execute('''CREATE TABLE IF NOT EXISTS %s (
+                    id integer primary key autoincrement,
+                    filename text unique not null
+                  )''' % CHANGE_JOURNAL)
+
+
+def record_change(db, path):
+    """
+    Add the file to the change journal (if it exists), returning the entry's id (or None).
+    The id is larger than any previous entry (a file already in the journal is moved to
+    the end) so that entries added while the journal is processed can be kept.
+    """
+    try:
+        return db.execute('INSERT OR REPLACE INTO %s (filename) VALUES (?)' % CHANGE_JOURNAL, (path,)).lastrowid
+    except OperationalError:
+        return None  # no journal yet, so the next index will scan everything
+
+
+# the modification time (ns) and number of entries of each NET/YEAR/DAY directory
+# after the last complete index, so that unchanged directories can be skipped.
+DIRECTORY_STATES = 'rover_scanned_dirs'
+
+
+def save_directory_states(db, states):
+    """
+    Replace the saved directory states with (dirname, mtime, entries) tuples.
+    """
+    db.execute('''CREATE TABLE IF NOT EXISTS %s (
+                    dirname text primary key,
+                    mtime integer not null,
+                    entries integer not null
+                  )''' % DIRECTORY_STATES)
+    db.execute('DELETE FROM %s' % DIRECTORY_STATES)
+    db.executemany('INSERT INTO %s (dirname, mtime, entries) VALUES (?, ?, ?)' % DIRECTORY_STATES, states)
+
+
+def forget_changes(db, last, paths=None):
+    """
+    Remove entries up to (and including) last from the change journal (only those for
+    the given paths, if not None).
+    """
+    if paths is None:
+        db.execute('DELETE FROM %s WHERE id <= ?' % CHANGE_JOURNAL, (last,))
+    else:
+        db.executemany('DELETE FROM %s WHERE filename = ? AND id <= ?' % CHANGE_JOURNAL,
+                       ((path, last) for path in paths))
+
+
 def find_stem(path, root, log):
     """
     Find the initial part of path that matches root (and return the length).
@@ -32,6 +86,18 @@ def find_stem(path, root, log):
             raise Exception('Could not find canonical prefix to %s' % original_path)
 
 
+def directory_range(dir, separator=sep):
+    """
+    The (lower, upper) bounds of the filenames within dir (sorted as strings).
+    """
+    prefix = dir + separator
+    return prefix, dir + chr(ord(separator) + 1)
+
+
+# the number of files read from the database at a time by DatabasePathIterator
+PAGE_SIZE = 10000
+
+
 class DatabasePathIterator(SqliteSupport):
     """
     Ordered iterator over files known in the database.
@@ -41,61 +107,94 @@ class DatabasePathIterator(SqliteSupport):
     over the filesystem (only) and querying the database for each file, we
     do a single scan of the database and use that to provide a list of known
     files.
+
+    The files are read a page at a time (keyset pagination on the filename), so
+    memory use is bounded and no read transaction is held open between pages
+    (ie while files are processed).  Files written while iterating are not seen
+    as long as their names sort before the last page read, which is the case in
+    ModifiedScanner (and once exhausted no more pages are read).
     """
 
-    def __init__(self, config):
+    def __init__(self, config, page_size=PAGE_SIZE):
         super().__init__(config)
         self._data_dir = config.dir(DATADIR)
-        self._stem = 0
-        self._prev_path = None
-        self._cursor = self._db.cursor()
-        # prev_path and ordering filemodtime desc guarantee that we get the latest
-        # modification time if there's more than one value (not clear if mseedindex
-        # updates all rows with the latest value).
-        try:
-            sql = 'SELECT distinct filemodtime, filename FROM tsindex ORDER BY filename ASC, filemodtime DESC'
-            self._log.debug('Execute: %s' % sql)
-            self._cursor.execute(sql)
-        except OperationalError as e:
-            # this is the case when there's no table yet, so no files
-            self._cursor = None
+        self._page_size = page_size
+        self._stem = None
+        self._page = iter(())
+        self._last = ''
+        self._exhausted = False
 
     def __iter__(self):
         return self
 
     def __next__(self):
         try:
-            if self._cursor:
-                lastmod, path = next(self._cursor)
-                if not self._prev_path:
-                    self._stem = find_stem(path, self._data_dir, self._log)
-                if self._prev_path != path:
-                    self._prev_path = path
-                return lastmod, join(self._data_dir, path[self._stem + 1:])
-            else:
-                raise StopIteration()
-        except:
-            if self._cursor:
-                self._cursor.close()
-            raise
+            lastmod, path = next(self._page)
+        except StopIteration:
+            if self._exhausted or not self._next_page():
+                self._exhausted = True
+                raise
+            lastmod, path = next(self._page)
+        return lastmod, join(self._data_dir, path[self._stem + 1:])
 
+    def _next_page(self):
+        # we take the latest modification time if there's more than one value (rows
+        # for data appended by ingest have a later value than the rest of the file).
+        # this query uses a covering index (see ROVER_INDEXES in index.py).
+        try:
+            rows = self.fetchall('''SELECT max(filemodtime), filename FROM tsindex WHERE filename > ?
+                                     GROUP BY filename ORDER BY filename LIMIT ?''',
+                                 (self._last, self._page_size), quiet=True)
+        except OperationalError:
+            # this is the case when there's no table yet, so no files
+            return False
+        if rows:
+            self._last = rows[-1][1]
+            if self._stem is None:
+                self._stem = find_stem(rows[0][1], self._data_dir, self._log)
+            self._page = iter(rows)
+        return bool(rows)
+
+
+def DataDirectoryIterator(root, depth=1):
+    """
+    Ordered iterator over the fourth level directories (NET/YEAR/DAY), that
+    contain the data files in the repository, returning the path, modification
+    time (ns) and (sorted) entries of each.
 
-def RepositoryIterator(root, depth=1):
+    os.scandir is used so that directories are identified without a stat call
+    for each entry, and the entries cache any stat result.
+    """
+    if depth == 1:
+        root = canonify(root)
+    # the time is read before the entries, so any later change is seen next time
+    mtime = stat(root).st_mtime_ns if depth == 4 else None
+    with scandir(root) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    if depth == 4:
+        yield root, mtime, entries
+    else:
+        for entry in entries:
+            if entry.is_dir():
+                # cannot use 'yield from' as 3to2 doesn't translate it
+                for directory in DataDirectoryIterator(entry.path, depth=depth + 1):
+                    yield directory
+
+
+def RepositoryIterator(root, states=None):
     """
     Ordered iterator over the filesystem, returning only files from
     the fourth directory level, corresponding to the data files in
-    the repository.
+    the repository, as (path, os.DirEntry) pairs.
+
+    If states is a list, (dirname, mtime, entries) is appended for each
+    directory.
     """
-    root = canonify(root)
-    files = sorted(listdir(root))
-    for file in files:
-        path = join(root, file)
-        if isdir(path) and depth < 4:
-            # cannot use 'yield from' as 3to2 doesn't translate it
-            for path in RepositoryIterator(path, depth=depth + 1):
-                yield path
-        elif depth == 4:
-            yield path
+    for dir, mtime, entries in DataDirectoryIterator(root):
+        if states is not None:
+            states.append((dir, mtime, len(entries)))
+        for entry in entries:
+            yield entry.path, entry
 
 
 class ModifiedScanner(SqliteSupport):
@@ -103,6 +202,12 @@ class ModifiedScanner(SqliteSupport):
     Compare the filesystem and the database (using the iterators above)
     and when there is a discrepancy either remove a database entry or process
     (via subclass) the file.
+
+    Once the repository has been scanned completely the change journal is
+    created, and later calls process just the files in the journal, plus any
+    changes in directories whose modification time or number of entries has
+    changed (ie files added or removed by something other than ingest).  With
+    --all, or before the first complete scan, everything is scanned.
     """
 
     def __init__(self, config):
@@ -115,20 +220,111 @@ class ModifiedScanner(SqliteSupport):
     def scan_data_dir(self):
         if not exists(self._data_dir):
             makedirs(self._data_dir)
-        # pull into memory here to avoid open database when processing
-        dbpaths = PushBackIterator(in_memory(DatabasePathIterator(self._config)))
-        fspaths = RepositoryIterator(self._data_dir)
+        last, previous, states = self.last_change(), self._directory_states(), []
+        if self._all or last is None or previous is None:
+            self._scan_all(states)
+        else:
+            self._scan_directories(previous, states, self._scan_journal(last))
+        self.done()
+        # only now are the changes safely in the index
+        with self._db:
+            create_change_journal(self._db)
+            if last is not None:
+                forget_changes(self._db, last)
+            save_directory_states(self._db, states)
+
+    def last_change(self):
+        """
+        The id of the latest entry in the change journal (0 if empty), or None if there
+        is no journal.
+        """
+        try:
+            return self.fetchsingle('SELECT coalesce(max(id), 0) FROM %s' % CHANGE_JOURNAL, quiet=True)
+        except OperationalError:
+            return None
+
+    def _directory_states(self):
+        """
+        The saved directory states (dirname: (mtime, entries)), or None if there are none.
+        """
+        try:
+            return dict((dir, (mtime, entries)) for dir, mtime, entries in
+                        self.fetchall('SELECT dirname, mtime, entries FROM %s' % DIRECTORY_STATES, quiet=True))
+        except OperationalError:
+            return None
+
+    def _scan_journal(self, last):
+        """
+        Process the files in the journal, returning their paths.
+        """
+        paths = [row[0] for row in self.fetchall('SELECT filename FROM %s WHERE id <= ? ORDER BY filename'
+                                                 % CHANGE_JOURNAL, (last,))]
+        self._log.info('Checking %d changed files (from the change journal)' % len(paths))
+        for path in paths:
+            if exists(path):
+                self.process(path)
+            else:
+                self._delete(path)
+        return set(paths)
+
+    def _scan_directories(self, previous, states, done):
+        """
+        Compare the files and the database for each directory that has changed (comparing
+        the modification time and, for filesystems with coarse times, the number of entries).
+        """
+        root, changed = self._indexed_root(), 0
+        for dir, mtime, entries in DataDirectoryIterator(self._data_dir):
+            states.append((dir, mtime, len(entries)))
+            if previous.pop(dir, None) != (mtime, len(entries)):
+                changed += 1
+                self._scan_directory(root, dir, entries, done)
+        for dir in previous:  # directories that have been removed
+            changed += 1
+            self._scan_directory(root, dir, [], done)
+        self._log.info('Checked %d changed directories (of %d)' % (changed, len(states)))
+
+    def _indexed_root(self):
+        # the data directory, as it appears in filenames in the database (see find_stem)
+        try:
+            filename = self.fetchsingle('SELECT filename FROM tsindex LIMIT 1', quiet=True)
+        except (NoResult, OperationalError):
+            return self._data_dir
+        return filename[:find_stem(filename, self._data_dir, self._log)]
+
+    def _scan_directory(self, root, dir, entries, done):
+        # the filename range for the directory uses the covering index (see ROVER_INDEXES in index.py)
+        try:
+            indexed = dict((self._data_dir + filename[len(root):], (lastmod, filename)) for lastmod, filename in
+                           self.fetchall('''SELECT max(filemodtime), filename FROM tsindex
+                                            WHERE filename >= ? AND filename < ? GROUP BY filename''',
+                                         directory_range(root + dir[len(self._data_dir):]), quiet=True))
+        except OperationalError:
+            indexed = {}  # no table yet
+        for entry in entries:
+            lastmod, _ = indexed.pop(entry.path, (None, None))
+            if entry.path in done:
+                continue
+            # add one because it's rounded down
+            if lastmod is None or entry.stat().st_mtime > parse_epoch(lastmod) + 1:
+                self.process(entry.path)
+        for _, filename in indexed.values():
+            self._delete(filename)
+
+    def _scan_all(self, states):
+        self._log.info('Scanning the repository for changed files')
+        # read in pages, to avoid an open database (and bound memory use) when processing
+        dbpaths = PushBackIterator(DatabasePathIterator(self._config))
+        fspaths = RepositoryIterator(self._data_dir, states)
         while True:
-            closed, dblastmod, dbpath, fspath = False, 0, None, None
+            closed, dblastmod, dbpath, fspath, entry = False, 0, None, None, None
             try:
                 dblastmod, dbpath = next(dbpaths)
             except StopIteration:
                 closed = True
             try:
-                fspath = next(fspaths)
+                fspath, entry = next(fspaths)
             except StopIteration:
                 if closed:
-                    self.done()
                     return
             # extra entry in file system, so push current database value back,
             # and pretend this entry was in the database, but with a modified date
@@ -143,12 +339,12 @@ class ModifiedScanner(SqliteSupport):
             # fspath == dbpath so test if need to scan
             else:
                 dbepoch = parse_epoch(dblastmod) + 1   # add one because it's rounded down
-                if self._all or getmtime(fspath) > dbepoch:
+                if self._all or entry.stat().st_mtime > dbepoch:
                     self.process(fspath)
 
     def _delete(self, path):
         self._log.debug('Removing %s from index' % path)
-        self.execute('delete from tsindex where filename like ?', (path,))
+        self.execute('delete from tsindex where filename = ?', (path,))
 
     def process(self, path):
         raise Exception('Unimplemented')
@@ -1,5 +1,6 @@
 
 from sqlite3 import connect
+from time import time
 
 from .utils import canonify
 
@@ -22,6 +23,16 @@ def init_db(dbpath, log):
     return db
 
 
+def begin_write(db):
+    """
+    Start a transaction that holds the write lock (so nothing else can write until
+    it is committed).  Returns the time (in seconds) spent waiting for the lock.
+    """
+    start = time()
+    db.execute('BEGIN IMMEDIATE')
+    return time() - start
+
+
 class NoResult(Exception):
     """
     Exception thrown when no results available.
@@ -114,7 +125,7 @@ class SqliteDb:
         Note that it may be better (eg in list-index) to iterate over
         the cursor explicitly (see foreachrow).
         """
-        with self.cursor() as c:
+        with self.cursor(quiet=quiet) as c:
             self._log.debug('Fetchall: %s %s' % (sql, params))
             return c.execute(sql, params).fetchall()
 
@@ -7,7 +7,7 @@ from .config import timeseries_db
 from .index import START, END
 from .utils import STATION, NETWORK, CHANNEL, LOCATION, format_epoch, tidy_timestamp
 from .args import SUMMARY
-from .sqlite import SqliteSupport
+from .sqlite import SqliteSupport, begin_write
 
 
 """
@@ -18,15 +18,35 @@ The 'rover list-summary' command - displays entries from the summary table.
 """
 
 
+def _changed(row):
+    return '''INSERT OR IGNORE INTO rover_summary_changes (network, station, location, channel)
+               VALUES (%s.network, %s.station, %s.location, %s.channel);''' % (row, row, row, row)
+
+
+# record the N_S_L_Cs whose summary must be updated.  an update could move a row to
+# a new N_S_L_C, so record both old and new.
+TRIGGERS = {
+    'rover_summary_insert': 'AFTER INSERT ON tsindex BEGIN %s END' % _changed('NEW'),
+    'rover_summary_update': 'AFTER UPDATE ON tsindex BEGIN %s %s END' % (_changed('OLD'), _changed('NEW')),
+    'rover_summary_delete': 'AFTER DELETE ON tsindex BEGIN %s END' % _changed('OLD')
+}
+
+_SUMMARY_ROWS = '''SELECT t.network, t.station, t.location, t.channel,
+                          min(t.starttime) AS earliest, max(t.endtime) AS latest,
+                          datetime('now') AS updt
+                     FROM tsindex AS t %s
+                    GROUP BY 1,2,3,4'''
+
+
 class Summarizer(SqliteSupport):
     """
 ### Summary
 
     rover summary
 
-Creates a summary of the index stored in a ROVER repository. This lists the
-overall span of data for each Net_Sta_Loc_Chan and can be queried using
-`rover list-summary`.
+Creates (or updates) a summary of the index stored in a ROVER repository.
+This lists the overall span of data for each Net_Sta_Loc_Chan and can be
+queried using `rover list-summary`.
 
 ##### Significant Options
 
@@ -44,23 +64,69 @@ will create the summary of a local ROVER repository.
 
     """
 
+# The summary is updated incrementally.  Triggers on tsindex record the N_S_L_Cs
+# that change in rover_summary_changes and only those are summarised again.  The
+# whole table is only rebuilt when the triggers are missing (the first time, or if
+# tsindex was re-created).  Either way, changes are made in a single transaction,
+# so the table can be queried throughout.
+
     def __init__(self, config):
         super().__init__(config)
 
     def run(self, args):
         if len(args):
             raise Exception('Usage: rover %s' % SUMMARY)
-        self._log.info('Generating summary table')
-        self.execute('DROP TABLE IF EXISTS tsindex_summary')
-        try:
-            self.execute('''CREATE TABLE tsindex_summary AS
-                              SELECT network, station, location, channel,
-                                     min(starttime) AS earliest, max(endtime) AS latest,
-                                     datetime('now') AS updt
-                              FROM tsindex
-                              GROUP BY 1,2,3,4''')
-        except OperationalError:
+        if not self.fetchsingle('''SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'tsindex' '''):
             self._log.default('No index found')
+            return
+        with self._db:  # single transaction
+            begin_write(self._db)
+            self._db.execute('''CREATE TABLE IF NOT EXISTS rover_summary_changes (
+                                  network text not null,
+                                  station text not null,
+                                  location text not null,
+                                  channel text not null,
+                                  primary key (network, station, location, channel)
+                                )''')
+            n_triggers = self._db.execute('''SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (?, ?, ?)''',
+                                          tuple(TRIGGERS.keys())).fetchone()[0]
+            n_summary = self._db.execute('''SELECT count(*) FROM sqlite_master
+                                             WHERE type = 'table' AND name = 'tsindex_summary' ''').fetchone()[0]
+            if n_triggers != len(TRIGGERS) or not n_summary:
+                self._rebuild()
+            else:
+                self._update()
+
+    def _rebuild(self):
+        self._log.info('Generating summary table')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS tsindex_summary (
+                              network TEXT, station TEXT, location TEXT, channel TEXT,
+                              earliest TEXT, latest TEXT, updt TEXT
+                            )''')
+        self._db.execute('''CREATE UNIQUE INDEX IF NOT EXISTS rover_summary_nslc_idx
+                              ON tsindex_summary (network, station, location, channel)''')
+        self._db.execute('DELETE FROM tsindex_summary')
+        self._db.execute('INSERT INTO tsindex_summary ' + _SUMMARY_ROWS % '')
+        for name, trigger in TRIGGERS.items():
+            self._db.execute('DROP TRIGGER IF EXISTS %s' % name)
+            self._db.execute('CREATE TRIGGER %s %s' % (name, trigger))
+        self._db.execute('DELETE FROM rover_summary_changes')
+
+    def _update(self):
+        n_changes = self._db.execute('SELECT count(*) FROM rover_summary_changes').fetchone()[0]
+        self._log.info('Updating summary table (%d N_S_L_Cs changed)' % n_changes)
+        if n_changes:
+            self._db.execute('''DELETE FROM tsindex_summary
+                                 WHERE EXISTS (SELECT 1 FROM rover_summary_changes AS c
+                                                WHERE c.network = tsindex_summary.network
+                                                  AND c.station = tsindex_summary.station
+                                                  AND c.location = tsindex_summary.location
+                                                  AND c.channel = tsindex_summary.channel)''')
+            self._db.execute('INSERT INTO tsindex_summary ' +
+                             _SUMMARY_ROWS % '''JOIN rover_summary_changes AS c
+                                                  ON c.network = t.network AND c.station = t.station
+                                                 AND c.location = t.location AND c.channel = t.channel''')
+            self._db.execute('DELETE FROM rover_summary_changes')
 
 
 class SummaryLister(SqliteSupport):
@@ -3,14 +3,18 @@ import datetime
 import time
 import re
 import codecs
+import io
 
 from binascii import hexlify
+from functools import lru_cache
 from hashlib import sha1
+from math import modf
 from os import makedirs, stat, getpid, listdir, unlink, kill, name, rename, rmdir, strerror
 from os.path import dirname, exists, isdir, expanduser, abspath, join, realpath, getmtime
 from shutil import move, copyfile
 from subprocess import Popen, check_output, STDOUT
 from sys import version_info
+from threading import Lock
 
 if version_info[0] >= 3:
     from os import replace
@@ -54,6 +58,10 @@ def safe_unlink(path):
             pass  # file still in use on windows
 
 
+# commands that have already been checked (so in-process workers don't re-check)
+_CHECKED_CMDS = set()
+
+
 def check_cmd(config, param, name):
     """
     Check the command exists and, if not, inform the user.
@@ -63,10 +71,13 @@ def check_cmd(config, param, name):
     if windows() and '/' in value:
         config.log.warn('Replacing slashes with back-slashes in "%s"' % value)
         value = re.sub(r'/', r'\\', value)
+    if value in _CHECKED_CMDS:
+        return value
     if not config.arg(FORCECMD):
         cmd = '%s -h' % value
         try:
             check_output(cmd, stderr=STDOUT, shell=True)
+            _CHECKED_CMDS.add(value)
             return value
         except Exception as e:
             config.log.error('Command "%s" failed' % cmd)
@@ -153,45 +164,99 @@ def unique_path(dir, filename, salt):
     name = uniqueish(filename, salt)
     return unique_filename(join(dir, name))
 
-def _stream_output(request, down, unique=True):
+# default size of blocks read from HTTP responses (see http-block-size)
+DEFAULT_BLOCKSIZE = 1024 * 1024
+
+
+def _stream_output(request, down, log, unique=True, blocksize=DEFAULT_BLOCKSIZE):
     # special case empty return.  this avoids handling empty files elsewhere
     # which isn't a 'serious' problem, but causes ugly logging
     if request.status_code == 204:
+        request.content  # consume (empty) body so the connection returns to the pool
         return None, lambda: None
     else:
         down = canonify(down)
         create_parents(down)
         if unique:
             down = unique_filename(down)
+        start, n_bytes = time.time(), 0
         with open(down, 'wb') as output:
-            for chunk in request.iter_content(chunk_size=1024):
-                if chunk:
-                    output.write(chunk)
+            if request.headers.get('Content-Encoding', 'identity') == 'identity':
+                # no decoding needed, so read directly from the socket into a re-used buffer
+                buffer = bytearray(blocksize)
+                view = memoryview(buffer)
+                while True:
+                    n = request.raw.readinto(buffer)
+                    if not n:
+                        break
+                    output.write(view[:n])
+                    n_bytes += n
+            else:
+                for chunk in request.iter_content(chunk_size=blocksize):
+                    if chunk:
+                        output.write(chunk)
+                        n_bytes += len(chunk)
+        elapsed = time.time() - start
+        log.info('Downloaded %d bytes in %.2fs (%.0f bytes/s)' % (n_bytes, elapsed, n_bytes / max(elapsed, 1e-6)))
         return down, request.raise_for_status
 
 
-def _session(retries):
+# connections are kept alive and shared between requests to the same host (availability,
+# dataselect and station services).  callers size the pool for the number of threads that
+# may make requests at once (see http_pool_size() in args.py), so that connections are not
+# discarded; any extra connections needed by a burst of threads are closed after use.
+HTTP_POOL_SIZE = 10
+_SESSIONS = {}
+_SESSIONS_LOCK = Lock()
+
+
+def _session(retries, pool_size=HTTP_POOL_SIZE):
     """
     Ugliness required by requests lib to set max retries.
-    (We don't really care about efficiency to the point where we need to re-use the session)
+    Sessions are cached (one per retry count and pool size) so that connections are re-used.
     """
-    # https://stackoverflow.com/questions/21371809/cleanly-setting-max-retries-on-python-requests-get-or-post-method
-    session = Session()
-    http_adapter = HTTPAdapter(max_retries=retries)
-    https_adapter = HTTPAdapter(max_retries=retries)
-    session.mount('http://', http_adapter)
-    session.mount('https://', https_adapter)
+    with _SESSIONS_LOCK:
+        key = (retries, pool_size)
+        if key not in _SESSIONS:
+            # https://stackoverflow.com/questions/21371809/cleanly-setting-max-retries-on-python-requests-get-or-post-method
+            session = Session()
+            http_adapter = HTTPAdapter(max_retries=retries, pool_maxsize=pool_size)
+            https_adapter = HTTPAdapter(max_retries=retries, pool_maxsize=pool_size)
+            session.mount('http://', http_adapter)
+            session.mount('https://', https_adapter)
+
+            # Create a User-Agent header with package, requests and Python identifiers
+            from rover import __version__
+            user_agent = 'rover/%s python-requests/%s Python/%s' % \
+                         (__version__, requests_version, ".".join(map(str, version_info[:3])))
+            session.headers.update({'User-Agent': user_agent})
+            _SESSIONS[key] = session
+
+        return _SESSIONS[key]
+
 
-    # Create a User-Agent header with package, requests and Python identifiers
-    from rover import __version__
-    user_agent = 'rover/%s python-requests/%s Python/%s' % \
-                 (__version__, requests_version, ".".join(map(str, version_info[:3])))
-    session.headers.update({'User-Agent': user_agent})
+def http_connection_stats():
+    """
+    Return (requests, new connections) for HTTP requests made by this process,
+    so that requests - new connections is the number that re-used a connection.
 
-    return session
+    Pools that have been discarded (too many different hosts) are not included.
+    """
+    n_requests, n_connections = 0, 0
+    with _SESSIONS_LOCK:
+        for session in _SESSIONS.values():
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        n_requests += pool.num_requests
+                        n_connections += pool.num_connections
+    return n_requests, n_connections
 
 
-def get_to_file(url, down, timeout, retries, log, unique=True):
+def get_to_file(url, down, timeout, retries, log, unique=True, blocksize=DEFAULT_BLOCKSIZE,
+                pool_size=HTTP_POOL_SIZE):
     """
     Execute an HTTP GET request, with output to a file.
 
@@ -202,11 +267,12 @@ def get_to_file(url, down, timeout, retries, log, unique=True):
     and the error exception.
     """
     log.info('Downloading %s from %s' % (down, url))
-    request = _session(retries).get(url, stream=True, timeout=timeout)
-    return _stream_output(request, down, unique=unique)
+    request = _session(retries, pool_size).get(url, stream=True, timeout=timeout)
+    return _stream_output(request, down, log, unique=unique, blocksize=blocksize)
 
 
-def post_to_file(url, up, down, timeout, retries, log, unique=True):
+def post_to_file(url, up, down, timeout, retries, log, unique=True, blocksize=DEFAULT_BLOCKSIZE,
+                 pool_size=HTTP_POOL_SIZE):
     """
     Execute an HTTP POST request, with output to a file.
 
@@ -219,8 +285,48 @@ def post_to_file(url, up, down, timeout, retries, log, unique=True):
     up = canonify(up)
     log.info('Downloading %s from %s with %s' % (down, url, up))
     with open(up, 'rb') as input:
-        request = _session(retries).post(url, stream=True, data=input, timeout=timeout)
-    return _stream_output(request, down, unique=unique)
+        request = _session(retries, pool_size).post(url, stream=True, data=input, timeout=timeout)
+    return _stream_output(request, down, log, unique=unique, blocksize=blocksize)
+
+
+def post_to_lines(url, up, down, timeout, retries, log, blocksize=DEFAULT_BLOCKSIZE, pool_size=HTTP_POOL_SIZE):
+    """
+    Execute an HTTP POST request, with output read (as text) while it arrives.
+
+    Returns (lines, lambda)
+    where lines iterates over the lines of the response (None if no data downloaded,
+                or on error, in which case the response is saved to down)
+          lambda() (ie when called) will raise an exception on HTTP error
+    """
+    up = canonify(up)
+    log.info('Streaming from %s with %s' % (url, up))
+    with open(up, 'rb') as input:
+        request = _session(retries, pool_size).post(url, stream=True, data=input, timeout=timeout)
+    if request.status_code == 204 or not request.ok:
+        down, check_status = _stream_output(request, down, log, unique=False, blocksize=blocksize)
+        return None, check_status
+    return _stream_lines(request, log, blocksize), request.raise_for_status
+
+
+def _stream_lines(request, log, blocksize):
+    start, n_lines = time.time(), 0
+    request.raw.decode_content = True  # undo any content encoding as we read
+    request.raw.auto_close = False  # let the text wrapper see the end of the data
+    input, complete = io.TextIOWrapper(io.BufferedReader(request.raw, blocksize), encoding='utf-8'), False
+    try:
+        for line in input:
+            n_lines += 1
+            yield line
+        complete = True
+    finally:
+        # detach (rather than close) the wrappers, which would close the connection.  once all the
+        # data are read the connection returns to the pool; if reading stopped early it cannot be re-used.
+        input.detach().detach()
+        if complete:
+            request.raw.release_conn()
+        else:
+            request.close()
+    log.info('Streamed %d lines in %.2fs' % (n_lines, time.time() - start))
 
 
 def clean_old_files(dir, age_secs, match, log):
@@ -294,6 +400,7 @@ class UTC(datetime.tzinfo):
 utc = UTC()
 EPOCH = datetime.datetime.utcfromtimestamp(0)
 EPOCH_UTC = EPOCH.replace(tzinfo=utc)
+EPOCH_ORDINAL = EPOCH.toordinal()
 
 
 def assert_valid_time(log, time):
@@ -308,9 +415,33 @@ def assert_valid_time(log, time):
         raise Exception(msg)
 
 
+@lru_cache(maxsize=4096)
+def _format_day(days):
+    # the date part (with separator) for a number of days since the epoch
+    return datetime.date.fromordinal(EPOCH_ORDINAL + days).strftime('%Y-%m-%dT')
+
+
 def format_epoch(epoch):
     """
     Format an epoch in the standard format.
+
+    Equivalent to _strftime_epoch(), but splits the epoch directly (with the same
+    rounding as datetime.fromtimestamp()) and caches the date part.
+    """
+    fraction, whole = modf(epoch)
+    micros = round(fraction * 1e6)
+    seconds = int(whole)
+    if micros >= 1000000:
+        seconds, micros = seconds + 1, micros - 1000000
+    elif micros < 0:
+        seconds, micros = seconds - 1, micros + 1000000
+    days, seconds = divmod(seconds, 86400)
+    return '%s%02d:%02d:%02d.%06d' % (_format_day(days), seconds // 3600, seconds // 60 % 60, seconds % 60, micros)
+
+
+def _strftime_epoch(epoch):
+    """
+    Format an epoch in the standard format (via datetime; used to check format_epoch()).
     """
     dt = datetime.datetime.fromtimestamp(epoch, utc)
     return datetime.datetime.strftime(dt, '%Y-%m-%dT%H:%M:%S.%f')
@@ -348,9 +479,45 @@ def format_time_epoch_local(epoch):
     return datetime.datetime.strftime(dt, '%Y-%m-%dT%H:%M:%S')
 
 
+# the fixed shapes handled by parse_epoch() directly
+_EPOCH_SHAPE = re.compile(r'(\d{4}-\d\d-\d\d)(?:T(\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?)?Z?$', re.ASCII)
+
+
+@lru_cache(maxsize=4096)
+def _parse_day(date):
+    # seconds from the epoch to the start of the day, or None if invalid
+    try:
+        day = datetime.date(int(date[0:4]), int(date[5:7]), int(date[8:10]))
+    except ValueError:
+        return None
+    return (day.toordinal() - EPOCH_ORDINAL) * 86400
+
+
 def parse_epoch(date):
     """
     Parse a date in the standard formats
+
+    The usual (fixed width) shapes are handled directly, giving the same value as
+    _strptime_epoch(); anything else (or anything invalid) falls back to that.
+    """
+    match = _EPOCH_SHAPE.match(date)
+    if match:
+        day, hour, minute, second, fraction = match.groups()
+        seconds = _parse_day(day)
+        if seconds is not None:
+            hour = int(hour) if hour else 0
+            minute = int(minute) if minute else 0
+            second = int(second) if second else 0
+            if hour < 24 and minute < 60 and second < 60:
+                micros = int(fraction.ljust(6, '0')) if fraction else 0
+                # integer microseconds, divided once, as timedelta.total_seconds()
+                return ((seconds + hour * 3600 + minute * 60 + second) * 1000000 + micros) / 1000000
+    return _strptime_epoch(date)
+
+
+def _strptime_epoch(date):
+    """
+    Parse a date in the standard formats (via datetime; used by and to check parse_epoch()).
     """
     if date.endswith('Z'):
         date = date[:-1]
@@ -445,7 +612,9 @@ def _python_sort(log, path):
 def _os_sort(log, path, temp_dir):
     sorted_path = unique_path(temp_dir, 'rover_sort', path)
     log.debug('Sorting %s into %s' % (path, sorted_path))
-    run('sort %s > %s' % (path, sorted_path), log)
+    # byte order (C locale) matches python and sqlite, which lets manager merge the sorted
+    # availability with the index
+    run('%ssort %s > %s' % ('' if windows() else 'LC_ALL=C ', path, sorted_path), log)
     safe_unlink(path)
     move(sorted_path, path)
 
@@ -482,10 +651,11 @@ def diagnose_error(log, error, request, response, copied=True):
     # avoid import loop
     from .args import mm, VERBOSITY, NO, DELETEFILES
     log.error(error)
-    log.error('Response contents (max 10 lines) are listed below:')
-    log_file_contents(response, log, 10)
-    log.error('Please pay special attention to the first lines of the message - ' +
-              'they often contains useful information.')
+    if response:  # None if the response was not saved
+        log.error('Response contents (max 10 lines) are listed below:')
+        log_file_contents(response, log, 10)
+        log.error('Please pay special attention to the first lines of the message - ' +
+                  'they often contains useful information.')
     log.error('Request contents (max 10 lines) are listed below:')
     log_file_contents(request, log, 10)
     log.error('The request is either provided by the user or created from the user input.')
@@ -4,10 +4,12 @@ from sqlite3 import OperationalError
 from threading import Thread
 from time import sleep
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit
 
-from .manager import INCONSISTENT, UNCERTAIN
+from .manager import INCONSISTENT, UNCERTAIN, wal_size
 from .args import HTTPBINDADDRESS, HTTPPORT, RETRIEVE, DAEMON, WEB
 from .download import DEFAULT_NAME
+from .metrics import metrics_path
 from .process import ProcessManager
 from .sqlite import SqliteSupport, NoResult
 from .utils import process_exists, format_time_epoch, format_time_epoch_local, safe_unlink
@@ -57,6 +59,9 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         We detect what is running and generate the appropriate response.
         """
+        if urlsplit(self.path).path == '/metrics':
+            self._do_metrics()
+            return
         self.send_response(200)
         self.send_header('Content-type', 'text/html')
         self.end_headers()
@@ -74,6 +79,20 @@ class RequestHandler(BaseHTTPRequestHandler):
     def _write(self, text):
         self.wfile.write(text.encode('ascii'))
 
+    def _do_metrics(self):
+        # the metrics are written by the download manager (see metrics.py), so there's
+        # no database access here
+        try:
+            with open(metrics_path(self.server.config), 'rb') as input:
+                body = input.read()
+        except FileNotFoundError:
+            body = b''
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def _html_header(self):
         self._write('''<html lang="en">
   <head>
@@ -126,20 +145,38 @@ Last active: %s (%s local)</pre></p>''' %
             pass
         if not count[0]:
             self._write('<p>No subscriptions</p>')
+        self._write_database()
         self._write_explanation()
 
     def _do_retrieve(self):
         self._write('<h2>Retrieval Progress</h2>')
         self._write_progress(DEFAULT_NAME, None, None, None)
+        self._write_database()
         self._write_explanation()
 
+    def _write_database(self):
+        self._write('<h2>Database</h2>')
+        self._write('<p><pre>WAL size: %.1f MiB\n' % (wal_size(self.server.config) / 1024 / 1024))
+        try:
+            checkpoint_epoch, duration, wal_before, wal_after, busy = \
+                self.server.fetchone('''SELECT checkpoint_epoch, duration, wal_before, wal_after, busy
+                                          FROM rover_checkpoint_stats''')
+            self._write('Last checkpoint: %s (%s local), took %.2fs, WAL %.1f MiB before, %.1f MiB after%s' %
+                        (format_time_epoch(checkpoint_epoch), format_time_epoch_local(checkpoint_epoch), duration,
+                         wal_before / 1024 / 1024, wal_after / 1024 / 1024, ' (incomplete)' if busy else ''))
+        except (NoResult, OperationalError):
+            self._write('Last checkpoint: none')
+        self._write('</pre></p>')
+
     def _write_progress(self, name, last_check_epoch, last_error_count, consistent):
         try:
-            initial_stations, remaining_stations, initial_time, remaining_time, n_retries, download_retries = \
+            initial_stations, remaining_stations, initial_time, remaining_time, n_retries, download_retries, \
+                provisional = \
                 self.server.fetchone('''SELECT initial_stations, remaining_stations, initial_time, remaining_time,
-                                               n_retries, download_retries
+                                               n_retries, download_retries, provisional
                                           FROM rover_download_stats WHERE submission = ?''', (name,))
-            self._write('<p>Progress for download attempt %d of %d:<pre>\n' % (n_retries, download_retries))
+            self._write('<p>Progress for download attempt %d of %d%s:<pre>\n' %
+                        (n_retries, download_retries, ' (provisional - still checking availability)' if provisional else ''))
             self._write_bar('stations', initial_stations, remaining_stations)
             self._write_bar('timespan', initial_time, remaining_time)
             self._write('</pre></p>')
@@ -175,6 +212,9 @@ Last active: %s (%s local)</pre></p>''' %
 <li>Progress values are based on data still to be downloaded; they do not include data within the pipeline.</li>
 <li>The stations statistic is the number of distinct Net_Sta that will be requested.</li>
 <li>The timespan statistic is the total time (s) covered by the data in the downloads.</li>
+<li>Totals are provisional (may increase) while the availability service is still being checked.</li>
+<li>The database is checkpointed (the WAL copied into the database and truncated) when no downloads are running; if downloads do not finish within a few seconds, the checkpoint is skipped (shown as incomplete).</li>
+<li>Metrics for monitoring (in the Prometheus text format) are at <a href="/metrics">/metrics</a>.</li>
 <li>Firefox will not open file:// URLs, but you can copy them to the address bar, where they will work.</li>
 </ul>
 ''')
@@ -191,6 +231,7 @@ class Server(HTTPServer, SqliteSupport):
     def __init__(self, config, address, handler):
         HTTPServer.__init__(self, address, handler)
         SqliteSupport.__init__(self, config)
+        self.config = config
         self.process_manager = ProcessManager(config)
 
 
@@ -206,6 +247,9 @@ class ServerStarter:
 
 Starts a web server that provides information on the progress of the download
 manager. ROVER's default configuration starts `rover web` automatically.
+Metrics (download bytes and requests, chunk, ingest and index times, workers,
+retries and database lock waits) are available at /metrics, in the Prometheus
+text format.
 The flag`--no-web` prevents ROVER's web server from launching in accordance
 with `rover retrieve`.
 
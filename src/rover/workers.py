@@ -1,14 +1,17 @@
 import json
 import os
 
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import Popen
+from threading import local, Event, Thread
 from time import sleep
 
-from .args import TEMPDIR
+from .args import TEMPDIR, ERROR_CODE
+from .config import thread_config
 from .utils import uniqueish, unique_filename
 
 """
-Support for running multiple sub-processes.
+Support for running multiple sub-processes (or threads).
 """
 
 class Workers:
@@ -26,6 +29,7 @@ class Workers:
         self._log = config.log
         self._n_workers = n_workers
         self._workers = []  # (command, popen, callback)
+        self._finished = Event()  # set when a process exits (see wait())
 
     def execute(self, command, callback=None, feedback=None):
         """
@@ -46,7 +50,33 @@ class Workers:
                 raise Exception('Cannot open feedback file: %s' % ex)
 
         self._log.debug('Adding worker for "%s" (callback %s)' % (command, callback))
-        self._workers.append((command, self._popen(command, feedback=feedback), callback, feedback))
+        process = self._popen(command, feedback=feedback)
+        self._workers.append((command, process, callback, feedback))
+        # a thread per process blocks until exit, so that we can wait for an event rather than poll
+        Thread(target=self._watch, args=(process,), daemon=True).start()
+
+    def _watch(self, process):
+        process.wait()
+        self._finished.set()
+
+    def wait(self, timeout=None, pending=False):
+        """
+        Block until a worker finishes or wake() is called (or the timeout, in seconds,
+        expires), then call check().  With no workers, just sleeps for the timeout,
+        unless pending is True (some other work will call wake()).
+        """
+        if self._workers or pending:
+            self._finished.wait(timeout)
+            self._finished.clear()
+        elif timeout:
+            sleep(timeout)
+        self.check()
+
+    def wake(self):
+        """
+        Interrupt wait() (may be called from any thread).
+        """
+        self._finished.set()
 
     def _wait_for_space(self):
         while True:
@@ -54,11 +84,17 @@ class Workers:
             if self.has_space():
                 self._log.debug('Space for new worker (%d/%d)' % (len(self._workers), self._n_workers))
                 return
-            sleep(0.1)
+            self.wait()
 
     def has_space(self):
         return len(self._workers) < self._n_workers
 
+    def is_idle(self):
+        return not self._workers
+
+    def n_active(self):
+        return len(self._workers)
+
     def _default_callback(self, cmd, returncode, **kwargs):
         if returncode:
             raise Exception('"%s" returned %d' % (cmd, returncode))
@@ -66,14 +102,15 @@ class Workers:
             self._log.debug('"%s" succeeded' % (cmd,))
 
     def check(self):
-        for idx, worker in enumerate(self._workers):
+        # iterate over a copy so that removing a worker doesn't skip the next one
+        for worker in list(self._workers):
             command, process, callback, feedback = worker
 
             process.poll()
             if process.returncode is not None:
 
                 # Remove finished worker from list
-                del self._workers[idx]
+                self._workers.remove(worker)
 
                 self._log.debug('Calling callback %s (command %s)' % (callback, command))
 
@@ -105,7 +142,126 @@ class Workers:
             if not self._workers:
                 self._log.debug('No workers remain')
                 return
-            sleep(0.1)
+            self.wait()
 
     def _popen(self, command, feedback=None):
         return Popen(command, shell=True, stdout=feedback)
+
+
+class ThreadWorkers:
+    """
+    A collection of threads that run commands inside this process, with the
+    same interface as Workers.  Again, the Python code here does NOT run
+    asynchronously - it will block if there are no free workers - and
+    callbacks are called from check() in the calling thread.
+
+    Here a command is a callable that takes a configuration (private to the
+    worker thread, so with its own database connection) and a feedback
+    dictionary (or None), which it can fill in as the process-based worker
+    would write JSON to stdout.  Any exception is logged and reported to the
+    callback as ERROR_CODE.
+    """
+
+    def __init__(self, config, n_workers):
+        self._config = config
+        self._log = config.log
+        self._n_workers = n_workers
+        self._workers = []  # (command, future, callback, feedback)
+        self._executor = ThreadPoolExecutor(max_workers=n_workers)
+        self._local = local()
+        self._finished = Event()  # set when a thread completes (see wait())
+
+    def execute(self, command, callback=None, feedback=None):
+        """
+        Execute the command in a separate thread.
+        """
+        self._wait_for_space()
+
+        if not callback:
+            callback = self._default_callback
+
+        feedback = {} if feedback else None
+
+        self._log.debug('Adding worker for "%s" (callback %s)' % (command, callback))
+        future = self._executor.submit(self._run, command, feedback)
+        future.add_done_callback(lambda future: self._finished.set())
+        self._workers.append((command, future, callback, feedback))
+
+    def _run(self, command, feedback):
+        # each thread in the pool keeps its own configuration for its lifetime
+        if not hasattr(self._local, 'config'):
+            self._local.config = thread_config(self._config)
+        try:
+            command(self._local.config, feedback)
+            return 0
+        except Exception as e:
+            self._log.error('"%s" failed: %s' % (command, e))
+            return ERROR_CODE
+
+    def wait(self, timeout=None, pending=False):
+        """
+        Block until a worker finishes or wake() is called (or the timeout, in seconds,
+        expires), then call check().  With no workers, just sleeps for the timeout,
+        unless pending is True (some other work will call wake()).
+        """
+        if self._workers or pending:
+            self._finished.wait(timeout)
+            self._finished.clear()
+        elif timeout:
+            sleep(timeout)
+        self.check()
+
+    def wake(self):
+        """
+        Interrupt wait() (may be called from any thread).
+        """
+        self._finished.set()
+
+    def _wait_for_space(self):
+        while True:
+            self.check()
+            if self.has_space():
+                self._log.debug('Space for new worker (%d/%d)' % (len(self._workers), self._n_workers))
+                return
+            self.wait()
+
+    def has_space(self):
+        return len(self._workers) < self._n_workers
+
+    def is_idle(self):
+        return not self._workers
+
+    def n_active(self):
+        return len(self._workers)
+
+    def _default_callback(self, cmd, returncode, **kwargs):
+        if returncode:
+            raise Exception('"%s" returned %d' % (cmd, returncode))
+        else:
+            self._log.debug('"%s" succeeded' % (cmd,))
+
+    def check(self):
+        for worker in list(self._workers):
+            command, future, callback, feedback = worker
+            if future.done():
+
+                # Remove finished worker from list
+                self._workers.remove(worker)
+
+                self._log.debug('Calling callback %s (command %s)' % (callback, command))
+
+                if feedback:
+                    callback(command, future.result(), feedback=feedback)
+                else:
+                    callback(command, future.result())
+
+    def wait_for_all(self):
+        """
+        Wait for all remaining threads to finish.
+        """
+        while True:
+            self.check()
+            if not self._workers:
+                self._log.debug('No workers remain')
+                return
+            self.wait()
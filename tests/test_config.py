@@ -3,8 +3,9 @@ from tempfile import TemporaryDirectory
 from os.path import join, dirname
 
 from rover.config import BaseConfig, RepoInitializer
-from rover.args import Arguments, TEMPDIR, DATADIR, FILE, INIT_REPOSITORY, DEFAULT_FILE
+from rover.args import Arguments, TEMPDIR, DATADIR, FILE, INIT_REPOSITORY, DEFAULT_FILE, HTTPBLOCKSIZE, fail_early, mm
 from rover.utils import canonify, windows
+from .shared_utils import TestConfig
 
 class DummyLog:
     def debug(self, *args): pass
@@ -121,3 +122,12 @@ def test_CONFIGDIR_bad():
             assert 'does not exist' in str(e), str(e)
         else:
             assert False, 'Expected exception'
+
+
+def test_http_block_size(tmp_path):
+    for size in ('0', '-1M', 'x'):
+        config = TestConfig(str(tmp_path), http_block_size=size)
+        with pytest.raises(Exception) as e:
+            fail_early(config)
+        assert mm(HTTPBLOCKSIZE) in str(e.value), str(e.value)
+    fail_early(TestConfig(str(tmp_path), http_block_size='64k'))
@@ -1,9 +1,9 @@
 import pytest
 from tempfile import TemporaryDirectory
-from random import randint, seed
+from random import randint, seed, Random
 
 from rover.logs import init_log
-from rover.coverage import Coverage
+from rover.coverage import Coverage, ArrayCoverage
 from rover.utils import format_epoch, parse_epoch
 
 
@@ -150,3 +150,62 @@ def test_coverage():
             # and must end with a width of at least 2, and at least one before end (so after, within tolerance)
             index_end = randint(max(avail_end-1, index_start+2), 6)
             run_explicit(log, 1.5, 0.5, [(index_start, index_end)], [(avail_start, avail_end)], [])
+
+
+def random_timespans(rng, n, scale):
+    # sorted starts with a mix of gaps, touching spans and (if messy) overlaps and spans inside others
+    messy = rng.random() < 0.3
+    timespans, start, end = [], rng.uniform(0, scale), 0
+    for i in range(n):
+        if messy:
+            start += rng.choice((0, rng.uniform(0, 0.1), rng.uniform(0, 1), rng.uniform(0, 10))) * scale
+        else:
+            start = end + rng.choice((0, rng.uniform(0, 0.1), rng.uniform(0, 1), rng.uniform(0, 10))) * scale
+        end = start + rng.choice((0, rng.uniform(0, 0.1), rng.uniform(0, 1), rng.uniform(0, 10))) * scale
+        timespans.append((start, end))
+    return timespans
+
+
+def copy_coverage(cls, log, coverage):
+    copy = cls(log, coverage._frac_tolerance, coverage._frac_increment, coverage.sncl)
+    copy.timespans = list(coverage.timespans)
+    copy.samplerate = coverage.samplerate
+    return copy
+
+
+def test_array_coverage():
+    pytest.importorskip('numpy')
+    with TemporaryDirectory() as dir:
+        log = init_log(dir, '10M', 1, 5, 4, 'coverage', False, 1)[0]
+        rng = Random(42)
+        for i in range(300):
+            samplerate = rng.choice((0, 0.1, 1, 40, 10000))
+            tolerance, increment = rng.choice(((0.5, 0.5), (1.5, 0.5), (0, 0), (0.1, 2)))
+            # spacing on the scale of the sample period, so tolerances matter
+            scale = 1 / samplerate if samplerate else 1
+            us = Coverage(log, tolerance, increment, 'N_S_L_C')
+            for start, end in random_timespans(rng, rng.randint(0, 300), scale):
+                us.add_epochs(start, end, samplerate)
+            them = Coverage(log, tolerance, increment, 'N_S_L_C')
+            if rng.random() < 0.3:
+                # mostly the same data
+                for start, end in us.timespans:
+                    if rng.random() < 0.9:
+                        them.add_epochs(start + rng.uniform(-1, 1) * tolerance * scale,
+                                        end + rng.uniform(-1, 1) * tolerance * scale, samplerate)
+                them.timespans.sort()
+            else:
+                for start, end in random_timespans(rng, rng.randint(0, 300), scale):
+                    them.add_epochs(start, end, samplerate)
+            array_us, array_them = copy_coverage(ArrayCoverage, log, us), copy_coverage(ArrayCoverage, log, them)
+            try:
+                expected = us.subtract(them)
+            except Exception as e:
+                with pytest.raises(Exception):
+                    array_us.subtract(array_them)
+                continue
+            result = array_us.subtract(array_them)
+            assert array_us.timespans == us.timespans
+            assert array_them.timespans == them.timespans
+            assert result.timespans == expected.timespans
+            assert result.samplerate == expected.samplerate
@@ -1,14 +1,17 @@
 import pytest
+from shutil import copyfile
 from tempfile import TemporaryDirectory
 from io import StringIO as buffer
-from os import unlink
+from os import unlink, listdir
 from os.path import join, dirname
 
 from rover import IndexLister
-from rover.args import DATADIR
+from rover.args import DATADIR, INDEXENGINE, MSEEDINDEX, NATIVE, ALL, INDEX
 
-from rover.index import Indexer
-from .shared_utils import ingest_and_index
+from rover.index import Indexer, TsindexWriter, index_file, create_rover_indexes, ROVER_INDEXES
+from rover.ingest import Ingester
+from rover.scan import DatabasePathIterator, directory_range
+from .shared_utils import ingest_and_index, TestConfig
 
 
 def test_ingest_and_index():
@@ -32,6 +35,144 @@ def test_deleted_file():
         assert n == 0, n
 
 
+def test_index_engines():
+    testdir = join(dirname(__file__), 'data')
+    columns = '''network, station, location, channel, quality, version, starttime, endtime, samplerate,
+                 filename, byteoffset, bytes, hash, timespans, filemodtime'''
+    sql = 'SELECT %s FROM tsindex ORDER BY filename, byteoffset' % columns
+
+    with TemporaryDirectory() as dir:
+        config = ingest_and_index(dir, [testdir])
+        config.db.execute('DELETE FROM tsindex')
+        config.db.commit()
+        Indexer(TestConfig(dir, **{INDEXENGINE.replace('-', '_'): MSEEDINDEX})).run([])
+        expected = config.db.execute(sql).fetchall()
+        config.db.execute('DELETE FROM tsindex')
+        config.db.commit()
+        # --all, because the change journal (created above) doesn't know about the deletion
+        Indexer(TestConfig(dir, **{ALL: True, INDEXENGINE.replace('-', '_'): NATIVE})).run([])
+        assert config.db.execute(sql).fetchall() == expected
+
+
+def test_change_journal():
+    testdir = join(dirname(__file__), 'data')
+
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        Indexer(config).run([])  # complete (empty) scan, so the journal is created
+        Ingester(TestConfig(dir, **{INDEX: False})).run([testdir])
+        journal = config.db.execute('SELECT filename FROM rover_changed_files').fetchall()
+        assert journal == [(join(config.arg(DATADIR), 'IU', '2010', '058', 'ANMO.IU.2010.058'),)], journal
+        Indexer(config).run([])
+        n = config.db.execute('SELECT count(*) FROM tsindex').fetchone()[0]
+        assert n == 36, n
+        n = config.db.execute('SELECT count(*) FROM rover_changed_files').fetchone()[0]
+        assert n == 0, n
+        # changes made elsewhere are only found with --all
+        config.db.execute('DELETE FROM tsindex')
+        config.db.commit()
+        Indexer(config).run([])
+        n = config.db.execute('SELECT count(*) FROM tsindex').fetchone()[0]
+        assert n == 0, n
+        Indexer(TestConfig(dir, **{ALL: True})).run([])
+        n = config.db.execute('SELECT count(*) FROM tsindex').fetchone()[0]
+        assert n == 36, n
+        # ingest that indexes directly leaves nothing in the journal
+        Ingester(config).run([testdir])
+        n = config.db.execute('SELECT count(*) FROM rover_changed_files').fetchone()[0]
+        assert n == 0, n
+
+
+class RecordingIndexer(Indexer):
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.processed = []
+
+    def process(self, path):
+        self.processed.append(path)
+        super().process(path)
+
+
+def test_changed_directories():
+    testdir = join(dirname(__file__), 'data')
+
+    with TemporaryDirectory() as dir:
+        config = ingest_and_index(dir, [testdir])
+        Indexer(config).run([])  # complete scan, saving the directory states
+        indexer = RecordingIndexer(config)
+        indexer.run([])
+        assert indexer.processed == [], indexer.processed
+        # files added and removed outside rover are found from the directory states
+        day = join(config.arg(DATADIR), 'IU', '2010', '058')
+        unlink(join(day, 'ANMO.IU.2010.058'))
+        indexer = RecordingIndexer(config)
+        indexer.run([])
+        assert indexer.processed == [], indexer.processed
+        n = config.db.execute('SELECT count(*) FROM tsindex').fetchone()[0]
+        assert n == 0, n
+        copyfile(join(testdir, 'IU.ANMO.00-2010-02-27T06-30-00.000-2010-02-27T10-30-00.000.mseed'),
+                 join(day, 'ANMO.IU.2010.058'))
+        indexer = RecordingIndexer(config)
+        indexer.run([])
+        assert indexer.processed == [join(day, 'ANMO.IU.2010.058')], indexer.processed
+        n = config.db.execute('SELECT count(*) FROM tsindex').fetchone()[0]
+        assert n > 0, n
+
+
+def test_directory_range():
+    # filenames use the platform's separator, so check ranges for both
+    for sep in ('/', '\\'):
+        day = sep.join(('', 'data', 'IU', '2010', '058'))
+        inside = [day + sep + name for name in ('ANMO.IU.2010.058', 'COR.IU.2010.058')]
+        outside = [day, day + '0' + sep + 'ANMO.IU.2010.0580', day + '.bak' + sep + 'ANMO.IU.2010.058',
+                   day[:-1] + '9' + sep + 'ANMO.IU.2010.059', day + ('/' if sep == '\\' else '\\') + 'x']
+        lower, upper = directory_range(day, sep)
+        assert [name for name in sorted(inside + outside) if lower <= name < upper] == inside, sep
+
+
+def test_database_path_pages():
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        assert list(DatabasePathIterator(config)) == []  # no table
+        data_dir = config.arg(DATADIR)
+        config.db.execute('CREATE TABLE tsindex (filename text, filemodtime text)')
+        names = ['%s/%03d' % (data_dir, i) for i in range(7)]
+        config.db.executemany('INSERT INTO tsindex VALUES (?, ?)',
+                              [(name, '2010-01-01T00:00:0%d' % i) for name in names for i in range(2)])
+        config.db.commit()
+        paths = DatabasePathIterator(config, page_size=3)
+        found = [next(paths) for _ in range(3)]
+        # changes after the last page read are seen, before are not
+        config.db.execute('DELETE FROM tsindex WHERE filename = ?', (names[4],))
+        config.db.execute('INSERT INTO tsindex VALUES (?, ?)', (data_dir + '/000a', '2010-01-01T00:00:00'))
+        config.db.commit()
+        found.extend(paths)
+        assert found == [('2010-01-01T00:00:01', join(data_dir, '%03d' % i)) for i in (0, 1, 2, 3, 5, 6)], found
+        # once exhausted, new files are not seen
+        config.db.execute('INSERT INTO tsindex VALUES (?, ?)', (data_dir + '/999', '2010-01-01T00:00:00'))
+        config.db.commit()
+        assert list(paths) == []
+
+
+def test_batched_writer():
+    testdir = join(dirname(__file__), 'data')
+    paths = [join(testdir, file) for file in sorted(listdir(testdir))]
+
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        writer = TsindexWriter(config, batch_files=2)
+        for path in paths[0:3]:
+            writer.add(path, index_file(path))
+        assert writer.n_batches == 1
+        writer.add(paths[0], index_file(paths[0]))  # replaces the earlier rows
+        writer.close()
+        assert writer.n_batches == 2
+        assert writer.n_files == 4
+        n = config.db.execute('select count(*) from tsindex').fetchone()[0]
+        assert n == 27, n
+
+
 def run_list_index(dir, args):
     testdir = join(dirname(__file__), 'data')
     config = ingest_and_index(dir, [testdir])
@@ -67,3 +208,77 @@ def test_count():
     with TemporaryDirectory() as dir:
         n = run_list_index(dir, ['count'])
         assert int(n) == 36, n
+
+
+def assert_plan(config, sql, params, expected):
+    details = [row[3] for row in config.db.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+    assert any(expected in detail for detail in details), details
+    for detail in details:
+        assert 'TEMP B-TREE' not in detail, details
+        assert not detail.startswith('SCAN tsindex') or 'COVERING INDEX' in detail, details
+
+
+def test_query_plans():
+    testdir = join(dirname(__file__), 'data')
+
+    with TemporaryDirectory() as dir:
+        config = ingest_and_index(dir, [testdir])
+        # Source._scan_index
+        assert_plan(config, '''SELECT coalesce(timespans, '<' || starttime || ' ' || endtime || '>'), samplerate
+                                 FROM tsindex
+                                WHERE network=? AND station=? AND location=? AND channel=?
+                                ORDER BY starttime, endtime''', ('IU', 'ANMO', '00', 'BHZ'),
+                    'SEARCH tsindex USING INDEX rover_tsindex_nslc_idx')
+        # Source._stream_index
+        assert_plan(config, '''SELECT network, station, location, channel,
+                                      coalesce(timespans, '<' || starttime || ' ' || endtime || '>'), samplerate
+                                 FROM tsindex WHERE (network = ?)
+                                ORDER BY network, station, location, channel''', ('IU',),
+                    'SEARCH tsindex USING INDEX rover_tsindex_nslc_idx')
+        # DatabasePathIterator
+        assert_plan(config, '''SELECT max(filemodtime), filename FROM tsindex WHERE filename > ?
+                               GROUP BY filename ORDER BY filename LIMIT ?''', ('', 10),
+                    'SEARCH tsindex USING COVERING INDEX rover_tsindex_filename_idx')
+        # ModifiedScanner._delete
+        assert_plan(config, 'delete from tsindex where filename = ?', ('x',), 'SEARCH tsindex USING')
+        # list-index with and without wildcards
+        for args in (['IU_ANMO_00_BHZ'], ['IU_ANMO_00_BH*'], ['net=IU', 'sta=AN*'],
+                     ['iu_anmo_00_bhz'], ['net=Iu', 'sta=aN*']):
+            lister = IndexLister(config)
+            lister._parse_args(args)
+            sql, params = lister._build_query()
+            assert ' like ' not in sql
+            assert_plan(config, sql, params, 'SEARCH tsindex USING')
+        # '_' is a wildcard, so still uses like (which can use the index for a prefix)
+        for args in (['net=I_'], ['net=IU', 'sta=AN_*']):
+            lister = IndexLister(config)
+            lister._parse_args(args)
+            sql, params = lister._build_query()
+            assert ' like ' in sql
+            assert_plan(config, sql, params, 'SEARCH tsindex USING')
+        # an index from an earlier version (with a different definition) is replaced
+        config.db.execute('DROP INDEX rover_tsindex_nslc_idx')
+        config.db.execute('CREATE INDEX rover_tsindex_nslc_idx ON tsindex (network,station,timespans)')
+        create_rover_indexes(config.db, config.log)
+        assert config.db.execute("SELECT sql FROM sqlite_master WHERE name = 'rover_tsindex_nslc_idx'").fetchone() == \
+            ('CREATE INDEX rover_tsindex_nslc_idx ON %s' % ROVER_INDEXES['rover_tsindex_nslc_idx'],)
+
+
+def test_case_and_underscore():
+    # the same matching as 'like' with case_sensitive_like (see init_db()): '_' is a
+    # single character wildcard and case matters
+    with TemporaryDirectory() as dir:
+        config = ingest_and_index(dir, [join(dirname(__file__), 'data')])
+
+        def count(args):
+            stdout = buffer()
+            IndexLister(config).run(['count'] + args, stdout=stdout)
+            return int(stdout.getvalue())
+
+        assert count([]) == 36
+        for args in (['net=IU', 'sta=ANMO'], ['net=I_', 'sta=A?MO'], ['net=_U', 'sta=AN*'], ['net=*', 'sta=AN_*'],
+                     ['net=IU', 'sta=ANM_']):
+            assert count(args) == 36, args
+        for args in (['net=iu'], ['net=Iu'], ['net=IU', 'sta=anmo'], ['net=i_'], ['net=IU', 'sta=an*'],
+                     ['net=I__'], ['net=IU', 'sta=ANMO_']):
+            assert count(args) == 0, args
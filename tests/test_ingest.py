@@ -1,10 +1,16 @@
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory
-from os.path import join, dirname
+from os import listdir, getpid
+from os.path import join, dirname, getsize
 
-from rover.args import DATADIR
+from rover.args import DATADIR, MSEEDINDEXCMD, TEMPDIR, INDEXENGINE, MSEEDINDEX, NATIVE
 
+from rover.config import thread_config
 from rover.ingest import Ingester
+from rover.lock import DatabaseBasedLockFactory, MSEED
+from rover.sqlite import SqliteContext
+from rover.utils import run
 from .shared_utils import assert_files, TestConfig
 
 
@@ -19,3 +25,82 @@ def test_ingester(tmp_path):
         assert_files(join(data_dir, 'IU'), '2010')
         assert_files(join(data_dir, 'IU', '2010'), '058')
         assert_files(join(data_dir, 'IU', '2010', '058'), 'ANMO.IU.2010.058')
+
+
+def test_ingester_append_and_recover(tmp_path):
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        src = join(dirname(__file__), 'data', 'IU.ANMO.00-2010-02-27T06-30-00.000-2010-02-27T10-30-00.000.mseed')
+        Ingester(config).run((src,))
+        mseed_file = join(config.arg(DATADIR), 'IU', '2010', '058', 'ANMO.IU.2010.058')
+        size = getsize(mseed_file)
+        Ingester(config).run((src,))
+        assert getsize(mseed_file) == 2 * size
+        # simulate a crash mid-append by a process that no longer exists
+        with open(mseed_file, 'ab') as output:
+            output.write(b'partial')
+        config.db.execute('INSERT INTO rover_ingest_journal (filename, size, pid) VALUES (?, ?, ?)',
+                          (mseed_file, 2 * size, 2 ** 22 + 1))
+        config.db.commit()
+        ingester = Ingester(config)
+        assert getsize(mseed_file) == 2 * size
+        assert not ingester.fetchall('SELECT * FROM rover_ingest_journal')
+
+
+def test_ingester_index_rows(tmp_path):
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir, **{INDEXENGINE.replace('-', '_'): NATIVE})
+        data = join(dirname(__file__), 'data')
+        Ingester(config).run((join(data, 'IU.ANMO.00-2010-02-27T04-30-00.000-2010-02-27T08-30-00.000.mseed'),))
+        mseed_file = join(config.arg(DATADIR), 'IU', '2010', '058', 'ANMO.IU.2010.058')
+        columns = '''network, station, location, channel, quality, version, starttime, endtime, samplerate,
+                     filename, byteoffset, bytes, hash, timespans'''
+        sql = 'SELECT %s FROM tsindex ORDER BY byteoffset' % columns
+        rows = config.db.execute(sql).fetchall()
+        # the rows written directly match those from mseedindex
+        db_path = join(dir, 'mseedindex.sqlite')
+        run('%s -sqlite %s %s' % (config.arg(MSEEDINDEXCMD), db_path, mseed_file), config.log)
+        with SqliteContext(db_path, config.log) as db:
+            assert rows == db.fetchall(sql)
+        # and appended data are indexed at the correct offsets
+        Ingester(config).run((join(data, 'IU.ANMO.00-2010-02-27T09-00-00.000-2010-02-27T10-00-00.000.mseed'),))
+        rows = config.db.execute(sql).fetchall()
+        assert len(rows) > 1
+        offset = 0
+        for row in rows:
+            assert row[10] == offset
+            offset += row[11]
+        assert offset == getsize(mseed_file)
+
+
+def test_ingester_mseedindex_engine(tmp_path):
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir, **{INDEXENGINE.replace('-', '_'): MSEEDINDEX})
+        Ingester(config).run((join(dirname(__file__), 'data',
+                                   'IU.ANMO.00-2010-02-27T06-30-00.000-2010-02-27T10-30-00.000.mseed'),))
+        assert config.db.execute('SELECT count(*) FROM tsindex').fetchone()[0] == 9
+        # the temporary database for mseedindex was deleted
+        assert not listdir(config.dir(TEMPDIR))
+
+
+def test_thread_locks(tmp_path):
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        # a table from an older version, with a lock held by another process
+        with config.db:
+            config.db.execute('''CREATE TABLE rover_lock_mseed (id integer primary key autoincrement,
+                                 pid integer unique, key text unique, creation_epoch int)''')
+            config.db.execute("INSERT INTO rover_lock_mseed (pid, key) VALUES (1, 'c')")
+        factory = DatabaseBasedLockFactory(config, MSEED)
+        assert config.db.execute('SELECT pid, thread, key FROM rover_lock_mseed').fetchall() == [(1, None, 'c')]
+        with factory.lock('a', pid=getpid()):
+            # another thread in this process can lock a different file at the same time
+
+            def lock(key):
+                local = thread_config(config)
+                with DatabaseBasedLockFactory(local, MSEED).lock(key, pid=getpid()):
+                    return local.db.execute('SELECT count(*) FROM rover_lock_mseed').fetchone()[0]
+
+            with ThreadPoolExecutor(1) as executor:
+                assert executor.submit(lock, 'b').result(timeout=10) == 3
+        assert config.db.execute('SELECT key FROM rover_lock_mseed').fetchall() == [('c',)]
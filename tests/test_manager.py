@@ -0,0 +1,305 @@
+from concurrent.futures import Future
+from os import listdir
+from os.path import join, dirname
+from queue import Queue
+from tempfile import TemporaryDirectory
+from time import sleep
+
+from rover.args import TIMESPANTOL, TIMESPANINC
+from rover.coverage import Coverage
+from rover.coverage_cache import CoverageCache
+from rover.download import TMPRESPONSE
+from rover.manager import Chunks, ProgressStatistics, Retrieval, Source, CheckpointScheduler, wal_size
+from rover.sqlite import SqliteSupport
+from rover.utils import parse_epoch
+from rover.ingest import Ingester
+from .shared_utils import ingest_and_index, TestConfig
+
+
+def coverage(sncl, start, end, samplerate=None):
+    coverage = Coverage(None, 0, 0, sncl)
+    coverage.add_epochs(parse_epoch(start), parse_epoch(end), samplerate)
+    return coverage
+
+
+def read_chunks(chunks, coverages):
+    progress = ProgressStatistics()
+    coverages = list(coverages)
+    while coverages and chunks.sncl_ok(coverages[0].sncl):
+        chunks.add_coverage(coverages.pop(0))
+    requests = []
+    while chunks:
+        description, path = chunks.pop(progress)
+        with open(path) as input:
+            requests.append((description, input.readlines()))
+    return requests, coverages
+
+
+def test_one_day_per_request():
+    with TemporaryDirectory() as dir:
+        requests, remaining = read_chunks(Chunks(dir), [
+            coverage('IU_ANMO_00_BHZ', '2010-01-01T00:00:00', '2010-01-03T12:00:00'),
+            coverage('IU_ANMO_00_BHN', '2010-01-01T00:00:00', '2010-01-03T12:00:00'),
+            coverage('IU_COLA_00_BHZ', '2010-01-01T00:00:00', '2010-01-03T12:00:00')])
+        assert [r[0] for r in requests] == ['IU_ANMO 2010-001', 'IU_ANMO 2010-002', 'IU_ANMO 2010-003']
+        assert all(len(r[1]) == 2 for r in requests)
+        assert len(remaining) == 1
+
+
+def test_combined_requests():
+    with TemporaryDirectory() as dir:
+        # 40Hz * 2 bytes * 86400s is about 6.6MB per channel day
+        requests, remaining = read_chunks(Chunks(dir, 15 * 1024 * 1024), [
+            coverage('IU_ANMO_00_BHZ', '2010-01-01T00:00:00', '2010-01-03T12:00:00'),
+            coverage('IU_COLA_00_BHZ', '2010-01-01T00:00:00', '2010-01-03T12:00:00')])
+        assert [r[0] for r in requests] == ['IU_ANMO 2010-001-2010-002', 'IU_ANMO 2010-003']
+        assert len(remaining) == 1
+        requests, remaining = read_chunks(Chunks(dir, 30 * 1024 * 1024), [
+            coverage('IU_ANMO_00_BHZ', '2010-01-01T00:00:00', '2010-01-02T12:00:00'),
+            coverage('IU_ANMO_00_BHN', '2010-01-01T00:00:00', '2010-01-02T12:00:00'),
+            coverage('IU_COLA_00_LHZ', '2010-01-01T00:00:00', '2010-01-03T12:00:00')])
+        assert not remaining
+        assert [r[0] for r in requests] == ['IU_ANMO+1 2010-001-2010-003']
+        assert len(requests[0][1]) == 7
+
+
+def index_source(config, request):
+    # a source without the retrieval (which needs an availability service)
+    source = Source.__new__(Source)
+    SqliteSupport.__init__(source, config)
+    source._log = config.log
+    source._timespan_tol = config.arg(TIMESPANTOL)
+    source._timespan_inc = config.arg(TIMESPANINC)
+    source._request_path = request
+    source._coverage_cache = CoverageCache(config)
+    return source
+
+
+MSEED = join(dirname(__file__), 'data', 'IU.ANMO.00-2010-02-27T06-30-00.000-2010-02-27T10-30-00.000.mseed')
+
+
+def check_join_index(source, sncls):
+    remotes = [coverage(sncl, '2010-02-27T00:00:00', '2010-02-28T00:00:00') for sncl in sncls]
+    joined = list(source._join_index(remotes))
+    assert [remote.sncl for remote, local in joined] == sncls
+    for remote, local in joined:
+        expected = source._scan_index(remote.sncl)
+        expected.join()
+        local.join()
+        assert local.sncl == expected.sncl
+        assert local.timespans == expected.timespans
+        assert local.samplerate == expected.samplerate
+    return [bool(local) for remote, local in joined]
+
+
+def test_join_index():
+    with TemporaryDirectory() as dir:
+        config = ingest_and_index(dir, (MSEED,))
+        request = join(dir, 'request')
+        with open(request, 'w') as output:
+            print('IU ANMO * * 2010-02-27T00:00:00 2010-02-28T00:00:00', file=output)
+        source = index_source(config, request)
+        # includes a channel with no local data and one out of order
+        sncls = ['IU_ANMO_00_AAA', 'IU_ANMO_00_BHZ', 'IU_ANMO_00_LHZ', 'IU_ANMO_00_BHZ', 'IU_ANMO_00_VHZ',
+                 'IU_ANMO_10_BHZ']
+        assert check_join_index(source, sncls) == [False, True, True, True, True, False]
+        assert source.fetchsingle('SELECT count(*) FROM rover_coverage_cache WHERE timespans IS NOT NULL') == 3
+        # again, from the cache
+        assert check_join_index(source, sncls) == [False, True, True, True, True, False]
+        assert source.fetchsingle('SELECT count(*) FROM rover_coverage_cache WHERE timespans IS NOT NULL') == 3
+        # indexing the same data again invalidates the cache
+        Ingester(config).run((MSEED,))
+        assert source.fetchsingle('SELECT count(*) FROM rover_coverage_cache') == 0
+        assert check_join_index(source, sncls) == [False, True, True, True, True, False]
+
+
+def test_coverage_cache_changes():
+    with TemporaryDirectory() as dir:
+        config = ingest_and_index(dir, (MSEED,))
+        cache = CoverageCache(config)
+        assert cache.prepare()
+        cached = 'SELECT channel FROM rover_coverage_cache WHERE timespans IS NOT NULL ORDER BY channel'
+        coverages = [coverage(sncl, '2010-02-27T06:30:00', '2010-02-27T10:30:00', 20.0)
+                     for sncl in ('IU_ANMO_00_BHZ', 'IU_ANMO_00_LHZ')]
+        token = cache.reserve(['network = ?'], ('IU',))
+        # a change to one N_S_L_C (while its coverage is read) prevents only that being saved
+        config.db.execute('''INSERT INTO tsindex (network, station, location, channel)
+                             VALUES ('IU', 'ANMO', '00', 'BHZ')''')
+        config.db.commit()
+        cache.save(coverages, token)
+        assert config.db.execute(cached).fetchall() == [('LHZ',)]
+        # read again, but changed (after reserving) and reserved by another reader
+        token = cache.reserve(['network = ?'], ('IU',))
+        config.db.execute('''INSERT INTO tsindex (network, station, location, channel)
+                             VALUES ('IU', 'ANMO', '00', 'BHZ')''')
+        config.db.commit()
+        other = cache.reserve(['network = ?'], ('IU',))
+        # so the first reader (which may have read before the change) cannot save it
+        cache.save(coverages, token)
+        assert config.db.execute(cached).fetchall() == [('LHZ',)]
+        # but the second reader can
+        assert cache.prepare()  # unchanged, so the cache is kept
+        cache.save(coverages, other)
+        assert config.db.execute(cached).fetchall() == [('BHZ',), ('LHZ',)]
+        assert [c.sncl for c in map(cache.coverage, cache.stream([], ()))] == ['IU_ANMO_00_BHZ', 'IU_ANMO_00_LHZ']
+        # and changes delete the entry
+        config.db.execute("DELETE FROM tsindex WHERE channel = 'LHZ'")
+        config.db.commit()
+        assert config.db.execute(cached).fetchall() == [('BHZ',)]
+
+
+def availability_lines(sncls):
+    lines = ['#Network Station Location Channel Earliest Latest\n']
+    for sncl in sncls:
+        n, s, l, c = (code if code else '--' for code in sncl.split('_'))
+        day = 27 if sncl.endswith('Z') else 28
+        lines.append('%s %s %s %s 2010-02-%02dT01:00:00.000000Z 2010-02-%02dT02:00:00.000000Z\n' % (n, s, l, c, day, day))
+    return lines
+
+
+def parse_availability(source, sncls):
+    lines = iter(availability_lines(sncls))
+    return [(coverage.sncl, coverage.timespans) for coverage in source._parse_availability(lines, source._request_path)]
+
+
+def test_parse_availability():
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        request = join(dir, 'request')
+        source = index_source(config, request)
+        source._temp_dir, source._delete_files, source._sort_in_python = dir, True, True
+        # grouped and ordered, so parsed directly
+        parsed = parse_availability(source, ['IU_ANMO__BHE', 'IU_ANMO__BHZ', 'IU_ANMO__BHZ', 'IU_COLA_00_BHZ'])
+        assert [sncl for sncl, timespans in parsed] == ['IU_ANMO__BHE', 'IU_ANMO__BHZ', 'IU_COLA_00_BHZ']
+        assert len(parsed[1][1]) == 2
+        # out of order, so the rest is sorted
+        parsed = parse_availability(source, ['IU_COLA_00_BHZ', 'IU_ANMO__BHZ', 'IU_KONO_00_BHZ', 'IU_ANMO__BHE'])
+        assert [sncl for sncl, timespans in parsed] == ['IU_COLA_00_BHZ', 'IU_ANMO__BHE', 'IU_ANMO__BHZ', 'IU_KONO_00_BHZ']
+        assert not [name for name in listdir(dir) if name.startswith(TMPRESPONSE)]
+        # start times out of order within an N_S_L_C, so sorted (in memory)
+        lines = availability_lines(['IU_ANMO__BHE', 'IU_ANMO__BHZ', 'IU_COLA_00_BHZ'])
+        lines.insert(2, lines[1].replace('T01:00', 'T00:00').replace('T02:00', 'T00:30'))
+        coverages = list(source._parse_availability(iter(lines), request))
+        assert [coverage.sncl for coverage in coverages] == ['IU_ANMO__BHE', 'IU_ANMO__BHZ', 'IU_COLA_00_BHZ']
+        assert len(coverages[0].timespans) == 2 and coverages[0].timespans == sorted(coverages[0].timespans)
+
+
+def test_build_requests():
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        request = join(dir, 'request')
+        with open(request, 'w') as output:
+            for station in ('COLA', 'ANMO', 'KONO', 'ANMO', 'MAJO'):
+                print('IU %s * * 2010-02-27T00:00:00 2010-02-28T00:00:00' % station, file=output)
+            print('II PFO * * 2010-02-27T00:00:00 2010-02-28T00:00:00', file=output)
+        source = index_source(config, request)
+        source._temp_dir, source._availability_workers = dir, 3
+        shards = []
+        for path in source._build_requests(request):
+            with open(path, 'r') as input:
+                lines = input.readlines()
+            assert lines[0] == 'merge=samplerate,quality\n'
+            shards.append([line.split()[1] for line in lines[1:]])
+        # stations are not split between shards
+        assert shards == [['PFO', 'ANMO', 'ANMO'], ['COLA'], ['KONO', 'MAJO']]
+        assert source._request_networks(path) == ['IU']
+        source._availability_workers = 10
+        assert len(source._build_requests(request)) == 5
+
+
+def test_build_requests_wildcards():
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        request = join(dir, 'request')
+        with open(request, 'w') as output:
+            for codes in ('IU * * BHZ', 'IU ANMO * *', 'TA * * BHZ', 'I? KON? * *', 'II PFO * *', 'IU,II MAJO * *'):
+                print('%s 2010-02-27T00:00:00 2010-02-28T00:00:00' % codes, file=output)
+        source = index_source(config, request)
+        source._temp_dir, source._availability_workers = dir, 3
+        shards = []
+        for path in source._build_requests(request):
+            with open(path, 'r') as input:
+                shards.append(sorted(' '.join(line.split()[0:2]) for line in input.readlines()[1:]))
+        # lines that could match the same station are in the same shard
+        assert shards == [['I? KON?', 'IU *', 'IU ANMO', 'IU,II MAJO'], ['II PFO'], ['TA *']], shards
+
+
+def test_pipeline():
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        request = join(dir, 'request')
+        with open(request, 'w') as output:
+            print('IU ANMO * * 2010-02-27T00:00:00 2010-02-28T00:00:00', file=output)
+        source = index_source(config, request)
+        source._retrieval = Retrieval(config.log, '', dir, False, 'http://example.com', 0, True, 0)
+        source._retrieval.progress.provisional = True
+        source._pipeline, source._wake, source._delete_files, source._fetch = True, None, False, False
+        future, queue = Future(), Queue()
+        source._shards, source._joining = [(future, request, queue)], None
+        # coverages are added while the query is still running
+        queue.put(coverage('IU_ANMO_00_BHZ', '2010-02-27T00:00:00', '2010-02-28T00:00:00'))
+        source._collect_availability()
+        assert source.availability_pending()
+        assert [c.sncl for c in source.get_coverages()] == ['IU_ANMO_00_BHZ']
+        assert str(source.stats()) == '(N_S 0/1+; day 0/0)'
+        queue.put(coverage('IU_ANMO_00_LHZ', '2010-02-27T00:00:00', '2010-02-28T00:00:00'))
+        future.set_result(None)
+        source._collect_availability()
+        assert not source.availability_pending()
+        assert [c.sncl for c in source.get_coverages()] == ['IU_ANMO_00_BHZ', 'IU_ANMO_00_LHZ']
+        assert str(source.stats()) == '(N_S 0/1; day 0/0)'
+
+
+def test_checkpoint():
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        config.db.execute('PRAGMA journal_mode=WAL')
+        scheduler = CheckpointScheduler(config)
+        assert scheduler.is_due()
+        config.db.execute('CREATE TABLE test (value text)')
+        config.db.executemany('INSERT INTO test VALUES (?)', [('x' * 100,)] * 1000)
+        config.db.commit()
+        assert wal_size(config) > 100000
+        scheduler.checkpoint()
+        assert not scheduler.is_due()
+        wal_before, wal_after, busy = config.db.execute(
+            'SELECT wal_before, wal_after, busy FROM rover_checkpoint_stats').fetchone()
+        assert wal_before > 100000
+        assert wal_after == 0
+        assert not busy
+
+
+def test_checkpoint_drain():
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        config.db.execute('PRAGMA journal_mode=WAL')
+        scheduler = CheckpointScheduler(config, drain=0.1)
+        config.db.execute('CREATE TABLE test (value text)')
+        config.db.executemany('INSERT INTO test VALUES (?)', [('x' * 100,)] * 1000)
+        config.db.commit()
+        stats = 'SELECT wal_before, wal_after, busy FROM rover_checkpoint_stats'
+        # workers running, so wait, but not for longer than the drain time
+        assert scheduler.drain(False, False)
+        assert scheduler.drain(False, False)
+        assert scheduler.is_due()
+        sleep(0.1)
+        assert not scheduler.drain(False, False)
+        assert not scheduler.is_due()
+        wal_before, wal_after, busy = config.db.execute(stats).fetchone()
+        assert wal_before > 100000 and wal_after == wal_before and busy
+        # reading the index (an open statement on the connection), so skip without waiting
+        scheduler._last = None
+        cursor = config.db.execute('SELECT value FROM test')
+        cursor.fetchone()
+        assert not scheduler.drain(False, True)
+        assert not scheduler.is_due()
+        assert config.db.execute(stats).fetchone()[2]
+        # and a checkpoint that cannot run on this connection is recorded as incomplete
+        scheduler.checkpoint()
+        cursor.close()
+        assert config.db.execute(stats).fetchone()[2]
+        # once idle, checkpoint
+        scheduler._last = None
+        assert not scheduler.drain(True, False)
+        wal_before, wal_after, busy = config.db.execute(stats).fetchone()
+        assert wal_before > 100000 and wal_after == 0 and not busy
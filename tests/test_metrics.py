@@ -0,0 +1,46 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from rover.metrics import Metrics, DOWNLOAD_BYTES, DOWNLOAD_REQUESTS, CHUNK_SECONDS, ACTIVE_WORKERS
+
+
+def test_counters_and_gauges():
+    metrics = Metrics()
+    metrics.inc(DOWNLOAD_BYTES, 100, source='retrieve')
+    metrics.inc(DOWNLOAD_BYTES, 50, source='retrieve')
+    metrics.inc(DOWNLOAD_REQUESTS, source='retrieve', result='ok')
+    metrics.set(ACTIVE_WORKERS, 3)
+    metrics.set(ACTIVE_WORKERS, 2)
+    assert metrics.get(DOWNLOAD_BYTES, source='retrieve') == 150
+    lines = metrics.render().splitlines()
+    assert '# TYPE rover_download_bytes_total counter' in lines
+    assert 'rover_download_bytes_total{source="retrieve"} 150' in lines
+    assert 'rover_download_requests_total{result="ok",source="retrieve"} 1' in lines
+    assert 'rover_workers_active 2' in lines
+    with pytest.raises(Exception):
+        metrics.inc('rover_unknown')
+
+
+def test_histogram():
+    metrics = Metrics(buckets=(1, 10))
+    for value in (0.5, 2, 3, 20):
+        metrics.observe(CHUNK_SECONDS, value, source='1')
+    lines = metrics.render().splitlines()
+    assert lines[1] == '# TYPE rover_chunk_seconds histogram', lines
+    assert lines[2:] == ['rover_chunk_seconds_bucket{source="1",le="1"} 1',
+                         'rover_chunk_seconds_bucket{source="1",le="10"} 3',
+                         'rover_chunk_seconds_bucket{source="1",le="+Inf"} 4',
+                         'rover_chunk_seconds_sum{source="1"} 25.5',
+                         'rover_chunk_seconds_count{source="1"} 4'], lines
+
+
+def test_write():
+    metrics = Metrics()
+    metrics.set(ACTIVE_WORKERS, 1)
+    with TemporaryDirectory() as dir:
+        path = join(dir, 'metrics.txt')
+        metrics.write(path)
+        with open(path) as input:
+            assert input.read() == metrics.render()
@@ -0,0 +1,45 @@
+
+from os.path import join, dirname
+from struct import pack
+
+from rover.mseed import scan_file, scan_records, group_sections
+from rover.utils import parse_epoch
+
+
+def ms3_record(start, n_samples, rate=20.0, sid='FDSN:IU_ANMO_00_B_H_Z', version=1):
+    # a miniSEED 3 record header (no data payload)
+    seconds = parse_epoch(start)
+    year, day = int(start[0:4]), int(seconds - parse_epoch(start[0:4] + '-01-01')) // 86400 + 1
+    hour, minute, second = int(start[11:13]), int(start[14:16]), int(start[17:19])
+    nanos = round((seconds % 1) * 1000000000)
+    return pack('<2sBBIHHBBBBdIIBBHI', b'MS', 3, 0, nanos, year, day, hour, minute, second, 11, rate,
+                n_samples, 0, version, len(sid), 0, 0) + sid.encode('ascii')
+
+
+def test_ms3_records():
+    data = ms3_record('2010-02-27T06:30:00.5', 100) + \
+           ms3_record('2010-02-27T06:30:05.5', 100) + \
+           ms3_record('2010-02-27T06:31:00.5', 10, rate=-10.0, sid='FDSN:IU_ANMO__L_H_Z', version=2)
+    records = list(scan_records(data))
+    assert [record.offset for record in records] == [0, 61, 122]
+    first = records[0]
+    assert first[0:6] == ('IU', 'ANMO', '00', 'BHZ', None, 1)
+    assert first.start == parse_epoch('2010-02-27T06:30:00.5')
+    assert first.end == parse_epoch('2010-02-27T06:30:05.45')
+    assert records[2][0:6] == ('IU', 'ANMO', '', 'LHZ', None, 2)
+    assert records[2].samplerate == 0.1
+    sections = list(group_sections(records))
+    assert len(sections) == 2
+    assert sections[0].length == 122
+    assert sections[0].timespans == [(first.start, records[1].end)]
+
+
+def test_ms2_file():
+    records = scan_file(join(dirname(__file__), 'data',
+                             'IU.ANMO.00-2010-02-27T09-00-00.000-2010-02-27T10-00-00.000.mseed'))
+    assert {record.channel for record in records} == {'BH1', 'BH2', 'BHZ', 'LH1', 'LH2', 'LHZ', 'VH1', 'VH2', 'VHZ'}
+    assert all(record.quality == 'M' and record.version == 4 for record in records)
+    offset = 0
+    for record in records:
+        assert record.offset == offset
+        offset += record.length
@@ -0,0 +1,39 @@
+
+from os.path import join, dirname
+from tempfile import TemporaryDirectory
+
+from rover.ingest import Ingester
+from rover.summary import Summarizer
+from .shared_utils import ingest_and_index
+
+
+def summary(config):
+    return config.db.execute('''SELECT network, station, location, channel, earliest, latest
+                                  FROM tsindex_summary ORDER BY 1, 2, 3, 4''').fetchall()
+
+
+def expected(config):
+    return config.db.execute('''SELECT network, station, location, channel, min(starttime), max(endtime)
+                                  FROM tsindex GROUP BY 1, 2, 3, 4 ORDER BY 1, 2, 3, 4''').fetchall()
+
+
+def test_incremental_summary():
+    data = join(dirname(__file__), 'data')
+    with TemporaryDirectory() as dir:
+        config = ingest_and_index(dir, [join(data, 'IU.ANMO.00-2010-02-27T04-30-00.000-2010-02-27T08-30-00.000.mseed')])
+        Summarizer(config).run([])
+        assert len(summary(config)) == 9
+        assert summary(config) == expected(config)
+        assert not config.db.execute('SELECT count(*) FROM rover_summary_changes').fetchone()[0]
+        # new data are recorded as changes and then summarised
+        Ingester(config).run([join(data, 'IU.ANMO.00-2010-02-27T11-00-00.000-2010-02-27T12-00-00.000.mseed')])
+        assert config.db.execute('SELECT count(*) FROM rover_summary_changes').fetchone()[0] == 9
+        Summarizer(config).run([])
+        assert summary(config) == expected(config)
+        assert summary(config)[0][5].startswith('2010-02-27T11:59')
+        # as are deletions
+        config.db.execute("DELETE FROM tsindex WHERE channel LIKE 'VH%'")
+        config.db.commit()
+        Summarizer(config).run([])
+        assert len(summary(config)) == 6
+        assert summary(config) == expected(config)
@@ -1,8 +1,16 @@
 import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from random import Random
 from tempfile import TemporaryDirectory
+from threading import Thread, Barrier
+from time import sleep
 
 from rover.logs import init_log
-from rover.utils import tidy_timestamp
+from rover.args import DOWNLOADWORKERS, AVAILABILITYWORKERS, http_pool_size
+from rover.utils import tidy_timestamp, get_to_file, post_to_lines, http_connection_stats, parse_epoch, format_epoch, \
+    _strptime_epoch, _strftime_epoch, HTTP_POOL_SIZE
+from .shared_utils import TestConfig
 
 
 def assert_timestamp(log, value, target):
@@ -16,3 +24,134 @@ def test_tidy_timestamp():
         assert_timestamp(log, '2018-7-4', '2018-07-04T00:00:00.000000')
         assert_timestamp(log, '2018-7-4T1:2:3.456', '2018-07-04T01:02:03.456000')
         assert_timestamp(log, '2018-7-4T1:3', '2018-07-04T01:03:00.000000')
+
+
+def test_epoch_codec():
+    random = Random(42)
+    for _ in range(10000):
+        epoch = round(random.uniform(-1e9, 4e9), random.randint(0, 7))
+        text = format_epoch(epoch)
+        assert text == _strftime_epoch(epoch), epoch
+        for date in (text, text + 'Z', text[:23], text[:19], text[:16], text[:10]):
+            assert parse_epoch(date) == _strptime_epoch(date), date
+    assert parse_epoch('2018-7-4') == parse_epoch('2018-07-04')
+    for date in ('2010-02-30', '2010-01-01T24:00', '2010-01-01T00:00:00.1234567'):
+        with pytest.raises(ValueError):
+            parse_epoch(date)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = b'0123456789'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_connection_reuse():
+    with TemporaryDirectory() as dir:
+        log = init_log(dir, '7M', 1, 5, 0, 'test', False, 0)[0]
+        server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/data' % server.server_address[1]
+            n_requests, n_connections = http_connection_stats()
+            for i in range(3):
+                # small blocks so that responses are read in several parts
+                path, check_status = get_to_file(url, join(dir, 'data%d' % i), 10, 3, log, blocksize=3)
+                check_status()
+                with open(path, 'rb') as input:
+                    assert input.read() == b'0123456789'
+            assert http_connection_stats() == (n_requests + 3, n_connections + 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class LinesHandler(KeepAliveHandler):
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        data = b'IU ANMO\nIU COLA\n'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def test_streamed_connection_reuse():
+    with TemporaryDirectory() as dir:
+        log = init_log(dir, '7M', 1, 5, 0, 'test', False, 0)[0]
+        server = ThreadingHTTPServer(('127.0.0.1', 0), LinesHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = 'http://127.0.0.1:%d/query' % server.server_address[1]
+            request = join(dir, 'request')
+            with open(request, 'w') as output:
+                print('IU * * * 2010-01-01 2010-01-02', file=output)
+            n_requests, n_connections = http_connection_stats()
+            for i in range(3):
+                lines, check_status = post_to_lines(url, request, join(dir, 'error%d' % i), 10, 3, log, blocksize=3)
+                check_status()
+                assert list(lines) == ['IU ANMO\n', 'IU COLA\n']
+            assert http_connection_stats() == (n_requests + 3, n_connections + 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class SlowKeepAliveHandler(KeepAliveHandler):
+
+    def do_GET(self):
+        sleep(0.3)  # so that requests from all threads overlap
+        super().do_GET()
+
+
+def test_connection_pool_size():
+    # connections are only kept (and re-used) if the pool is large enough for all threads
+    n_threads = HTTP_POOL_SIZE + 2
+    with TemporaryDirectory() as dir:
+        log = init_log(dir, '7M', 1, 5, 0, 'test', False, 0)[0]
+        for pool_size in (n_threads, HTTP_POOL_SIZE):
+            server = ThreadingHTTPServer(('127.0.0.1', 0), SlowKeepAliveHandler)
+            Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                url = 'http://127.0.0.1:%d/data' % server.server_address[1]
+                barrier = Barrier(n_threads)
+
+                def download(i):
+                    for j in range(2):
+                        barrier.wait()
+                        get_to_file(url, join(dir, '%d-%d-%d' % (pool_size, i, j)), 10, 3, log,
+                                    pool_size=pool_size)[1]()
+
+                n_requests, n_connections = http_connection_stats()
+                threads = [Thread(target=download, args=(i,)) for i in range(n_threads)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                requests, connections = http_connection_stats()
+                assert requests - n_requests == 2 * n_threads
+                if pool_size == n_threads:
+                    assert connections - n_connections == n_threads, connections - n_connections
+                else:
+                    assert connections - n_connections > n_threads, connections - n_connections
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+def test_http_pool_size():
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir, **{DOWNLOADWORKERS.replace('-', '_'): 20,
+                                    AVAILABILITYWORKERS.replace('-', '_'): 4})
+        assert http_pool_size(config) == 24
@@ -0,0 +1,67 @@
+import pytest
+from tempfile import TemporaryDirectory
+from time import time
+
+from rover.args import ERROR_CODE
+from rover.workers import Workers, ThreadWorkers
+from .shared_utils import TestConfig
+
+
+class Command:
+
+    def __init__(self, fail=False):
+        self._fail = fail
+
+    def __call__(self, config, feedback):
+        config.db.execute('SELECT 1')  # private connection usable in the worker thread
+        if feedback is not None:
+            feedback['download_byte_count'] = 42
+        if self._fail:
+            raise Exception('Failure for tests')
+
+
+def test_thread_workers():
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        workers = ThreadWorkers(config, 2)
+        results = []
+
+        def callback(command, returncode, **kwargs):
+            results.append((returncode, kwargs.get('feedback')))
+
+        workers.execute(Command(), callback=callback, feedback=True)
+        workers.execute(Command(fail=True), callback=callback, feedback=True)
+        workers.execute(Command(), callback=callback)
+        workers.wait_for_all()
+
+        assert len(results) == 3, results
+        assert (0, {'download_byte_count': 42}) in results, results
+        assert (ERROR_CODE, {'download_byte_count': 42}) in results, results
+        assert (0, None) in results, results
+
+
+def test_thread_workers_default_callback():
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        workers = ThreadWorkers(config, 1)
+        workers.execute(Command(fail=True))
+        with pytest.raises(Exception):
+            workers.wait_for_all()
+
+
+def test_workers_wait():
+    with TemporaryDirectory() as dir:
+        config = TestConfig(dir)
+        workers = Workers(config, 2)
+        results = []
+        workers.execute('sleep 0.2', callback=lambda cmd, rtn, **kargs: results.append(rtn))
+        workers.execute('exit 3', callback=lambda cmd, rtn, **kargs: results.append(rtn))
+        start = time()
+        while len(results) < 2:
+            workers.wait()
+        assert sorted(results) == [0, 3]
+        # woken by the process exiting, not the (long) timeout
+        workers.execute('true', callback=lambda cmd, rtn, **kargs: results.append(rtn))
+        while len(results) < 3:
+            workers.wait(10)
+        assert time() - start < 5